@@ -1,11 +1,29 @@
 import pandas as pd
+import numpy as np
 from pyjstat import pyjstat
 import requests
 from collections import OrderedDict
-import stats_to_pandas as stp
 import time
 import copy
 import re
+import os
+import json
+import sys
+import importlib.util
+
+
+# Metadataen per URL som (tidspunkt, variabler), delt av alle SSBTable i prosessen
+metadata_cache = {}
+# Sekunder metadataen i metadata_cache kan brukes før den hentes på nytt
+metadata_ttl = 3600
+
+
+def invalidate_metadata(tabell_id=None):
+    """ Fjerner metadataen til tabell_id fra metadata_cache, eller alt hvis tabell_id er None. """
+    if tabell_id is None:
+        metadata_cache.clear()
+    else:
+        metadata_cache.pop(SSBTable(tabell_id).url, None)
 
 
 class SSBTable:
@@ -18,23 +36,35 @@ class SSBTable:
         full_url = "http://data.ssb.no/api/v0/no/table/"+self.tabell_id
         return full_url
 
+    def cached_variables(self):
+        """ Variablene fra metadata_cache, hentes fra SSB første gang og når de er eldre enn metadata_ttl. """
+        cached = metadata_cache.get(self.url)
+        if cached is None or time.time() - cached[0] > metadata_ttl:
+            df = pd.read_json(self.url)
+            cached = (time.time(), [dict(values) for values in df.iloc[:, 1]])
+            metadata_cache[self.url] = cached
+        return cached[1]
+
+    def invalidate(self):
+        """ Fjerner metadataen til tabellen fra metadata_cache, så den hentes på nytt neste gang. """
+        metadata_cache.pop(self.url, None)
+
     @property
     def variables(self):
-        full_url = self.url
-        df = pd.read_json(full_url)
-        SSBvariables = [dict(values) for values in df.iloc[:, 1]]
+        # En kopi, så den som endrer variablene ikke endrer metadata_cache
+        SSBvariables = copy.deepcopy(self.cached_variables())
         return SSBvariables
 
     @property
     def dimensions(self):
-        l = [i["code"] for i in self.variables]
+        l = [i["code"] for i in self.cached_variables()]
         return l
 
     @property
     def metadata(self):
         dfs = []
-        for i in range(len(self.dimensions)):
-            dfs.append(pd.DataFrame({str(self.dimensions[i])+"_kode": self.variables[i]["values"], str(self.dimensions[i]): self.variables[i]["valueTexts"]}))
+        for variable in self.cached_variables():
+            dfs.append(pd.DataFrame({str(variable["code"])+"_kode": variable["values"], str(variable["code"]): variable["valueTexts"]}))
         return dfs
 
 
@@ -51,231 +81,203 @@ def read_query(queries):
         return dataframes[0]
 
 
-x = '07459'
-a = SSBTable(x)
-
-query1 = stp.full_json(table_id=x, language="no")
-
-datostring = time.strftime("%Y, %m, %d, %H, %M, %S")
-datosplit = datostring.split(", ")
-
-# År er alltid siste dimensjonen i tabellen og siste verdi i arrayet har siste gyldige året
-if x != "08655":
-    gyldigeAar = query1["query"][-1]["selection"]["values"]
-    forsteAar = int(gyldigeAar[0])
-
-# forsteAar = int(query1["query"][-1]["selection"]["values"][0])
-# År er alltid siste dimensjonen i tabellen og siste verdi i arrayet har siste gyldige året
-if x != "08655":
-    sisteAar = int(query1["query"][-1]["selection"]["values"][-1])
-
-# Year variables used to get the years from 2015-now
-aarsFilter = "top"
-antallSisteAar = ["4"]
-
-# Each year consists of 4 quarters, which means that we want the top 12 to get the last 3 years
-antallKvartalAar = ["12"]
-
-if x == "12367":
-    query = []
-    for i in a.variables[a.dimensions.index("KOKart0000")]["values"]:
-        d = {"query": [{"code": "KOKregnskapsomfa0000", "selection": {"filter": "item", "values": ["A"]}},
-                       {"code": "KOKart0000", "selection": {"filter": "item", "values": [i]}},
-                       {"code": "Tid", "selection": {"filter": "top", "values": ["3"]}}], "response": {"format": "json-stat2"}}
-        query.append(d)
-elif x == "09817":
-    query = []
-    kommuneListe = query1["query"][0]
-
-    # The first landbakgrunn variable is Alle Land, pop this to use it later
-    alleLandVar = query1["query"][2]["selection"]["values"].pop(0)
-    landbakgrunnListe = query1["query"][2]
-
-    for i in a.variables[a.dimensions.index("InnvandrKat")]["values"]:
-        d = {"query": [kommuneListe,
-                       {"code": "Landbakgrunn", "selection": {
-                           "filter": "item", "values": [alleLandVar]}},
-                       {"code": "InnvandrKat", "selection": {
-                           "filter": "item", "values": [i]}},
-                       {"code": "ContentsCode", "selection": {
-                           "filter": "item", "values": ["Personer1"]}},
-                       {"code": "Tid", "selection": {"filter": aarsFilter, "values": antallSisteAar}}],
-             "response": {"format": "json-stat2"}}
-
-        query.append(d)
-
-        # If innvandringskategori is Invandrere then we want all the single countries as well
-        if i == "B":
-            d = {"query": [kommuneListe,
-                           landbakgrunnListe,
-                           {"code": "InnvandrKat", "selection": {
-                               "filter": "item", "values": [i]}},
-                           {"code": "ContentsCode", "selection": {
-                               "filter": "item", "values": ["Personer1"]}},
-                           {"code": "Tid", "selection": {"filter": aarsFilter, "values": antallSisteAar}}],
-                 "response": {"format": "json-stat2"}}
-            query.append(d)
-elif x == "07984":
-    query = []
-    kommuneListe = query1["query"][0]
-    næringListe = query1["query"][1]
-    alderListe = query1["query"][3]
-
-    q = {"query": [kommuneListe,
-                   næringListe,
-                   alderListe,
-                   {"code": "Tid", "selection": {"filter": aarsFilter, "values": antallSisteAar}}],
-         "response": {"format": "json-stat2"}}
-    query.append(q)
-elif x == "12449":
-    query1["query"][-1]["selection"]["filter"] = aarsFilter
-    query1["query"][-1]["selection"]["values"] = antallKvartalAar
-    query = [query1]
-elif x == "12362":
-    # The standard form to get KOSTRA funksjons from SSB
-    funksjonListe = {"code": "KOKfunksjon0000",
-                     "selection": {"filter": "item", "values": []}}
-    kommuneListe = query1["query"][0]
-
-    # Want all the FGK funksjons so we add the ones that starts with FGK to funksjonListe
-    for i in a.variables[a.dimensions.index("KOKfunksjon0000")]["values"]:
-        if i.startswith("FGK"):
-            funksjonListe["selection"]["values"].append(i)
-
-    q = {"query": [kommuneListe,
-                   funksjonListe,
-                   {"code": "KOKart0000", "selection": {
-                       "filter": "item", "values": ["AGD2"]}},
-                   {"code": "Tid", "selection": {"filter": aarsFilter, "values": antallSisteAar}}],
-         "response": {"format": "json-stat2"}}
-    query = [q]
-elif x == "12368":
-    # The standard form to get KOSTRA funksjons from SSB
-    funksjonListe = {"code": "KOKfunksjon0000",
-                     "selection": {"filter": "item", "values": []}}
-    kommuneListe = query1["query"][0]
-
-    # Want all the FGK funksjons so we add the ones that starts with FGK to funksjonListe
-    for i in a.variables[a.dimensions.index("KOKfunksjon0000")]["values"]:
-        if i.startswith("FGF"):
-            funksjonListe["selection"]["values"].append(i)
-
-    q = {"query": [kommuneListe,
-                   funksjonListe,
-                   {"code": "KOKart0000", "selection": {
-                       "filter": "item", "values": ["AGD2"]}},
-                   {"code": "Tid", "selection": {"filter": aarsFilter, "values": antallSisteAar}}],
-         "response": {"format": "json-stat2"}}
-    query = [q]
-elif x == "01182":
-    query1["query"][-1]["selection"]["filter"] = aarsFilter
-    query1["query"][-1]["selection"]["values"] = ["1"]
-    query = [query1]
-elif x == "08655":
-    print("08655")
-    query = [query1]
-else:
-    # Special cases, remove unwanted filter (bygningstype)
-    if x == "05939" or x == "05940":
-        del query1["query"][1]
-
-    # if x == "09345":
-    #	print(query1["query"][0]["selection"]["filter"])
-    #	query1["query"][0]["selection"]["filter"] = "vs:Kommun"
-
-    # Gamle koden
-    # 2020 sammenslåingskodene
-    # Svalbard, Jan Mayen, Kontinentalsokkelen, Utlandet, Havområder, Ikke bosatt i Norge
-    # Viken, Innlandet, Vestfold og Telemark, Agder, Vestland, Troms og Finnmark
-    # komnrreg = re.compile(r"^21|^22|^23|^25|^26|^30|^34|^38|^42|^46|^54|^88")
-    komnrreg = re.compile(r"^30|^34|^38|^42|^46|^54")
-    """    
-     Itererer på år for alle tabeller
-     query = []
-     for i in range(0, int(antallSisteAar[-1])):
-    	gjeldendeAar = sisteAar - i
-    
-    	Hvis tabellen ikke har antallSisteAar antall år
-    	if (gjeldendeAar < forsteAar):
-    		break
-    
-    	query.append(copy.deepcopy(query1))
-    	kom = []
-    	if (gjeldendeAar < 2020):
-    		for komnr in query[-1]["query"][0]["selection"]["values"]:
-    			if not komnrreg.match(komnr):
-    				kom.append(komnr)
-    """
-    regionindeks = 0
-    for idx, content in enumerate(query1["query"]):
-        if (content["code"] == "KOKkommuneregion0000" or content["code"] == "vs:Kommun"):
-            regionindeks = idx
-    """
-    Bruker regex for å fjerne overflødig data fra query
-    Viken, Innlandet, Vestfold og Telemark, Agder, Vestland, Troms og Finnmark
+ssb_max_row_query = 800000
+
+try:
+    skript_dir = os.path.dirname(os.path.abspath(__file__))
+except NameError:
+    # SQL Server sin external_script har ikke __file__
+    skript_dir = os.getcwd()
+profile_dir = os.path.join(skript_dir, "profiles")
+
+
+def last_meta_filter():
+    """ Laster Meta Filter AlleAar.py som modul, filnavnet har mellomrom så den kan ikke importeres med navn.
+
+    Reglene for gyldige regioner (RegionRules og load_region_rules) ligger der, og deles i stedet for å kopieres.
     """
-    nykomreg = re.compile(r"^30|^34|^38|^42|^46|^54")
+    if "meta_filter_alleaar" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("meta_filter_alleaar",
+                                                      os.path.join(skript_dir, "Meta Filter AlleAar.py"))
+        modul = importlib.util.module_from_spec(spec)
+        sys.modules["meta_filter_alleaar"] = modul
+        spec.loader.exec_module(modul)
+    return sys.modules["meta_filter_alleaar"]
+
 
-    trondregpre = re.compile(r"^16")
-    trondregpost = re.compile(r"^50")
+meta = last_meta_filter()
+
+
+def load_profile(table_id):
+    """ Leser profilen til tabellen fra profiles/<table_id>.json, None hvis tabellen ikke har en profil.
+
+    En profil beskriver spørringen deklarativt:
+        parts     : liste med utvalg, hvert utvalg er en dict med dimensjonskode -> seleksjon
+                    {"values": [...]}, {"all": true}, {"prefix": [...]}, {"top": N},
+                    {"first": N} eller {"skip": N}
+        unlisted  : "omit" (dimensjoner som ikke er nevnt sendes ikke med) eller "all"
+        fan_out   : dimensjoner planleggeren kan dele opp på hvis et utvalg blir større enn ssb_max_row_query
     """
-    Disse ble ikke påvirket av 2020 sammenslåingen
-    Trøndelag ble slått sammen i 2018 så man kunne hatt dette som noe eget
-    Stavanger, Møre og Romsdal, Nordland, Trøndelag
+    path = os.path.join(profile_dir, table_id + ".json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def resolve_selection(variable, selection):
+    """ Gjør om en seleksjon fra profilen til (filter, values, antall rader) for en dimensjon i metadataen. """
+    values = variable["values"]
+    if "values" in selection:
+        return "item", list(selection["values"]), len(selection["values"])
+    if "prefix" in selection:
+        prefixes = tuple(selection["prefix"])
+        selected = [v for v in values if v.startswith(prefixes)]
+        return "item", selected, len(selected)
+    if "top" in selection:
+        n = int(selection["top"])
+        return "top", [str(n)], min(n, len(values))
+    if "first" in selection:
+        selected = values[:int(selection["first"])]
+        return "item", selected, len(selected)
+    if "skip" in selection:
+        selected = values[int(selection["skip"]):]
+        return "item", selected, len(selected)
+    if selection.get("all"):
+        # Hele dimensjonen sendes som all/*, split_selections skriver ut verdiene hvis den må dele på den
+        return "all", ["*"], len(values)
+    raise ValueError("Ukjent seleksjon i profilen: " + json.dumps(selection))
+
+
+def split_selections(selections, variables, fan_out, max_rows):
+    """ Deler et utvalg på fan_out dimensjonene til hver del er under max_rows.
+
+    Deler bare så mye som trengs: dimensjonen deles i så store biter som radgrensen tillater,
+    og neste fan_out dimensjon brukes bare hvis én verdi fortsatt er for stor.
+    En del må ha færre rader enn max_rows, som delene meta_filter i Meta Filter AlleAar planlegger.
     """
-    uendretreg = re.compile(r"^11|^15|^18|^50")
-
-    # Svalbard, Jan Mayen, Kontinentalsokkelen, Utlandet, Havområder, Ikke bosatt i Norge
-    ovrigreg = re.compile(r"^21|^22|^23|^25|^26|^88|^99")
-
-    # Itererer på år for alle tabeller
-    # Ta utgangspunkt i gyldige år og går ned fra høyest til lavest, lager ett query per år
-    query = []
-    for i in enumerate(reversed(gyldigeAar)):
-        gjeldendeAar = int(i[1])
-        indeks = int(i[0])
-
-        if (indeks + 1 > int(antallSisteAar[0])):
-            break
-
-        # Hvis tabellen ikke har antallSisteAar antall år
-        if (gjeldendeAar < forsteAar):
-            break
-
-        # Deepcopier dataene hentet fra SSB for å kunne
-        query.append(copy.deepcopy(a.variables))
-
-        kom = []
-        # Hvis året man henter ut er < 2020 ta bare med kommunedata på pre-2020 kommuner
-        if (gjeldendeAar < 2018):
-            for komnr in query[-1]["query"][regionindeks]["selection"]["values"]:
-                if not ovrigreg.match(komnr):
-                    if not nykomreg.match(komnr):
-                        if not trondregpost.match(komnr):
-                            if(komnr == "5001"):
-                                print("wtf skjer her?2")
-                            kom.append(komnr)
-        elif (gjeldendeAar < 2020):
-            for komnr in query[-1]["query"][regionindeks]["selection"]["values"]:
-                if not ovrigreg.match(komnr):
-                    if not nykomreg.match(komnr):
-                        if not trondregpre.match(komnr):
-                            if(komnr == "1601"):
-                                print("wtf skjer her?2")
-                            kom.append(komnr)
-        # Ta bare med kommunedata på post-2020 kommuner
-        else:
-            for komnr in query[-1]["query"][regionindeks]["selection"]["values"]:
-                if not ovrigreg.match(komnr):
-                    if nykomreg.match(komnr) or uendretreg.match(komnr):
-                        kom.append(komnr)
-
-        query[-1]["query"][regionindeks]["selection"]["values"] = kom
-        query[-1]["query"][-1]["selection"]["values"] = [str(gjeldendeAar)]
-        query[-1]["response"]["format"] = "json-stat2"
-
-tries = 0
-r = read_query(query)
-while (tries < 10 and r.empty):
+    total = 1
+    for code in selections:
+        total *= selections[code][2]
+    if total < max_rows:
+        return [selections]
+
+    for code in fan_out:
+        if code not in selections or selections[code][2] < 2:
+            continue
+        _filter, values, size = selections[code]
+        if _filter == "top":
+            values = variables[code]["values"][-size:]
+        elif _filter == "all":
+            values = variables[code]["values"]
+        rest = total // size
+        per_chunk = max(1, (max_rows - 1) // rest)
+        chunks = []
+        for start in range(0, len(values), per_chunk):
+            chunk = dict(selections)
+            chunk_values = values[start:start + per_chunk]
+            chunk[code] = ("item", chunk_values, len(chunk_values))
+            chunks.extend(split_selections(chunk, variables, [c for c in fan_out if c != code], max_rows))
+        return chunks
+
+    print("Tabellen er større enn", max_rows, "rader og kan ikke deles mer på", fan_out)
+    return [selections]
+
+
+def compile_profile(profile, metadata_variables, max_rows=ssb_max_row_query):
+    """ Kompilerer en profil til minst mulig antall spørringer under max_rows. """
+    variables = OrderedDict((var["code"], var) for var in metadata_variables)
+    fan_out = profile.get("fan_out", [])
+    queries = []
+    for part in profile["parts"]:
+        for code in part:
+            if code not in variables:
+                raise KeyError(code + " finnes ikke i tabell " + profile["table_id"])
+        selections = OrderedDict()
+        for code, var in variables.items():
+            if code in part:
+                selections[code] = resolve_selection(var, part[code])
+            elif profile.get("unlisted", "omit") == "all":
+                selections[code] = resolve_selection(var, {"all": True})
+        for chunk in split_selections(selections, variables, fan_out, max_rows):
+            q = {"query": [{"code": code, "selection": {"filter": _filter, "values": values}}
+                           for code, (_filter, values, size) in chunk.items()],
+                 "response": {"format": "json-stat2"}}
+            queries.append(q)
+    return queries
+
+
+# TabellNummer blir satt av SQL Server sin external_script, uten den og som modul kan filen importeres uten å hente noe
+if __name__ == "__main__" or "TabellNummer" in globals():
+    import stats_to_pandas as stp
+
+    x = globals().get("TabellNummer", "07459")
+    a = SSBTable(x)
+
+    query1 = stp.full_json(table_id=x, language="no")
+
+    datostring = time.strftime("%Y, %m, %d, %H, %M, %S")
+    datosplit = datostring.split(", ")
+
+    # År er alltid siste dimensjonen i tabellen og siste verdi i arrayet har siste gyldige året
+    if x != "08655":
+        gyldigeAar = query1["query"][-1]["selection"]["values"]
+        forsteAar = int(gyldigeAar[0])
+
+    # forsteAar = int(query1["query"][-1]["selection"]["values"][0])
+    # År er alltid siste dimensjonen i tabellen og siste verdi i arrayet har siste gyldige året
+    if x != "08655":
+        sisteAar = int(query1["query"][-1]["selection"]["values"][-1])
+
+    # Year variables used to get the years from 2015-now
+    antallSisteAar = ["4"]
+
+    # Tabeller med egen profil i profiles/ bygges av compile_profile, resten bruker region filtreringen under
+    profil = load_profile(x)
+    if profil is not None:
+        query = compile_profile(profil, a.variables)
+    else:
+        # Special cases, remove unwanted filter (bygningstype)
+        if x == "05939" or x == "05940":
+            del query1["query"][1]
+
+        # if x == "09345":
+        #	print(query1["query"][0]["selection"]["filter"])
+        #	query1["query"][0]["selection"]["filter"] = "vs:Kommun"
+
+        regionindeks = 0
+        for idx, content in enumerate(query1["query"]):
+            if (content["code"] == "KOKkommuneregion0000" or content["code"] == "vs:Kommun"):
+                regionindeks = idx
+
+        # Hvilke kommuner som er gyldige hvert år avgjøres av regelsettet prefix, se load_region_rules i Meta Filter
+        regler = meta.load_region_rules("prefix")
+
+        # Itererer på år for alle tabeller
+        # Ta utgangspunkt i gyldige år og går ned fra høyest til lavest, lager ett query per år
+        query = []
+        for i in enumerate(reversed(gyldigeAar)):
+            gjeldendeAar = int(i[1])
+            indeks = int(i[0])
+
+            if (indeks + 1 > int(antallSisteAar[0])):
+                break
+
+            # Hvis tabellen ikke har antallSisteAar antall år
+            if (gjeldendeAar < forsteAar):
+                break
+
+            # Deepcopier dataene hentet fra SSB for å kunne endre kommunene og året
+            query.append(copy.deepcopy(query1))
+
+            komnr = query[-1]["query"][regionindeks]["selection"]["values"]
+            gyldige = regler.validity(komnr, [gjeldendeAar])[0]
+            query[-1]["query"][regionindeks]["selection"]["values"] = [k for k, g in zip(komnr, gyldige) if g]
+            query[-1]["query"][-1]["selection"]["values"] = [str(gjeldendeAar)]
+            query[-1]["response"]["format"] = "json-stat2"
+
+    tries = 0
     r = read_query(query)
-    tries = tries + 1
+    while (tries < 10 and r.empty):
+        r = read_query(query)
+        tries = tries + 1
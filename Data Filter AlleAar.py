@@ -9,6 +9,34 @@ from io import StringIO
 import json
 from datetime import datetime
 import numpy as np
+import os
+import sys
+import importlib.util
+
+
+try:
+    skript_dir = os.path.dirname(os.path.abspath(__file__))
+except NameError:
+    # SQL Server sin external_script har ikke __file__
+    skript_dir = os.getcwd()
+
+
+def last_meta_filter():
+    """ Laster Meta Filter AlleAar.py som modul, filnavnet har mellomrom så den kan ikke importeres med navn.
+
+    Reglene for gyldige regioner (region_rules) og KLASS regionene (RegionKLASS) deles med Meta Filter AlleAar
+    i stedet for å kopieres.
+    """
+    if "meta_filter_alleaar" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("meta_filter_alleaar",
+                                                      os.path.join(skript_dir, "Meta Filter AlleAar.py"))
+        modul = importlib.util.module_from_spec(spec)
+        sys.modules["meta_filter_alleaar"] = modul
+        spec.loader.exec_module(modul)
+    return sys.modules["meta_filter_alleaar"]
+
+
+meta = last_meta_filter()
 
 
 class SSBTable:
@@ -132,66 +160,15 @@ class SSBTable:
         return self.variables["variables"][dimension_closest_to_max]
 
 
-class RegionKLASS:
-    def __init__(self, klass_id):
-        self.klass_id = klass_id
-        self.to_date = time.localtime(time.time()).tm_year
-        self.from_date = self.to_date - 5
-        self.klass_variables = self.get_klass_variables()
-        self.filtered_klass_variables = self.filter_klass_variables()
-        self.filtered_regions = self.filter_regions()
-
-    
-    def region_klass_url(self, i):
-        url = "http://data.ssb.no/api/klass/v1/classifications/" + i + "/codes?from=" + str(self.from_date) + "-01-01&to=2059-01-01&includeFuture=true"
-        return url
+def region_klass(klass_id, from_date=None):
+    """ KLASS regionene for de siste fem årene, eller fra from_date, delt med Meta Filter AlleAar.
 
-    def get_klass_variables(self):
-        all_klass_data = []
-        for i in self.klass_id:
-            headers = {"Accept": "application/json", "charset": "UTF-8"}
-            response = requests.get(self.region_klass_url(i), headers=headers)
-            data = response.text
-
-            if ("?" in response.text):
-                data = response.text.replace("?", "š")
-            all_klass_data.append(data)
-        return all_klass_data
-
-    def filter_klass_variables(self):
-        regioner = []
-        for klass_id in self.klass_variables:
-            json_array = json.loads(klass_id)["codes"]
-
-            for item in json_array:
-                regioner_details = {"code": None,
-                                    "validFrom": None, "validTo": None}
-                regioner_details["code"] = item["code"]
-                datetime_object = datetime.strptime(
-                    item["validFromInRequestedRange"], "%Y-%m-%d")
-                regioner_details["validFrom"] = str(datetime_object.year)
-                datetime_object = datetime.strptime(
-                    item["validToInRequestedRange"], "%Y-%m-%d")
-                regioner_details["validTo"] = str(datetime_object.year)
-                regioner.append(regioner_details)
-        return regioner
-
-    def filter_regions(self):
-        filtered_regions_klass = {}
-        for regions in self.filtered_klass_variables:
-            try:
-                a = filtered_regions_klass[regions["code"]]
-                if regions["validFrom"] < filtered_regions_klass[regions["code"]]["validFrom"]:
-                    filtered_regions_klass[regions["code"]]["validFrom"] = regions["validFrom"]
-                else:
-                    filtered_regions_klass[regions["code"]]["validTo"] = regions["validTo"]
-            except KeyError:
-                filtered_regions_klass[regions["code"]] = regions
-        return filtered_regions_klass
-        
-
-ssb_table = SSBTable("07459", "Tid=2015,2016,2017,2018,2019")
-klass = RegionKLASS(["131", "104", "214"])
+    Klassifikasjonene hentes og slås sammen av meta.RegionKLASS (samtidig, alltid som UTF-8, og med
+    intervallene slått sammen), og deles med alle tabeller med samme from date, se meta.shared_region_klass.
+    """
+    if from_date is None:
+        from_date = time.localtime(time.time()).tm_year - 5
+    return meta.shared_region_klass(klass_id, from_date=from_date).load()
 
 
 def build_query(iterator=0, _filter="item", ):
@@ -264,6 +241,9 @@ def data_filter(data):
     
     data_region_index = data["dimension"][data["id"][table_region]]["category"]["index"]
     data_year_index = data["dimension"][data["id"][table_tid]]["category"]["index"]
+    # Hvilke regioner som er gyldige hvert år avgjøres av reglene i Meta Filter AlleAar (se load_region_rules)
+    gyldige = meta.region_rules.validity(list(data_region_index), [int(year) for year in data_year_index],
+                                         klass.filtered_regions)
     for y_idx, year in enumerate(data_year_index):
         counter = 0
         region_value_pos = y_idx
@@ -274,7 +254,7 @@ def data_filter(data):
         year_label = {}
         result["value"] = []
         for r_idx, region in enumerate(data_region_index):
-            if region in {"0", "EAK", "EAKUO"}:
+            if gyldige[y_idx, r_idx]:
                 region_index[region] = counter
                 region_label[region] = data["dimension"][data["id"][table_region]]["category"]["label"][region]
                 year_index[year] = 0
@@ -282,18 +262,6 @@ def data_filter(data):
                 for val in data["value"][region_value_pos:region_value_range:size[table_tid]]:
                     result["value"].append(val)
                 counter += 1
-            elif region in klass.filtered_regions.keys():
-                valid_from = int(klass.filtered_regions[region]["validFrom"])
-                valid_to = int(klass.filtered_regions[region]["validTo"])
-                if int(year) in range(valid_from, valid_to):
-                    region_index[region] = counter
-                    region_label[region] = data["dimension"][data["id"][table_region]]["category"]["label"][region]
-                    year_index[year] = 0
-                    year_label[year] = year
-                    for val in data["value"][region_value_pos:region_value_range:size[table_tid]]:
-                        result["value"].append(val)
-                            
-                    counter += 1
             region_value_pos += region_value_size
             region_value_range += region_value_size
         result["dimension"][data["id"][table_region]]["category"]["index"] = region_index
@@ -326,4 +294,7 @@ def post_query():
         return big_df
     return dataframes
 
-r = post_query()
\ No newline at end of file
+if __name__ == "__main__":
+    ssb_table = SSBTable("07459", "Tid=2015,2016,2017,2018,2019")
+    klass = region_klass(["131", "104", "214"])
+    r = post_query()
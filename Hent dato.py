@@ -12,5 +12,6 @@ def published_to_dataframe(table_id):
     dataframe = pd.DataFrame(data, columns = ["Tabell Nummer", "Oppdatert Dato"])
     return dataframe
 
-r = published_to_dataframe(TabellNummer)
-print(r)
+if "TabellNummer" in globals():
+    r = published_to_dataframe(TabellNummer)
+    print(r)
@@ -1,14 +1,146 @@
 import pandas as pd
+import numpy as np
 from pyjstat import pyjstat
 import requests
 from collections import OrderedDict
 import time
-import copy
 import re
 import json
+import io
+import csv
+import os
+import shutil
+import hashlib
+import gzip
+import threading
+import argparse
+import sqlite3
+import sys
+import cProfile
+import pstats
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 
+class Dimension:
+    """ A compact representation of one dimension in the metadata of a table.
+
+    The value codes are stored once per dimension in a NumPy string array, together with a code to position map.
+    The texts are kept as the list of str from the JSON, since a NumPy string array takes 4 bytes per character
+    of the longest text for every value, and they are only needed for to_variable and to parse text labels.
+    A filtered dimension, or the part of a dimension a query chunk asks for, is the same arrays with a different
+    array of positions, so we never copy the values themselves.
+
+    Attributes:
+    -----------
+    code : str
+        The code of the dimension, e.g. KOKkommuneregion0000 or Tid.
+    text : str
+        The name of the dimension, e.g. region or år.
+    time : bool
+        True if SSB has marked the dimension as the time dimension.
+    elimination : bool
+        True if the dimension can be left out of a query.
+    codes : numpy.ndarray
+        Every value code the table has for the dimension.
+    texts : list
+        The value texts, in the same order as codes.
+    index : dict
+        Value code to its position in codes.
+    positions : numpy.ndarray
+        Positions in codes that are selected.
+    fingerprint : str
+        A hash of the selected value codes, see the property.
+    """
+
+    __slots__ = ("code", "text", "time", "elimination", "codes", "texts", "index", "positions", "_fingerprint")
+
+    def __init__(self, variable=None):
+        """
+        Parameters:
+        -----------
+        variable : dict/None
+            A variable from the JSON metadata, with code, text, values and valueTexts.
+            Every value is selected.
+        """
+        if variable is None:
+            return
+        self.code = variable["code"]
+        self.text = variable["text"]
+        self.time = bool(variable.get("time", False))
+        self.elimination = bool(variable.get("elimination", False))
+        self.codes = np.array(variable["values"], dtype=str)
+        self.texts = list(variable["valueTexts"])
+        self.index = {code: pos for pos, code in enumerate(variable["values"])}
+        self.positions = np.arange(len(self.codes))
+        self._fingerprint = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def values(self):
+        """ The selected value codes as a list of str. """
+        return self.codes[self.positions].tolist()
+
+    @property
+    def value_texts(self):
+        """ The selected value texts as a list of str. """
+        return [self.texts[position] for position in self.positions.tolist()]
+
+    @property
+    def fingerprint(self):
+        """ A hash of the selected value codes, calculated the first time its used and kept.
+
+        Dimensions with the same values selected have the same fingerprint, so results calculated from the values
+        can be shared between tables, see period_validity. The codes are hashed as text with a separator and the
+        number of codes first, the raw bytes of codes dont have either, so "0301", "0101" would hash as "03010101".
+        """
+        if self._fingerprint is None:
+            values = "\0".join([str(len(self.positions))] + self.codes[self.positions].tolist())
+            self._fingerprint = hashlib.sha1(values.encode("utf-8")).hexdigest()
+        return self._fingerprint
+
+    @property
+    def is_complete(self):
+        """ True if every value in the table is selected, once each. """
+        return len(self.positions) == len(self.codes) and len(np.unique(self.positions)) == len(self.codes)
+
+    def select(self, positions):
+        """ Returns a new Dimension that shares the arrays with this one, with only positions selected.
+
+        Parameters:
+        -----------
+        positions : list/numpy.ndarray
+            Positions in codes, see index.
+
+        Returns:
+        --------
+        dimension : Dimension
+            The selected part of the dimension.
+        """
+        dimension = Dimension()
+        dimension.code = self.code
+        dimension.text = self.text
+        dimension.time = self.time
+        dimension.elimination = self.elimination
+        dimension.codes = self.codes
+        dimension.texts = self.texts
+        dimension.index = self.index
+        dimension.positions = np.asarray(positions, dtype=np.intp)
+        dimension._fingerprint = None
+        return dimension
+
+    def to_variable(self):
+        """ Returns the selected part of the dimension in the same form as the JSON metadata. """
+        variable = {"code": self.code, "text": self.text, "values": self.values, "valueTexts": self.value_texts}
+        if self.elimination:
+            variable["elimination"] = True
+        if self.time:
+            variable["time"] = True
+        return variable
+
+
 class SSBTable:
     """ A class used to get metadata from ssb.no, process them and keep track of variables.
 
@@ -28,8 +160,8 @@ class SSBTable:
         Creates a URL string for the table we will query.
     metadata_variables(self, metadata_filter):
         Does a JSON get request to the table metadata URL.
-        Calls on filter_json_metadata to filter the data based on the filters tags.
-    filter_json_metadata(self, json_metadata, filter_dict):
+        Calls on filter_dimensions to filter the data based on the filters tags.
+    filter_dimensions(self, dimensions, filter_dict_inc, filter_dict_exc):
         ...
     filter_as_dict
         ...
@@ -38,6 +170,8 @@ class SSBTable:
         Tid and Region since we will be iterating on those.
     """
 
+    filter_term = re.compile(r"^\s*(?P<code>[\w:\-]+)\s*(?P<operator>!=|=)\s*(?P<values>[^=!&]*?)\s*$")
+
     def __init__(self, table_id, metadata_filter=None):
         """
         Parameters:
@@ -48,10 +182,16 @@ class SSBTable:
             A list thats set to None by default, unless a filter has been passed along.
             This filter defines what data we will query with, if its empty we will query for everything.
 
+        Constructing a table is free, nothing is fetched from SSB until it is used. The metadata is fetched
+        the first time variables (or anything that depends on it) is used, and the KLASS regions the first time
+        klass is used. Both are kept on the object, so they are only fetched once per table.
+
         Attributes:
         -----------
-        variables : list
-            A complete list of the tables metadata, except for what had been filtered out by filter_json_metadata.
+        dimensions : list
+            The tables metadata as a list of Dimension, except for what had been filtered out by filter_dimensions.
+        variables : dict
+            The same metadata in the JSON form SSB returns it in, built from dimensions when its used.
         table_region : int
             Position of the Region dimension in variables.
         table_tid : int
@@ -59,7 +199,14 @@ class SSBTable:
         table_size : int
             Row size of the dimensions, except for Region and Tid.
         ssb_max_row_query : int
-            Maximum rows we can query per request to SSB.no
+            Maximum rows we plan per request to SSB.no, the size ChunkTuner has tuned for the table,
+            or ssb_row_limit if it hasnt been tuned, see planned_max_rows.
+        klass_id : list
+            The classifications used by klass to find valid regions.
+        region_rules : RegionRules
+            The rules meta_filter uses to decide which regions are valid, see load_region_rules.
+        stats : dict
+            Number of requests, bytes and rows, and seconds spent per stage, see new_stats.
         """
         self.table_id = table_id
         self.metadata_filter = metadata_filter
@@ -67,9 +214,107 @@ class SSBTable:
         self.inclusion_variables = None
         if metadata_filter != None:
             self.exclusion_variables, self.inclusion_variables = self.filters_as_dict(self.metadata_filter)
-        self.variables = self.metadata_variables(self.inclusion_variables, self.exclusion_variables)
-        self.table_region, self.table_tid_name, self.table_tid, self.table_size, self.table_total_size = self.find_table_dimensions
-        self.ssb_max_row_query = 800000
+        self.ssb_max_row_query = planned_max_rows(table_id)
+        self.klass_id = ["131", "104", "214", "231"]
+        self.region_rules = region_rules
+        self._dimensions = None
+        self._table_dimensions = None
+        self._klass = None
+        self._lock = threading.Lock()
+        self._prefetched = False
+        self.stats = new_stats()
+
+    @property
+    def dimensions(self):
+        """ The metadata of the table as a list of Dimension, fetched and filtered the first time its used. """
+        with self._lock:
+            if self._dimensions is None:
+                timer = time.time()
+                self._dimensions = self.metadata_variables(self.inclusion_variables, self.exclusion_variables)
+                add_seconds(self.stats, "metadata", time.time() - timer)
+        return self._dimensions
+
+    def prefetch(self):
+        """ Starts fetching the metadata, and then the KLASS classifications, in the background.
+
+        The KLASS date window depends on the periods in the metadata, and a table without a region dimension
+        doesnt need KLASS at all, so the classifications are only fetched when the metadata has arrived and
+        shows a region dimension, for the from date of its periods. The classifications are fetched at the same
+        time (see RegionKLASS.get_klass_variables), and tables with the same from date share them
+        (shared_region_klass), so in a batch run they are only fetched once.
+
+        The metadata and KLASS of one table are fetched one after the other, so prefetch saves time when it is
+        called before the table is needed: main prefetches the next table while the current one is fetched,
+        and post_query, estimate and compare_formats prefetch (if it hasnt been done) before they plan.
+
+        If a fetch in the background fails, nothing is kept, and it is fetched again (and raises) when used.
+
+        Returns:
+        --------
+        self : SSBTable
+        """
+        if self._prefetched:
+            return self
+        self._prefetched = True
+        # Navnet gjør at Profiler sampler tråden sammen med tabellen
+        threading.Thread(target=prefetch_quietly, args=(self.load_klass,), name=self.table_id + "/prefetch",
+                         daemon=True).start()
+        return self
+
+    def load_klass(self):
+        """ Fetches the metadata, and the KLASS classifications if the table has a region dimension. """
+        if self.table_region is not None:
+            self.klass.load()
+
+    @property
+    def variables(self):
+        """ The filtered metadata in the JSON form SSB returns it in. """
+        return {"variables": [dimension.to_variable() for dimension in self.dimensions]}
+
+    @property
+    def table_dimensions(self):
+        """ The result of find_table_dimensions, only calculated once. """
+        if self._table_dimensions is None:
+            self._table_dimensions = self.find_table_dimensions
+        return self._table_dimensions
+
+    @property
+    def table_region(self):
+        return self.table_dimensions[0]
+
+    @property
+    def table_tid_name(self):
+        return self.table_dimensions[1]
+
+    @property
+    def table_tid(self):
+        return self.table_dimensions[2]
+
+    @property
+    def table_size(self):
+        return self.table_dimensions[3]
+
+    @property
+    def table_total_size(self):
+        return self.table_dimensions[4]
+
+    @property
+    def tid(self):
+        """ The values of the Tid dimension, or an empty list if the table doesnt have one. """
+        for dimension in self.dimensions:
+            if dimension.code == "Tid":
+                return dimension.values
+        return []
+
+    @property
+    def klass(self):
+        """ The RegionKLASS for the periods in this table, created the first time its used.
+
+        Tables with the same classifications and from date share the same RegionKLASS, see shared_region_klass.
+        """
+        if self._klass is None:
+            self._klass = shared_region_klass(self.klass_id, self.tid)
+        return self._klass
 
     @property
     def metadata_url(self):
@@ -86,36 +331,40 @@ class SSBTable:
     def metadata_variables(self, inclusion_variables, exclusion_variables):
         """ JSON request for the metadata.
 
-        Does a JSON get request for the metadata for the table we will query.
-        If a filter is provided it will call the filter_json_metadata() function to filter it
+        Does a JSON get request for the metadata for the table we will query and turns every variable
+        into a Dimension. If a filter is provided it will call the filter_dimensions() function to filter it
         first then return it.
 
         Parameters:
         -----------
-        metadata_filter : None/string
+        inclusion_variables : None/dict
+            Empty by default, unless a filter is provided.
+        exclusion_variables : None/dict
             Empty by default, unless a filter is provided.
 
         Returns:
         --------
-        filtered_variables : list
-            returns the metadata requested.
+        dimensions : list
+            returns the metadata requested as a list of Dimension.
         """
-        filtered_variables = []
-        ssb_table_metadata = requests.get(self.metadata_url).json()
+        response = http_get(self.metadata_url)
+        count_response(self.stats, response)
+        ssb_table_metadata = response.json()
+        dimensions = [Dimension(var) for var in ssb_table_metadata["variables"]]
         if (inclusion_variables != None) or (exclusion_variables != None):
-            filtered_variables = self.filter_json_metadata(ssb_table_metadata, self.inclusion_variables,
-                                                           self.exclusion_variables)
-        else:
-            filtered_variables = ssb_table_metadata
-        return filtered_variables
+            dimensions = self.filter_dimensions(dimensions, inclusion_variables or {}, exclusion_variables or {})
+        return dimensions
 
-    def filter_json_metadata(self, json_metadata, filter_dict_inc, filter_dict_exc):
+    def filter_dimensions(self, dimensions, filter_dict_inc, filter_dict_exc):
         """Filters out metadata that isnt in the filter string.
 
+        The values are looked up in the code to position map of each Dimension,
+        so filtering is linear in the number of values in the filter.
+
         Parameters:
         -----------
-        json_metadata : list
-            A complete list of the tables metadata, except for what had been filtered out by filter_json_metadata.
+        dimensions : list
+            A complete list of the tables metadata as Dimension.
         filter_dict_inc : dict
             A dict of the filter string provided by filters_as_dict to include
         filter_dict_exc : dict
@@ -123,36 +372,46 @@ class SSBTable:
 
         Returns:
         --------
-        json_metadata : dict
-            Returns a filtered dict of the metadata.
+        dimensions : list
+            Returns a filtered list of the metadata.
         """
-        for idx, var in enumerate(json_metadata["variables"]):
-            if var["code"] in filter_dict_inc:
-                value_texts = []
-                for value in filter_dict_inc[var["code"]]:
+        filtered_dimensions = []
+        for dimension in dimensions:
+            if dimension.code not in filter_dict_inc and dimension.code not in filter_dict_exc:
+                filtered_dimensions.append(dimension)
+                continue
+            positions = dimension.positions.tolist()
+
+            if dimension.code in filter_dict_inc:
+                positions = []
+                for value in filter_dict_inc[dimension.code]:
                     if value == "None":
-                        filter_dict_inc[var["code"]].remove(value)
+                        continue
+                    if value in dimension.index:
+                        positions.append(dimension.index[value])
+                    else:
+                        print(value, "finnes ikke i metadata, har blitt fjernet fra spørringen.")
+
+            if dimension.code in filter_dict_exc:
+                excluded = set()
+                for value in filter_dict_exc[dimension.code]:
+                    if value in dimension.index:
+                        excluded.add(dimension.index[value])
                     else:
-                        try:
-                            index_of_value = json_metadata["variables"][idx]["values"].index(
-                                value)
-                            value_texts.append(
-                                json_metadata["variables"][idx]["valueTexts"][index_of_value])
-                        except ValueError:
-                            filter_dict_inc[var["code"]].remove(value)
-                            print(value, "finnes ikke i metadata, har blitt fjernet fra spørringen.")
-                json_metadata["variables"][idx]["values"] = filter_dict_inc[var["code"]]
-                json_metadata["variables"][idx]["valueTexts"] = value_texts
-
-        for idx, var in enumerate(json_metadata["variables"]):
-            if var["code"] in filter_dict_exc:
-                for value in filter_dict_exc[var["code"]]:
-                    json_metadata["variables"][idx]["values"].remove(value)
-
-        return json_metadata
+                        print(value, "finnes ikke i metadata, kan ikke ekskluderes.")
+                positions = [pos for pos in positions if pos not in excluded]
+
+            filtered_dimensions.append(dimension.select(positions))
+
+        return filtered_dimensions
 
     def filters_as_dict(self, filter_string):
-        """ Splits up the filter string and returns it as a dict.
+        """ Parses the filter string and returns it as two dicts, one to exclude and one to include.
+
+        The filter string is a list of terms separated by "&", where each term is either
+        code=value1,value2 to only include those values or code!=value1,value2 to exclude them.
+        Every term is parsed in one pass with the precompiled filter_term grammar. If a code is
+        repeated the values are merged, and values are only kept once.
 
         Parameters:
         -----------
@@ -161,41 +420,30 @@ class SSBTable:
 
         Returns:
         --------
-        filters : dict
-            Returns a dict of the filter string.
-        """
-        filter_args_exc_split = []
-        filter_args_inc_split = []
-        filter_split = re.split("&", filter_string)
-        for var in filter_split:
-            if re.search(r"\w+!=\w+", var):
-                filter_args_exc_split.append(var)
-            if re.search(r"\w+=\w+", var):
-                filter_args_inc_split.append(var)
-
-        filter_args_exc = []
-        for var in filter_args_exc_split:
-            split = re.split(r"!=", var)
-            filter_args_exc.extend(split)
-
-        filter_args_inc = []
-        for var in filter_args_inc_split:
-            split = re.split(r"=", var)
-            filter_args_inc.extend(split)
-
+        filters_exc : dict
+            Returns a dict of the codes and values to exclude.
+        filters_inc : dict
+            Returns a dict of the codes and values to include.
+
+        Raises:
+        -------
+        ValueError
+            If a term in the filter string isnt a valid filter.
+        """
         filters_inc = {}
         filters_exc = {}
-
-        if filter_args_exc:
-            for idx, meta_filter in enumerate(filter_args_exc):
-                if ((idx % 2) == 0):
-                    filters_exc[meta_filter] = filter_args_exc[filter_args_exc.index(
-                        meta_filter) + 1].split(",")
-        if filter_args_inc:
-            for idx, meta_filter in enumerate(filter_args_inc):
-                if ((idx % 2) == 0):
-                    filters_inc[meta_filter] = filter_args_inc[filter_args_inc.index(
-                        meta_filter) + 1].split(",")
+        for term in filter_string.split("&"):
+            if not term.strip():
+                continue
+            match = self.filter_term.match(term)
+            if match is None:
+                raise ValueError("Ugyldig filter: '{}' i '{}'".format(term, filter_string))
+            filters = filters_exc if match.group("operator") == "!=" else filters_inc
+            values = filters.setdefault(match.group("code"), [])
+            for value in match.group("values").split(","):
+                value = value.strip()
+                if value and value not in values:
+                    values.append(value)
 
         return filters_exc, filters_inc
 
@@ -215,29 +463,58 @@ class SSBTable:
         table_region = None
         table_tid = None
         table_tid_name = None
-        table_size = 1
-        table_total_size = 1
-        for v_idx, var in enumerate(self.variables["variables"]):
-            table_total_size *= len(var["values"])
-            if var["text"] == "region":
+        sizes = np.array([len(dimension) for dimension in self.dimensions], dtype=np.int64)
+        table_total_size = int(sizes.prod())
+        for v_idx, var in enumerate(self.dimensions):
+            if var.text == "region":
                 table_region = v_idx
-            elif var["text"] == "måned":
+            elif var.text == "måned":
                 table_tid_name = "måned"
                 table_tid = v_idx
-            elif var["text"] == "kvartal":
+            elif var.text == "kvartal":
                 table_tid_name = "kvartal"
                 table_tid = v_idx
-            elif var["text"] == "år":
+            elif var.text == "år":
                 table_tid_name = "år"
                 table_tid = v_idx
-            elif var["code"] == "Tid":
+            elif var.code == "Tid":
                 raise Exception(
-                    "Tid er noe annet enn år, kvartal eller måned. Verdien på navnet er x.".format(var["text"]))
-            else:
-                table_size *= len(var["values"])
+                    "Tid er noe annet enn år, kvartal eller måned. Verdien på navnet er x.".format(var.text))
+        table_size = int(np.delete(sizes, [i for i in (table_region, table_tid) if i is not None]).prod())
         return table_region, table_tid_name, table_tid, table_size, table_total_size
 
 
+# KLASS gir ingen slutt dato for koder som fortsatt er gyldige, de regnes som gyldige til denne datoen.
+# Det er også slutten av perioden vi spør KLASS om, langt nok fram til at alle koder som er gyldige nå er med
+klass_open_end = "2059-01-01"
+
+
+def klass_records(klass_ids, klass_data):
+    """ The validity interval of every code in the KLASS classifications, the records KlassIntervals is made from.
+
+    Parameters:
+    -----------
+    klass_ids : list
+        The classifications, in the same order as klass_data.
+    klass_data : list
+        The parsed JSON response from KLASS for each classification.
+
+    Returns:
+    --------
+    records : list
+        A dict per code and interval with code, validFrom and validTo (as YYYY-MM-DD) and classification.
+        Codes that are still valid are valid to klass_open_end.
+    """
+    records = []
+    for klass_id, data in zip(klass_ids, klass_data):
+        for item in data["codes"]:
+            records.append({"code": item["code"],
+                            "validFrom": item["validFromInRequestedRange"],
+                            "validTo": item.get("validToInRequestedRange") or klass_open_end,
+                            "classification": klass_id})
+    return records
+
+
 class RegionKLASS:
     """ A class used to get classification list from SSB to keep track of which regions are valid within the last five years
 
@@ -260,14 +537,20 @@ class RegionKLASS:
         Prunes the classification code region list to only include code, validfrom and validto dates.
     filter_regions():
         Filters equal codes, merges ones with name change and not region code change.
+    intervals:
+        Every code from every classification as a KlassIntervals, for point in time queries.
     """
 
-    def __init__(self, klass_id, tid_list):
+    def __init__(self, klass_id, tid_list=None, from_date=None):
         """
         Parameters:
         -----------
         klass_id : list
             List of classificationcode we are using to get our complete list of region codes.
+        tid_list : list/None
+            The periods of the table, the from date is calculated from them by klass_from_date.
+        from_date : int/None
+            The from date, used instead of tid_list when its given.
 
         Attributes:
         -----------
@@ -281,21 +564,59 @@ class RegionKLASS:
             List of all the classifications
         filtered_klass_variables : list
             Pruned and filtered list of classifications
+        intervals : KlassIntervals
+            Every code with its validity interval and classification, sorted by code and from date.
         filtered_regions : dict
             Filtered and merged regions.
+
+        Nothing is fetched when the object is created, the classifications are fetched and merged
+        the first time filtered_regions (or one of the lists it is built from) is used.
         """
-        tid = ""
-        max_tid = max(tid_list)[0:4]
-        min_tid = min(tid_list)[0:4]
-        if int(max_tid) - 5 < int(min_tid):
-            tid = int(min_tid)
-        else:
-            tid = int(max_tid) - 5
         self.klass_id = klass_id
-        self.from_date = tid
-        self.klass_variables = self.get_klass_variables()
-        self.filtered_klass_variables = self.filter_klass_variables()
-        self.filtered_regions = self.filter_regions()
+        self.from_date = from_date if from_date is not None else klass_from_date(tid_list)
+        self._klass_variables = None
+        self._filtered_klass_variables = None
+        self._intervals = None
+        self._filtered_regions = None
+        self._lock = threading.RLock()
+        self.stats = new_stats()
+
+    @property
+    def klass_variables(self):
+        if self._klass_variables is None:
+            self._klass_variables = self.get_klass_variables()
+        return self._klass_variables
+
+    @property
+    def filtered_klass_variables(self):
+        if self._filtered_klass_variables is None:
+            self._filtered_klass_variables = self.filter_klass_variables()
+        return self._filtered_klass_variables
+
+    @property
+    def intervals(self):
+        with self._lock:
+            if self._intervals is None:
+                self._intervals = KlassIntervals(self.filtered_klass_variables)
+        return self._intervals
+
+    @property
+    def filtered_regions(self):
+        return self.load()._filtered_regions
+
+    def load(self):
+        """ Fetches and merges the classifications now instead of the first time filtered_regions is used.
+
+        Returns:
+        --------
+        self : RegionKLASS
+        """
+        with self._lock:
+            if self._filtered_regions is None:
+                timer = time.time()
+                self._filtered_regions = self.filter_regions()
+                add_seconds(self.stats, "klass", time.time() - timer)
+        return self
 
     def region_klass_url(self, i):
         """ Concatenates klass_id with from date to max date from ssb to create the url
@@ -310,228 +631,2613 @@ class RegionKLASS:
             The concatenated url
         """
         url = "http://data.ssb.no/api/klass/v1/classifications/" + i + "/codes?from=" + \
-              str(self.from_date) + "-01-01&to=2059-01-01&includeFuture=true"
+              str(self.from_date) + "-01-01&to=" + klass_open_end + "&includeFuture=true"
         return url
 
     def get_klass_variables(self):
         """ Does a JSON get request for the classification ID provided and appends it to a list
 
         Set a headers dict first, this is so that we get a JSON back. Standard return from SSB is XML.
-        Then we loop over the klass_id list and do a get request for each klass_id provided and append them to
-        a list.
+        Then we do a get request for each klass_id provided, all at the same time, and append them to
+        a list in the order of klass_id. The body is parsed as JSON from the bytes, which is always UTF-8
+        (or UTF-16/32, json detects which), so names like Kautokeino/Guovdageaidnu with š are decoded correctly
+        whatever charset the response headers claim.
 
         Returns:
         --------
         all_klass_data : list
-            Returns a list of all the classification codes.
+            Returns a list with the JSON response of each classification.
         """
+        headers = {"Accept": "application/json", "Accept-Charset": "utf-8"}
+        with ThreadPoolExecutor(max_workers=max(1, len(self.klass_id)),
+                                thread_name_prefix=threading.current_thread().name + "/klass") as pool:
+            responses = list(pool.map(lambda i: http_get(self.region_klass_url(i), headers=headers),
+                                      self.klass_id))
         all_klass_data = []
-        headers = {"Accept": "application/json", "charset": "UTF-8"}
-        for i in self.klass_id:
-            response = requests.get(self.region_klass_url(i), headers=headers)
-            data = response.text
-
-            if ("?" in response.text):
-                data = response.text.replace("?", "š")
-            all_klass_data.append(data)
+        for response in responses:
+            count_response(self.stats, response)
+            all_klass_data.append(json.loads(response.content))
         return all_klass_data
 
     def filter_klass_variables(self):
-        """ Prunes the classification code region list to only include code, validfrom and validto dates.
-
-        Runs through the klass_variables list and loads them as a JSON object. It then runs through the
-        JSON object and prunes away everything we dont need so that we only have region code, validfrom and validto.
-        This might be an unnecessary step, but it doesnt take much time and is done only once per table.
+        """ Prunes the classification code region list to only include code, validfrom, validto and classification.
 
         Returns:
         --------
         regioner : list
-            A list of all the region codes and their valid from/to date.
-        """
-        regioner = []
-        for klass_id in self.klass_variables:
-            json_array = json.loads(klass_id)["codes"]
-
-            for item in json_array:
-                regioner_details = {"code": None,
-                                    "validFrom": None, "validTo": None}
-                regioner_details["code"] = item["code"]
-                datetime_object = datetime.strptime(
-                    item["validFromInRequestedRange"], "%Y-%m-%d")
-                regioner_details["validFrom"] = str(datetime_object.year)
-                datetime_object = datetime.strptime(
-                    item["validToInRequestedRange"], "%Y-%m-%d")
-                regioner_details["validTo"] = str(datetime_object.year)
-                regioner.append(regioner_details)
-        return regioner
+            A list of all the region codes with their valid from/to date (as YYYY-MM-DD) and the classification,
+            see klass_records.
+        """
+        return klass_records(self.klass_id, self.klass_variables)
 
     def filter_regions(self):
         """ Filters equal codes, merges ones with name change and not region code change.
 
-        In this method we go through the filtered_klass_variables and merge regions that has only changed name,
-        we also filter out regions that are equal.
+        Every code gets the first year it is valid from and the last year it is valid to, in any classification,
+        see KlassIntervals.regions.
 
         Returns:
         --------
         filtered_regions_klass : dict
             A complete list of all region codes we use.
         """
-        filtered_regions_klass = {}
-        for regions in self.filtered_klass_variables:
-            try:
-                a = filtered_regions_klass[regions["code"]]
-                if regions["validFrom"] < filtered_regions_klass[regions["code"]]["validFrom"]:
-                    filtered_regions_klass[regions["code"]
-                    ]["validFrom"] = regions["validFrom"]
-                elif regions["validTo"] > filtered_regions_klass[regions["code"]]["validTo"]:
-                    filtered_regions_klass[regions["code"]
-                    ]["validTo"] = regions["validTo"]
-            except KeyError:
-                filtered_regions_klass[regions["code"]] = regions
-        return filtered_regions_klass
-
-
-def build_query(variables, _filter="item"):
-    """ A function to build a standard query for the SSB API.
+        return self.intervals.regions()
 
-    We set up a standard query as a dict and an empty query list.
-    Then it loops over the variables parameter, which is a list of the metadata
-    that has been filtered for the regions that are invalid within the last five years.
-    It ignores the other values, except for the code, filter and values from the metadata
-    as SSB doesnt use those when querying.
-    At the end it appends it query list in the main query dict and returns it.
 
-    Parameters:
+class KlassIntervals:
+    """ A class used to keep the validity intervals of every code in the KLASS classifications, sorted.
+
+    The intervals are stored as NumPy arrays (code, from, to, classification), sorted by code and from date,
+    so the codes valid on a date is one vectorized comparison, and the intervals of a code is a binary search.
+    Like KLASS, from is inclusive and to is exclusive.
+
+    Attributes:
     -----------
-    variables : list
-        Filtered list that has been pruned for regions that are not valid
-    _filter : str
-        A string parameter for the query filter variable
+    code : numpy.ndarray
+        The code of each interval.
+    valid_from : numpy.ndarray
+        The first date the code is valid, as datetime64[D].
+    valid_to : numpy.ndarray
+        The first date the code is no longer valid, as datetime64[D].
+    classification : numpy.ndarray
+        The classification the interval is from.
 
-    Returns:
+    Methods:
     --------
-    query : dict
-        Returns a query for a single year or one that equals 800k rows.
+    valid_on(date):
+        The codes that are valid on a date, e.g. "2019-01-01".
+    lookup(code):
+        The intervals of a code.
+    regions():
+        The codes with the first and last year they are valid, the form meta_filter uses.
+    """
+
+    def __init__(self, records):
+        """
+        Parameters:
+        -----------
+        records : list
+            Dicts with code, validFrom, validTo and classification, from RegionKLASS.filter_klass_variables.
+        """
+        code = np.array([record["code"] for record in records], dtype=str)
+        valid_from = np.array([record["validFrom"] for record in records], dtype="datetime64[D]")
+        valid_to = np.array([record["validTo"] for record in records], dtype="datetime64[D]")
+        classification = np.array([record["classification"] for record in records], dtype=str)
+        order = np.lexsort((valid_from, code))
+        self.code = code[order]
+        self.valid_from = valid_from[order]
+        self.valid_to = valid_to[order]
+        self.classification = classification[order]
+
+    def __len__(self):
+        return len(self.code)
+
+    def valid_on(self, date):
+        """ The sorted codes that are valid on date, in any of the classifications. """
+        date = np.datetime64(date, "D")
+        return np.unique(self.code[(self.valid_from <= date) & (date < self.valid_to)]).tolist()
+
+    def lookup(self, code):
+        """ The intervals of code as a list of (from, to, classification), sorted by from. """
+        start = np.searchsorted(self.code, code, side="left")
+        end = np.searchsorted(self.code, code, side="right")
+        return [(str(self.valid_from[i]), str(self.valid_to[i]), str(self.classification[i]))
+                for i in range(start, end)]
+
+    def regions(self):
+        """ Every code with the first year its valid from and the last year its valid to, as year strings.
+
+        Returns:
+        --------
+        regions : dict
+            {code: {"code": code, "validFrom": year, "validTo": year}}
+        """
+        if len(self.code) == 0:
+            return {}
+        starts = np.flatnonzero(np.r_[True, self.code[1:] != self.code[:-1]])
+        first = np.minimum.reduceat(self.valid_from.astype("datetime64[Y]").astype(np.int64), starts) + 1970
+        last = np.maximum.reduceat(self.valid_to.astype("datetime64[Y]").astype(np.int64), starts) + 1970
+        return {code: {"code": code, "validFrom": str(valid_from), "validTo": str(valid_to)}
+                for code, valid_from, valid_to in zip(self.code[starts].tolist(), first.tolist(), last.tolist())}
+
+
+class ResultAssembler:
+    """ A class used to build the result DataFrame directly from the JSON-Stat responses.
+
+    The number of rows is known after meta_filter, its the sum of the products of the dimension sizes in
+    each chunk. The columns are allocated once, as categorical codes per dimension and a float value array,
+    and each response is written straight into its slice. There is no DataFrame per chunk and no concat
+    at the end, so the result is only held in memory once.
 
+    Attributes:
+    -----------
+    dimensions : list
+        The dimensions of the table, the categories of each column are the value codes of the dimension.
+    rows : int
+        Number of rows allocated.
+    position : int
+        Number of rows filled so far.
+    categorical : bool
+        If False the dimension columns are converted to str like pyjstat returns them.
+
+    Methods:
+    --------
+    add(json_stat):
+        Writes a json-stat2 response into the next slice.
+    dataframe():
+        Returns the filled rows as a DataFrame.
     """
-    query = {
-        "query": [],
-        "response": {
-            "format": "json-stat2"
-        }
-    }
 
-    for var in variables:
-        query_details = {
-            "code": None,
-            "selection": {
-                "filter": _filter,
-                "values": []
-            }
-        }
-        query_details["code"] = var["code"]
-        if (_filter != "item"):
-            query_details["selection"]["filter"] = _filter
-        query_details["selection"]["values"].extend(var["values"])
-        query["query"].append(query_details)
-    return query
+    def __init__(self, dimensions, meta_data, categorical=True):
+        self.dimensions = dimensions
+        self.dimension_position = {dimension.code: idx for idx, dimension in enumerate(dimensions)}
+        self.categorical = categorical
+        self.rows = 0
+        for variables in meta_data:
+            self.rows += int(np.prod([len(var) for var in variables], dtype=np.int64))
+        self.codes = [np.zeros(self.rows, dtype=self.code_dtype(len(dimension.codes))) for dimension in dimensions]
+        self.value = np.full(self.rows, np.nan)
+        self.position = 0
+
+    @staticmethod
+    def code_dtype(categories):
+        """ The smallest integer type pandas uses for the codes of a categorical with this many categories. """
+        if categories < np.iinfo(np.int8).max:
+            return np.int8
+        if categories < np.iinfo(np.int16).max:
+            return np.int16
+        return np.int32
+
+    def grow(self, rows):
+        """ Makes room for more rows if a response is bigger than planned. """
+        print("Svaret fra SSB har flere rader enn planlagt, utvider resultatet med", rows, "rader.")
+        self.codes = [np.concatenate([codes, np.zeros(rows, dtype=codes.dtype)]) for codes in self.codes]
+        self.value = np.concatenate([self.value, np.full(rows, np.nan)])
+        self.rows += rows
+
+    def add(self, json_stat):
+        """ Writes a json-stat2 response into the next rows of the result.
+
+        The values are in row-major order over the dimensions in json_stat["id"], so the codes of each
+        dimension are written by broadcasting its category positions over a view of the slice.
 
+        Parameters:
+        -----------
+        json_stat : dict
+            A json-stat2 response from SSB.
 
-def calc_iterations():
-    iterations = 0
-    if ssb_table.table_tid_name == "år":
-        iterations = -6
-    elif ssb_table.table_tid_name == "måned":
-        iterations = -61
-    elif ssb_table.table_tid_name == "kvartal":
-        iterations = -21
+        Returns:
+        --------
+        rows : int
+            Number of rows written.
+        """
+        sizes = [int(size) for size in json_stat["size"]]
+        rows = int(np.prod(sizes, dtype=np.int64))
+        if self.position + rows > self.rows:
+            self.grow(self.position + rows - self.rows)
+        start = self.position
+        end = start + rows
+
+        for d_idx, code in enumerate(json_stat["id"]):
+            dimension = self.dimensions[self.dimension_position[code]]
+            index = json_stat["dimension"][code]["category"]["index"]
+            if isinstance(index, dict):
+                category_codes = sorted(index, key=index.get)
+            else:
+                category_codes = list(index)
+            positions = np.array([dimension.index[category] for category in category_codes],
+                                 dtype=self.codes[self.dimension_position[code]].dtype)
+            shape = [1] * len(sizes)
+            shape[d_idx] = sizes[d_idx]
+            target = self.codes[self.dimension_position[code]][start:end].reshape(sizes)
+            target[...] = positions.reshape(shape)
+
+        value = json_stat["value"]
+        if isinstance(value, dict):
+            for idx, val in value.items():
+                self.value[start + int(idx)] = np.nan if val is None else val
+        else:
+            self.value[start:end] = np.array(value, dtype=float)
+        self.position = end
+        return rows
 
-    return iterations
+    def add_frame(self, dataframe):
+        """ Writes a response parsed by one of response_parsers into the next rows of the result.
 
+        Parameters:
+        -----------
+        dataframe : DataFrame
+            A str column per dimension and a float value column.
 
-def meta_filter(iterations):
-    """ A function that filters away the regions that are invalid for the past five years.
+        Returns:
+        --------
+        rows : int
+            Number of rows written.
+        """
+        rows = len(dataframe)
+        if self.position + rows > self.rows:
+            self.grow(self.position + rows - self.rows)
+        start = self.position
+        end = start + rows
+        for column in dataframe.columns:
+            if column == "value":
+                continue
+            dimension = self.dimensions[self.dimension_position[column]]
+            self.codes[self.dimension_position[column]][start:end] = \
+                pd.Index(dimension.codes).get_indexer(dataframe[column])
+        self.value[start:end] = dataframe["value"].to_numpy(dtype=float)
+        self.position = end
+        return rows
+
+    def dataframe(self):
+        """ Returns the rows filled so far as a DataFrame, with a column per dimension and a value column. """
+        columns = {}
+        for dimension, codes in zip(self.dimensions, self.codes):
+            column = pd.Categorical.from_codes(codes[:self.position],
+                                               dtype=pd.CategoricalDtype(dimension.codes.tolist()))
+            columns[dimension.code] = column if self.categorical else column.astype(str)
+        columns["value"] = self.value[:self.position]
+        return pd.DataFrame(columns, copy=False)
+
+
+class SQLTableSink:
+    """ A class used to load the result into a database table chunk by chunk, instead of returning one DataFrame.
+
+    Each decoded chunk is inserted in batches with executemany as soon as it has been decoded, so loading
+    overlaps with fetching and nothing has to be marshalled back through external_script at the end.
+    With pyodbc fast_executemany is turned on, which makes SQL Server do a bulk insert of each batch.
+    Any DB-API connection with qmark parameters works, so the same code can be run against sqlite3 locally.
 
-    We run a double for loop, where the first one iterates on year and the second one goes through regions.
-    Its done this way becaue of the way JSON-Stat files are built up, if we dont do a filter and query for each year
-    separately we will end up getting values for regions that are invalid for that year (In SSBs case they
-    are returned as the number 0). For each region we check it against our classification list to check if the
-    region code we are on is valid for the current year we are iterating over. If not, it excludes it from the filter.
-    We also constantly check if the next region added is going to make us surpass 800k rows on a query, is so, it appends
-    the current list to metadata_filter and starts building up a new list from where it left off. If it never reaches 800k
-    per year, it will append the list to metadata_filter when the region loop is done.
+    Attributes:
+    -----------
+    connection : object
+        A DB-API connection, e.g. pyodbc.connect(...) or sqlite3.connect(...).
+    table_name : str
+        The table the result is loaded into. Its replaced on every run, like the DataFrame result.
+    staging : bool
+        If True the chunks are loaded into table_name + "_staging", which is swapped with table_name
+        when every chunk has been loaded. Readers then never see a half loaded table.
+    batch_size : int
+        Number of rows per executemany call.
+    dialect : str
+        "mssql" or "sqlite", decides the column types and how the staging table is swapped.
+    rows : int
+        Number of rows loaded so far.
+    drop_missing : bool
+        If True the rows without a value arent loaded, set by post_query, see sparse_result. The table is
+        replaced on every run, so no rows from an earlier run are left behind.
 
-    Returns:
+    Methods:
     --------
-    metadata_filter : list
-        A list of the metadata_variables that has been filtered for non valid regions for the past five years.
+    write(dataframe):
+        Inserts a decoded chunk, creates the table on the first chunk.
+    close():
+        Commits and swaps the staging table, returns a report with the number of rows loaded.
+    abort():
+        Rolls back and drops the staging table. The table is dropped and created in the same transaction
+        as the inserts, so without staging the old table_name is restored too.
     """
-    metadata_filter = []
-    if ssb_table.table_region != None:
-        for year in ssb_table.variables["variables"][ssb_table.table_tid]["values"][-1:iterations:-1]:
-            new_meta_var = copy.deepcopy(ssb_table.variables["variables"])
-            new_meta_regions = []
-            for region in ssb_table.variables["variables"][ssb_table.table_region]["values"]:
-                if region in {"0", "EAK", "EAKUO"}:
-                    new_meta_regions.append(region)
-                elif region in klass.filtered_regions.keys():
-                    valid_from = int(klass.filtered_regions[region]["validFrom"])
-                    valid_to = int(klass.filtered_regions[region]["validTo"])
-                    if int(year[0:4]) in range(valid_from, valid_to):
-                        if (ssb_table.table_size * (len(new_meta_regions) + 1)) < ssb_table.ssb_max_row_query:
-                            new_meta_regions.append(region)
-                        else:
-                            new_meta_var[ssb_table.table_region]["values"] = new_meta_regions
-                            new_meta_var[ssb_table.table_tid]["values"] = [year]
-                            metadata_filter.append(new_meta_var)
-                            new_meta_regions = []
-                            new_meta_regions.append(region)
-                            new_meta_var = copy.deepcopy(ssb_table.variables["variables"])
-            new_meta_var[ssb_table.table_region]["values"] = new_meta_regions
-            new_meta_var[ssb_table.table_tid]["values"] = [year]
-            metadata_filter.append(new_meta_var)
-    else:
-        if ssb_table.table_total_size < ssb_table.ssb_max_row_query:
-            metadata_filter.append(ssb_table.variables["variables"])
-    return metadata_filter
 
+    drop_missing = False
 
-def post_query():
-    """ A function to do a post query on the SSB API.
+    def __init__(self, connection, table_name, staging=False, batch_size=10000, dialect=None):
+        self.connection = connection
+        self.table_name = table_name
+        self.staging = staging
+        self.batch_size = batch_size
+        if dialect is None:
+            dialect = "sqlite" if type(connection).__module__.startswith("sqlite3") else "mssql"
+        self.dialect = dialect
+        self.rows = 0
+        self.columns = None
+        self.cursor = None
 
-    This function does a post query on the SSB API, following the SSB API Documentation, by
-    doing a post request with the query we have built up, we get a JSON stat file back with the result.
-    First we run meta_filter() once to get the filtered metadata variables, then for each dict in the list
-    we run the build_query() function and post that query to the SSB API. Which after running that query
-    returns a JSON-Stat file back with the results. We then run that JSON-Stat through pyjstat which converts
-    and structures that file to a pandas DataFrame which gets appended to dataframes list. Once the for loop
-    has finished we run a pandas concat on the dataframes list to convert to one single DF.
+    @property
+    def load_table(self):
+        """ The table the chunks are inserted into. """
+        if self.staging:
+            return self.table_name + "_staging"
+        return self.table_name
+
+    def quote(self, name):
+        if self.dialect == "mssql":
+            return "[" + name.replace("]", "]]") + "]"
+        return '"' + name.replace('"', '""') + '"'
+
+    def drop_table(self, table_name):
+        if self.dialect == "mssql":
+            self.cursor.execute("IF OBJECT_ID(?, 'U') IS NOT NULL DROP TABLE " + self.quote(table_name), table_name)
+        else:
+            self.cursor.execute("DROP TABLE IF EXISTS " + self.quote(table_name))
 
-    Returns:
+    def begin(self):
+        """ Starts a transaction on sqlite, which otherwise runs DDL outside of one, so abort couldnt roll it back.
+
+        The transaction takes the write lock at once (IMMEDIATE), so a sink loading another table into the same
+        file waits for it with the busy timeout of the connection. A deferred transaction that first reads and
+        then writes fails at once with "database is locked" when another connection is writing.
+        """
+        if self.dialect == "sqlite" and not self.connection.in_transaction:
+            self.cursor.execute("BEGIN IMMEDIATE")
+
+    def create_table(self, dataframe):
+        """ Creates load_table with a column per column in the first chunk, value as float and the rest as text. """
+        self.cursor = self.connection.cursor()
+        self.begin()
+        if self.dialect == "mssql" and hasattr(self.cursor, "fast_executemany"):
+            self.cursor.fast_executemany = True
+        self.columns = list(dataframe.columns)
+        column_types = []
+        for column in self.columns:
+            if pd.api.types.is_numeric_dtype(dataframe[column]):
+                column_type = "FLOAT" if self.dialect == "mssql" else "REAL"
+            else:
+                column_type = "NVARCHAR(255)" if self.dialect == "mssql" else "TEXT"
+            column_types.append(self.quote(column) + " " + column_type)
+        self.drop_table(self.load_table)
+        self.cursor.execute("CREATE TABLE " + self.quote(self.load_table) + " (" + ", ".join(column_types) + ")")
+
+    def loaded_rows(self, dataframe):
+        """ The rows of a chunk that are loaded into load_table, without the rows without a value if drop_missing. """
+        if self.drop_missing:
+            return dataframe[dataframe["value"].notna()]
+        return dataframe
+
+    def write(self, dataframe, updated=None):
+        """ Inserts a decoded chunk into load_table in batches of batch_size rows.
+
+        Parameters:
+        -----------
+        dataframe : DataFrame
+            A chunk decoded by pyjstat, every chunk has to have the same columns.
+        updated : str/None
+            When SSB last updated the table, not used by this sink.
+        """
+        if self.columns is None:
+            self.create_table(dataframe)
+        insert = "INSERT INTO " + self.quote(self.load_table) + " (" + \
+                 ", ".join(self.quote(column) for column in self.columns) + ") VALUES (" + \
+                 ", ".join("?" for column in self.columns) + ")"
+        dataframe = self.loaded_rows(dataframe)[self.columns].astype(object)
+        dataframe = dataframe.where(dataframe.notna(), None)
+        rows = list(dataframe.itertuples(index=False, name=None))
+        for start in range(0, len(rows), self.batch_size):
+            self.cursor.executemany(insert, rows[start:start + self.batch_size])
+        self.rows += len(rows)
+
+    def close(self):
+        """ Commits the load and swaps the staging table in place of table_name.
+
+        Returns:
+        --------
+        report : dict
+            The table name and number of rows loaded.
+        """
+        if self.cursor is None:
+            return {"table": self.table_name, "rows": self.rows}
+        if self.staging:
+            self.drop_table(self.table_name)
+            if self.dialect == "mssql":
+                self.cursor.execute("EXEC sp_rename ?, ?", self.load_table, self.table_name)
+            else:
+                self.cursor.execute("ALTER TABLE " + self.quote(self.load_table) + " RENAME TO " +
+                                    self.quote(self.table_name))
+        self.connection.commit()
+        self.cursor.close()
+        self.cursor = None
+        return {"table": self.table_name, "rows": self.rows}
+
+    def abort(self):
+        """ Rolls back what hasnt been committed and drops the staging table, the old table_name is left as it was. """
+        if self.cursor is None:
+            return
+        self.connection.rollback()
+        if self.staging:
+            self.drop_table(self.load_table)
+            self.connection.commit()
+        self.cursor.close()
+        self.cursor = None
+
+
+class SQLiteMergeSink(SQLTableSink):
+    """ A sink that merges each run into a local SQLite table instead of replacing it.
+
+    The rows are keyed on the dimension id columns (every column except value). Each chunk is inserted
+    into a temporary table, and when the run is closed only rows that are new or have a changed value
+    are written to table_name. A republished table where only one year changed therefore only
+    touches the rows for that year.
+
+    With drop_missing the rows without a value are still loaded into the temporary table, so the merge knows
+    which cells no longer have a value. They arent inserted, and the rows table_name has for them are deleted.
+
+    Attributes:
+    -----------
+    key_columns : list/None
+        The columns that identify a row, None uses every column except value.
+    partition_column : str
+        The column the diff is grouped by, Tid by default.
+    diff : DataFrame/None
+        The diff of the last run, with inserted, changed, unchanged and deleted rows per partition_column value.
+
+    Methods:
     --------
-    big_df : Series
-        This is the DataFrame that will be returned to the SQL server we are using.
+    close():
+        Merges the run into table_name and returns a report with the number of inserted, changed, unchanged
+        and deleted rows.
     """
 
-    dataframes = []
-    meta_data = meta_filter(calc_iterations())
-
-    for variables in meta_data:
-        query = build_query(variables)
-        data = requests.post(ssb_table.metadata_url, json=query)
-        if data.status_code != 200:
-            print("Feil! Status kode:", data.status_code)
-        time.sleep(3.0)
-        results = pyjstat.from_json_stat(data.json(object_pairs_hook=OrderedDict), naming="id")
-        dataframes.append(results[0])
-    big_df = pd.concat(dataframes, ignore_index=True)
-    return big_df
+    def __init__(self, connection, table_name, key_columns=None, partition_column="Tid", batch_size=10000):
+        SQLTableSink.__init__(self, connection, table_name, staging=False, batch_size=batch_size, dialect="sqlite")
+        self.key_columns = key_columns
+        self.partition_column = partition_column
+        self.diff = None
+
+    @property
+    def load_table(self):
+        return self.table_name + "_incoming"
+
+    def loaded_rows(self, dataframe):
+        """ Every row, the rows without a value are needed to delete them from table_name in close. """
+        return dataframe
+
+    def create_table(self, dataframe):
+        """ Creates table_name with a primary key on key_columns if it doesnt exist, and the temporary table for the run. """
+        self.cursor = self.connection.cursor()
+        self.begin()
+        self.columns = list(dataframe.columns)
+        if self.key_columns is None:
+            self.key_columns = [column for column in self.columns if column != "value"]
+        column_types = []
+        for column in self.columns:
+            column_type = "REAL" if pd.api.types.is_numeric_dtype(dataframe[column]) else "TEXT"
+            column_types.append(self.quote(column) + " " + column_type)
+        keys = ", ".join(self.quote(column) for column in self.key_columns)
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS " + self.quote(self.table_name) + " (" +
+                            ", ".join(column_types) + ", PRIMARY KEY (" + keys + "))")
+        self.cursor.execute("DROP TABLE IF EXISTS temp." + self.quote(self.load_table))
+        self.cursor.execute("CREATE TEMP TABLE " + self.quote(self.load_table) + " (" +
+                            ", ".join(column_types) + ", PRIMARY KEY (" + keys + ") ON CONFLICT REPLACE)")
+
+    def close(self):
+        """ Merges the rows of the run into table_name and calculates the diff.
+
+        Returns:
+        --------
+        report : dict
+            The table name, number of rows in the run and how many of them were inserted, changed, unchanged
+            or deleted.
+        """
+        if self.cursor is None:
+            return {"table": self.table_name, "rows": 0, "inserted": 0, "changed": 0, "unchanged": 0, "deleted": 0}
+        incoming = self.quote(self.load_table)
+        target = self.quote(self.table_name)
+        join = " AND ".join("t." + self.quote(column) + " = i." + self.quote(column) for column in self.key_columns)
+        value_columns = [column for column in self.columns if column not in self.key_columns]
+        changed = " OR ".join("t." + self.quote(column) + " IS NOT i." + self.quote(column)
+                              for column in value_columns) or "0"
+        if self.drop_missing and value_columns:
+            missing = " AND ".join("i." + self.quote(column) + " IS NULL" for column in value_columns)
+        else:
+            missing = "0"
+        if self.partition_column in self.columns:
+            partition = "i." + self.quote(self.partition_column)
+        else:
+            partition = "NULL"
+        first_key = "t." + self.quote(self.key_columns[0])
+
+        self.cursor.execute(
+            "SELECT " + partition + ", "
+            "SUM(CASE WHEN " + first_key + " IS NULL AND NOT (" + missing + ") THEN 1 ELSE 0 END), "
+            "SUM(CASE WHEN " + first_key + " IS NOT NULL AND NOT (" + missing + ") AND (" + changed + ") "
+            "THEN 1 ELSE 0 END), "
+            "SUM(CASE WHEN " + first_key + " IS NOT NULL AND NOT (" + missing + ") AND NOT (" + changed + ") "
+            "THEN 1 ELSE 0 END), "
+            "SUM(CASE WHEN " + first_key + " IS NOT NULL AND (" + missing + ") THEN 1 ELSE 0 END) "
+            "FROM " + incoming + " i LEFT JOIN " + target + " t ON " + join + " GROUP BY 1 ORDER BY 1")
+        self.diff = pd.DataFrame(self.cursor.fetchall(),
+                                 columns=[self.partition_column, "inserted", "changed", "unchanged", "deleted"])
+
+        columns = ", ".join(self.quote(column) for column in self.columns)
+        update = ", ".join(self.quote(column) + " = excluded." + self.quote(column) for column in value_columns)
+        where = " OR ".join(target + "." + self.quote(column) + " IS NOT excluded." + self.quote(column)
+                            for column in value_columns)
+        if update:
+            on_conflict = " ON CONFLICT (" + ", ".join(self.quote(column) for column in self.key_columns) + \
+                          ") DO UPDATE SET " + update + " WHERE " + where
+        else:
+            on_conflict = " ON CONFLICT DO NOTHING"
+        self.cursor.execute("INSERT INTO " + target + " (" + columns + ") SELECT " + columns + " FROM " +
+                            incoming + " i WHERE NOT (" + missing + ")" + on_conflict)
+        if missing != "0":
+            matches = " AND ".join(target + "." + self.quote(column) + " = i." + self.quote(column)
+                                   for column in self.key_columns)
+            self.cursor.execute("DELETE FROM " + target + " WHERE EXISTS (SELECT 1 FROM " + incoming + " i WHERE " +
+                                matches + " AND " + missing + ")")
+        self.cursor.execute("DROP TABLE temp." + incoming)
+        self.connection.commit()
+        self.cursor.close()
+        self.cursor = None
+
+        touched = self.diff[(self.diff["inserted"] > 0) | (self.diff["changed"] > 0) | (self.diff["deleted"] > 0)]
+        print("Endret", self.table_name + ":", touched.to_dict("records"))
+        return {"table": self.table_name,
+                "rows": self.rows,
+                "inserted": int(self.diff["inserted"].sum()),
+                "changed": int(self.diff["changed"].sum()),
+                "unchanged": int(self.diff["unchanged"].sum()),
+                "deleted": int(self.diff["deleted"].sum())}
+
+    def abort(self):
+        """ Rolls back and drops the temporary table, table_name is left as it was. """
+        if self.cursor is None:
+            return
+        self.connection.rollback()
+        self.cursor.execute("DROP TABLE IF EXISTS temp." + self.quote(self.load_table))
+        self.cursor.close()
+        self.cursor = None
+
+
+class PartitionedDatasetSink:
+    """ A sink that writes each chunk as files in a partitioned dataset on disk.
+
+    The files are laid out as <path>/table=<table_id>/tid=<period>/part-<N>.csv.gz (or .parquet), with a
+    manifest.json per table that records the rows, regions, published date and checksum of every part.
+    Only the periods written in a run are replaced, the other periods are kept, so a run can reload
+    a few periods without touching the rest. read_dataset uses the manifest to only read the parts it needs.
+
+    Attributes:
+    -----------
+    path : str
+        The root directory of the dataset.
+    table_id : str
+        The table that is written.
+    file_format : str
+        "csv" (gzip compressed) or "parquet", which needs pyarrow.
+    region_column : str/None
+        The region column, None uses the first column with region in its name.
+    tid_column : str
+        The period column the parts are partitioned by.
+    parts : list
+        The manifest entries written in this run.
+    tids : set
+        Every period in the chunks written in this run, also the ones without a part.
+    drop_missing : bool
+        If True the rows without a value arent written, set by post_query, see sparse_result. A period where
+        every row is dropped is still replaced, so it ends up without parts instead of keeping the old ones.
+
+    Methods:
+    --------
+    write(dataframe, updated=None):
+        Writes a chunk to a new part in each period it has rows for.
+    close():
+        Moves the new periods into place and writes the manifest.
+    abort():
+        Removes what has been written in this run.
+    """
+
+    drop_missing = False
+
+    def __init__(self, path, table_id, file_format="csv", region_column=None, tid_column="Tid"):
+        self.path = path
+        self.table_id = table_id
+        self.file_format = file_format
+        self.region_column = region_column
+        self.tid_column = tid_column
+        self.columns = None
+        self.published = None
+        self.parts = []
+        self.part_numbers = {}
+        self.tids = set()
+
+    @property
+    def table_path(self):
+        return os.path.join(self.path, "table=" + self.table_id)
 
+    @property
+    def staging_path(self):
+        return os.path.join(self.table_path, "_staging")
+
+    def write(self, dataframe, updated=None):
+        """ Writes a decoded chunk, one part per period in the chunk.
+
+        Parameters:
+        -----------
+        dataframe : DataFrame
+            A chunk decoded by pyjstat.
+        updated : str/None
+            When SSB last updated the table, recorded as published in the manifest.
+        """
+        if self.columns is None:
+            self.columns = list(dataframe.columns)
+            if self.region_column is None:
+                self.region_column = next((column for column in self.columns if "region" in column.lower()), None)
+            shutil.rmtree(self.staging_path, ignore_errors=True)
+        if updated is not None:
+            self.published = updated
+        self.tids.update(dataframe[self.tid_column].astype(str).unique().tolist())
+        if self.drop_missing:
+            dataframe = dataframe[dataframe["value"].notna()]
+
+        for tid, part in dataframe.groupby(self.tid_column, sort=False, observed=True):
+            number = self.part_numbers.get(tid, 0)
+            self.part_numbers[tid] = number + 1
+            extension = ".parquet" if self.file_format == "parquet" else ".csv.gz"
+            relative = os.path.join("tid=" + str(tid), "part-" + str(number) + extension)
+            file_path = os.path.join(self.staging_path, relative)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            if self.file_format == "parquet":
+                part.to_parquet(file_path, index=False)
+            else:
+                part.to_csv(file_path, index=False, compression="gzip")
+            with open(file_path, "rb") as f:
+                checksum = hashlib.sha256(f.read()).hexdigest()
+            regions = []
+            if self.region_column is not None:
+                regions = sorted(part[self.region_column].astype(str).unique().tolist())
+            self.parts.append({"path": relative.replace(os.sep, "/"), "tid": str(tid), "rows": len(part),
+                               "regions": regions, "sha256": checksum})
+
+    def close(self):
+        """ Replaces the periods written in this run and writes the manifest.
+
+        Returns:
+        --------
+        report : dict
+            The path of the table, number of rows and number of parts written.
+        """
+        rows = sum(part["rows"] for part in self.parts)
+        if self.columns is None:
+            return {"table": self.table_path, "rows": 0, "parts": 0}
+        manifest = read_manifest(self.path, self.table_id) or {"table_id": self.table_id, "parts": []}
+        written = set(part["tid"] for part in self.parts) | self.tids
+        for tid in written:
+            shutil.rmtree(os.path.join(self.table_path, "tid=" + tid), ignore_errors=True)
+            if os.path.exists(os.path.join(self.staging_path, "tid=" + tid)):
+                os.replace(os.path.join(self.staging_path, "tid=" + tid),
+                           os.path.join(self.table_path, "tid=" + tid))
+        shutil.rmtree(self.staging_path, ignore_errors=True)
+
+        manifest["parts"] = [part for part in manifest["parts"] if part["tid"] not in written] + self.parts
+        manifest["parts"].sort(key=lambda part: (part["tid"], part["path"]))
+        manifest["columns"] = self.columns
+        manifest["file_format"] = self.file_format
+        manifest["region_column"] = self.region_column
+        manifest["tid_column"] = self.tid_column
+        manifest["published"] = self.published or manifest.get("published")
+        manifest["rows"] = sum(part["rows"] for part in manifest["parts"])
+        manifest_path = os.path.join(self.table_path, "manifest.json")
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        return {"table": self.table_path, "rows": rows, "parts": len(self.parts)}
+
+    def abort(self):
+        """ Removes the parts written in this run, the dataset is left as it was. """
+        shutil.rmtree(self.staging_path, ignore_errors=True)
+
+
+def read_manifest(path, table_id):
+    """ Reads the manifest of a table in a partitioned dataset, None if the table hasnt been written.
+
+    Parameters:
+    -----------
+    path : str
+        The root directory of the dataset.
+    table_id : str
+        The table to read the manifest for.
 
-ssb_table = SSBTable(TabellNummer, Filter)
-tid = []
-for var in ssb_table.variables["variables"]:
-    if var["code"] == "Tid":
-        tid = var["values"]
-klass = RegionKLASS(["131", "104", "214", "231"], tid)
-r = post_query()
\ No newline at end of file
+    Returns:
+    --------
+    manifest : dict/None
+        The manifest, see PartitionedDatasetSink.
+    """
+    manifest_path = os.path.join(path, "table=" + table_id, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_dataset(path, table_id, tid=None, regions=None, verify=False):
+    """ Reads a table from a partitioned dataset, only the parts that can have the periods and regions asked for.
+
+    Parameters:
+    -----------
+    path : str
+        The root directory of the dataset.
+    table_id : str
+        The table to read.
+    tid : list/None
+        The periods to read, None reads every period.
+    regions : list/None
+        The region codes to read, None reads every region.
+    verify : bool
+        If True the checksum of every part is checked before its read.
+
+    Returns:
+    --------
+    dataframe : DataFrame
+        The rows for the periods and regions asked for.
+    """
+    manifest = read_manifest(path, table_id)
+    if manifest is None:
+        raise FileNotFoundError("Finner ikke tabell " + table_id + " i " + path)
+    tids = None if tid is None else set(str(t) for t in tid)
+    region_set = None if regions is None else set(str(r) for r in regions)
+    dtypes = {column: str for column in manifest["columns"] if column != "value"}
+
+    dataframes = []
+    for part in manifest["parts"]:
+        if tids is not None and part["tid"] not in tids:
+            continue
+        if region_set is not None and manifest["region_column"] is not None \
+                and region_set.isdisjoint(part["regions"]):
+            continue
+        file_path = os.path.join(path, "table=" + table_id, part["path"])
+        if verify:
+            with open(file_path, "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() != part["sha256"]:
+                    raise ValueError("Feil checksum for " + file_path)
+        if manifest["file_format"] == "parquet":
+            dataframe = pd.read_parquet(file_path)
+        else:
+            dataframe = pd.read_csv(file_path, dtype=dtypes, keep_default_na=False, na_values=[""],
+                                    compression="gzip")
+        if region_set is not None and manifest["region_column"] is not None:
+            dataframe = dataframe[dataframe[manifest["region_column"]].isin(region_set)]
+        dataframes.append(dataframe)
+
+    if not dataframes:
+        return pd.DataFrame(columns=manifest["columns"])
+    return pd.concat(dataframes, ignore_index=True)
+
+
+def new_stats():
+    """ Returns an empty dict to count requests, bytes, rows and seconds spent per stage in.
+
+    bytes is the size of the responses after decompression, wire_bytes what was actually transferred.
+    """
+    return {"requests": 0, "bytes": 0, "wire_bytes": 0, "rows": 0, "seconds": {}}
+
+
+def wire_size(response):
+    """ The number of bytes SSB sent for response, the compressed size if the body was compressed.
+
+    requests decompresses the body, but Content-Length is still the size that was transferred. An archived
+    response has the size from when it was recorded in wire_bytes instead, see ResponseArchive.
+    """
+    if isinstance(response, ArchivedResponse):
+        return response.wire_bytes
+    wire_bytes = response.headers.get("Content-Length")
+    return int(wire_bytes) if wire_bytes else len(response.content)
+
+
+def count_response(stats, response):
+    """ Counts a response from SSB in a stats dict from new_stats. """
+    stats["requests"] += 1
+    stats["bytes"] += len(response.content)
+    stats["wire_bytes"] += wire_size(response)
+
+
+def add_seconds(stats, stage, seconds):
+    """ Adds seconds to a stage in a stats dict from new_stats. """
+    stats["seconds"][stage] = stats["seconds"].get(stage, 0.0) + seconds
+
+
+class ArchivedResponse:
+    """ A response read from a ResponseArchive, with the parts of requests.Response the scripts use.
+
+    The body is already decompressed, so the headers never have Content-Encoding and Content-Length is the
+    length of content, also for archives recorded with the headers as SSB sent them. wire_bytes is the size
+    SSB sent, the length of content if it isnt known.
+    """
+
+    def __init__(self, content, status_code, headers, wire_bytes=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {key: value for key, value in headers.items()
+                        if key.lower() not in ("content-encoding", "content-length")}
+        self.headers["Content-Length"] = str(len(content))
+        self.wire_bytes = len(content) if wire_bytes is None else wire_bytes
+        charset = re.search(r"charset=([\w-]+)", headers.get("Content-Type", ""))
+        self.encoding = charset.group(1) if charset else "utf-8"
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors="replace")
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+
+class ResponseArchive:
+    """ A class used to store every raw response from SSB on disk, and to replay them without the network.
+
+    The bodies are stored gzip compressed and content addressed, objects/<sha256 of the body>.gz, so a body
+    that is returned for several requests is only stored once. Each request is stored as
+    requests/<sha256 of method, url and query>.json, with the url, the query from build_query, the status code,
+    the headers, the sha256 of the body and the bytes SSB sent for it (wire_bytes). The headers describe the
+    stored body, which is decompressed, so Content-Encoding is dropped and Content-Length is its length.
+
+    In replay mode the responses are read from the archive and the network is never used, a request that
+    isnt in the archive raises FileNotFoundError.
+
+    The chunks depend on the rows per chunk ChunkTuner has tuned for the table, so the rows each table was
+    planned with are frozen in plans.json when recording, and used instead of tuned_chunk_sizes when replaying.
+    Otherwise a replay with other tuned sizes plans other chunks, which arent in the archive.
+
+    Attributes:
+    -----------
+    path : str
+        The directory of the archive.
+    replay : bool
+        True if the responses are read from the archive instead of SSB.
+    """
+
+    # Headerne som lagres med svaret, resten trengs ikke for å dekode det på nytt
+    # Content-Encoding og Content-Length gjelder det komprimerte svaret, og lagres ikke, se ArchivedResponse
+    kept_headers = ("Content-Type", "Last-Modified")
+
+    def __init__(self, path, replay=False):
+        self.path = path
+        self.replay = replay
+        self._lock = threading.Lock()
+
+    @property
+    def plans_path(self):
+        return os.path.join(self.path, "plans.json")
+
+    def plans(self):
+        """ The rows per chunk each table in the archive was planned with, {table_id: max_rows}. """
+        if not os.path.exists(self.plans_path):
+            return {}
+        with open(self.plans_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def freeze_plan(self, table_id, max_rows):
+        """ Stores the rows per chunk table_id was planned with, so a replay plans the same chunks. """
+        with self._lock:
+            plans = self.plans()
+            plans[table_id] = max_rows
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.plans_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(plans, f, indent=2, sort_keys=True)
+            os.replace(self.plans_path + ".tmp", self.plans_path)
+
+    def request_path(self, method, url, body):
+        key = hashlib.sha256(json.dumps([method, url, body], sort_keys=True).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "requests", key[:2], key + ".json")
+
+    def object_path(self, checksum):
+        return os.path.join(self.path, "objects", checksum[:2], checksum + ".gz")
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """ Does a GET (body is None) or POST request, or reads it from the archive in replay mode.
+
+        Returns:
+        --------
+        response : requests.Response/ArchivedResponse
+        """
+        request_path = self.request_path(method, url, body)
+        if self.replay:
+            if not os.path.exists(request_path):
+                raise FileNotFoundError("Finner ikke svaret i arkivet: " + method + " " + url)
+            with open(request_path, encoding="utf-8") as f:
+                entry = json.load(f)
+            with gzip.open(self.object_path(entry["sha256"]), "rb") as f:
+                return ArchivedResponse(f.read(), entry["status_code"], entry["headers"], entry.get("wire_bytes"))
+
+        if method == "POST":
+            response = requests.post(url, json=body, headers=headers, timeout=timeout)
+        else:
+            response = requests.get(url, headers=headers)
+        checksum = hashlib.sha256(response.content).hexdigest()
+        object_path = self.object_path(checksum)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            with gzip.open(object_path + ".tmp", "wb") as f:
+                f.write(response.content)
+            os.replace(object_path + ".tmp", object_path)
+        headers = {key: response.headers[key] for key in self.kept_headers if key in response.headers}
+        headers["Content-Length"] = str(len(response.content))
+        entry = {"method": method, "url": url, "query": body, "status_code": response.status_code,
+                 "headers": headers, "sha256": checksum, "wire_bytes": wire_size(response),
+                 "archived": datetime.now().isoformat(timespec="seconds")}
+        os.makedirs(os.path.dirname(request_path), exist_ok=True)
+        with open(request_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False, indent=2)
+        os.replace(request_path + ".tmp", request_path)
+        return response
+
+
+# Arkivet alle spørringer går gjennom, se use_archive
+response_archive = None
+
+
+def use_archive(path, replay=False):
+    """ Stores every response from SSB in the archive in path, or replays them from it if replay is True.
+
+    None turns the archive off again.
+    """
+    global response_archive
+    response_archive = None if path is None else ResponseArchive(path, replay)
+
+
+def replaying():
+    """ True if the responses are read from the archive, there is then no reason to pause between requests. """
+    return response_archive is not None and response_archive.replay
+
+
+def planned_max_rows(table_id):
+    """ The rows per chunk to plan table_id with.
+
+    When replaying its the size frozen in the archive (see ResponseArchive.freeze_plan), otherwise the size
+    ChunkTuner has tuned for the table, or ssb_row_limit. Archives recorded before the plans were frozen fall
+    back to the tuned size.
+    """
+    if replaying():
+        frozen = response_archive.plans().get(table_id)
+        if frozen is not None:
+            return frozen
+    return tuned_chunk_sizes.get(table_id, {}).get("max_rows", ssb_row_limit)
+
+
+def http_get(url, headers=None):
+    """ requests.get, through the archive if use_archive has been used. """
+    if response_archive is None:
+        return requests.get(url, headers=headers)
+    return response_archive.request("GET", url, headers=headers)
+
+
+def http_post(url, json=None, headers=None, timeout=None):
+    """ requests.post, through the archive if use_archive has been used. The default timeout is request_timeout. """
+    timeout = timeout or request_timeout
+    if response_archive is None:
+        return requests.post(url, json=json, headers=headers, timeout=timeout)
+    return response_archive.request("POST", url, json, headers, timeout)
+
+
+region_klass_cache = {}
+region_klass_lock = threading.Lock()
+
+
+def klass_from_date(tid_list):
+    """ The first year we need the classifications for, five years before the last period but not before the first. """
+    max_tid = int(max(tid_list)[0:4])
+    min_tid = int(min(tid_list)[0:4])
+    if max_tid - 5 < min_tid:
+        return min_tid
+    return max_tid - 5
+
+
+def prefetch_quietly(target):
+    """ Runs a fetch started by SSBTable.prefetch, errors are raised again when the result is used. """
+    try:
+        target()
+    except Exception:
+        pass
+
+
+def shared_region_klass(klass_id, tid_list=None, from_date=None):
+    """ Returns a RegionKLASS that is shared by every table with the same classifications and from date.
+
+    When several tables are fetched in one run, the classifications are then only fetched once.
+
+    Parameters:
+    -----------
+    klass_id : list
+        List of classificationcode we are using to get our complete list of region codes.
+    tid_list : list/None
+        The periods of the table.
+    from_date : int/None
+        The from date, used instead of tid_list when its given.
+
+    Returns:
+    --------
+    klass : RegionKLASS
+        The shared RegionKLASS.
+    """
+    klass = RegionKLASS(klass_id, tid_list, from_date)
+    key = (tuple(klass_id), klass.from_date)
+    with region_klass_lock:
+        if key not in region_klass_cache:
+            region_klass_cache[key] = klass
+        return region_klass_cache[key]
+
+
+def wildcard_patterns(values, table_values):
+    """ Compresses a list of value codes to SSB wildcard patterns, if it can be done without changing the selection.
+
+    For every selected code we look for the shortest prefix where every code in the table with that
+    prefix is selected, e.g. all the Viken municipalities become "30*". Prefixes that would also match
+    codes we have filtered out are never used, so the server returns exactly the same values.
+
+    Parameters:
+    -----------
+    values : list
+        The value codes we want to query.
+    table_values : list
+        Every value code the table has for the dimension.
+
+    Returns:
+    --------
+    patterns : list
+        Wildcard patterns and exact codes that select the same values.
+    """
+    selected = set(values)
+    prefix_total = {}
+    prefix_selected = {}
+    for code in table_values:
+        for i in range(1, len(code) + 1):
+            prefix_total[code[:i]] = prefix_total.get(code[:i], 0) + 1
+            if code in selected:
+                prefix_selected[code[:i]] = prefix_selected.get(code[:i], 0) + 1
+
+    patterns = []
+    seen = set()
+    for code in values:
+        pattern = code
+        for i in range(1, len(code) + 1):
+            prefix = code[:i]
+            if prefix_total[prefix] == prefix_selected.get(prefix, 0):
+                pattern = prefix + "*" if prefix_total[prefix] > 1 or prefix != code else code
+                break
+        if pattern not in seen:
+            seen.add(pattern)
+            patterns.append(pattern)
+    return patterns
+
+
+def build_selection(dimension):
+    """ Picks the smallest SSB selection that is equivalent to the selected values of the dimension.
+
+    The selection is pushed down to the server where it is equivalent to the item list:
+    every value becomes "all" with "*", the newest periods of Tid becomes "top" and groups of
+    codes becomes wildcard patterns. Otherwise it falls back to spelling out every value with "item".
+
+    Parameters:
+    -----------
+    dimension : Dimension
+        The dimension with the values we want to query selected.
+
+    Returns:
+    --------
+    selection : dict
+        The selection part of the query for the dimension.
+    """
+    values = dimension.values
+    size = len(dimension.codes)
+    if not values or len(np.unique(dimension.positions)) != len(values):
+        return {"filter": "item", "values": values}
+    if dimension.is_complete:
+        return {"filter": "all", "values": ["*"]}
+    if (dimension.time or dimension.code == "Tid") \
+            and np.array_equal(np.sort(dimension.positions), np.arange(size - len(values), size)):
+        return {"filter": "top", "values": [str(len(values))]}
+    all_values = dimension.codes.tolist()
+    if any("*" in value or "?" in value for value in all_values):
+        return {"filter": "item", "values": values}
+    patterns = wildcard_patterns(values, all_values)
+    if len(patterns) < len(values):
+        return {"filter": "all", "values": patterns}
+    return {"filter": "item", "values": values}
+
+
+def build_query(variables, _filter="item", response_format="json-stat2"):
+    """ A function to build a standard query for the SSB API.
+
+    We set up a standard query as a dict and an empty query list.
+    Then it loops over the variables parameter, which is a list of the metadata
+    that has been filtered for the regions that are invalid within the last five years.
+    It ignores the other values, except for the code, filter and values from the metadata
+    as SSB doesnt use those when querying.
+    Unless a filter is forced with _filter, build_selection is used to push the selection
+    down to the server with SSB's own filters, so we dont have to spell out every value.
+    At the end it appends it query list in the main query dict and returns it.
+
+    Parameters:
+    -----------
+    variables : list
+        Filtered list of Dimension that has been pruned for regions that are not valid
+    _filter : str
+        A string parameter for the query filter variable
+    response_format : str
+        The format SSB should respond with, one of response_formats.
+
+    Returns:
+    --------
+    query : dict
+        Returns a query for a single year or one that equals 800k rows.
+
+    """
+    query = {
+        "query": [],
+        "response": {
+            "format": response_format
+        }
+    }
+
+    for var in variables:
+        query_details = {
+            "code": None,
+            "selection": {
+                "filter": _filter,
+                "values": []
+            }
+        }
+        query_details["code"] = var.code
+        if (_filter != "item"):
+            query_details["selection"]["filter"] = _filter
+            query_details["selection"]["values"].extend(var.values)
+        else:
+            query_details["selection"] = build_selection(var)
+        query["query"].append(query_details)
+    return query
+
+
+# Svarformatene post_query kan be om, json-stat2 dekodes av ResultAssembler/pyjstat og resten av parserne under
+response_formats = ["json-stat2", "csv2", "px"]
+
+# Det SSB skriver i stedet for en verdi som mangler eller ikke kan vises
+missing_values = {".", "..", "...", ":", "-", ""}
+
+
+def frame_from_positions(variables, positions, value):
+    """ Builds a DataFrame like pyjstat.from_json_stat(naming="id") returns from category positions.
+
+    Parameters:
+    -----------
+    variables : list
+        The Dimension of each column, in the order of the columns.
+    positions : list
+        An array per dimension with the position of the value code in the dimension on each row.
+    value : numpy.ndarray
+        The values, NaN where SSB has no value.
+
+    Returns:
+    --------
+    dataframe : DataFrame
+        A str column per dimension and a float value column, sorted like json-stat2 sorts its values.
+    """
+    order = np.lexsort(positions[::-1])
+    columns = {}
+    for dimension, position in zip(variables, positions):
+        columns[dimension.code] = dimension.codes[position[order]].astype(object)
+    columns["value"] = value[order]
+    return pd.DataFrame(columns)
+
+
+def parse_values(tokens, decimal="."):
+    """ Converts the values in a csv or px response to floats, everything in missing_values becomes NaN. """
+    tokens = pd.Series(tokens, dtype=object)
+    tokens[tokens.isin(missing_values)] = np.nan
+    if decimal != ".":
+        tokens = tokens.str.replace(decimal, ".", regex=False)
+    return pd.to_numeric(tokens, errors="coerce").to_numpy(dtype=float)
+
+
+def label_positions(dimension, labels):
+    """ The position of each label in dimension, by value code, or by value text if its not a code. -1 if unknown.
+
+    A text that more than one value in the dimension has, e.g. two art with the same name, cant tell which value
+    it is, so only texts that are unique in the dimension are used.
+    """
+    labels = pd.Index(labels)
+    position = pd.Index(dimension.codes).get_indexer(labels)
+    unknown = position < 0
+    if unknown.any():
+        texts = pd.Series(dimension.texts)
+        unique = texts[~texts.duplicated(keep=False)]
+        by_text = pd.Index(unique.to_numpy()).get_indexer(labels[unknown])
+        position[unknown] = np.where(by_text < 0, -1, unique.index.to_numpy()[by_text])
+    return position
+
+
+# Skilletegnene parse_csv kjenner igjen, SSB bruker komma, men semikolon og tab finnes i andre csv formater
+csv_separators = [",", ";", "\t"]
+
+
+def csv_separator(content, columns):
+    """ The separator of a csv response, the one that splits the header into columns columns. """
+    header = content.split(b"\n", 1)[0].decode("utf-8-sig", errors="replace")
+    for separator in csv_separators:
+        if len(next(csv.reader([header], delimiter=separator))) == columns:
+            return separator
+    raise ValueError("Ukjent csv format, finner ikke skilletegnet i " + header)
+
+
+def parse_csv(content, variables):
+    """ Parses a csv2 response from SSB into the same DataFrame pyjstat gives for json-stat2.
+
+    The response has a row per cell, with the value codes of each dimension in their own column and the
+    value in the last one. The separator is found from the header, which has a column per dimension and the
+    value column, and with ; as separator the values have decimal comma. The columns are matched with variables
+    by code or text, and the values are looked up with label_positions, so the whole response is parsed
+    column by column.
+
+    Parameters:
+    -----------
+    content : bytes
+        The response body.
+    variables : list
+        The Dimension in the query, in the order of the query.
+
+    Returns:
+    --------
+    dataframe : DataFrame
+        A str column per dimension and a float value column.
+    """
+    separator = csv_separator(content, len(variables) + 1)
+    raw = pd.read_csv(io.BytesIO(content), sep=separator, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    names = {}
+    for dimension in variables:
+        for column in raw.columns:
+            if column == dimension.code or column.lower() == dimension.text.lower():
+                names[dimension.code] = column
+    missing = [dimension.code for dimension in variables if dimension.code not in names]
+    value_columns = [column for column in raw.columns if column not in names.values()]
+    if missing or len(value_columns) != 1:
+        raise ValueError("Ukjent csv format, kolonnene er " + ", ".join(raw.columns))
+
+    positions = []
+    for dimension in variables:
+        position = label_positions(dimension, raw[names[dimension.code]])
+        if (position < 0).any():
+            raise ValueError("Ukjente verdier i kolonne " + names[dimension.code])
+        positions.append(position)
+    value = parse_values(raw[value_columns[0]].to_numpy(), decimal="," if separator == ";" else ".")
+    return frame_from_positions(variables, positions, value)
+
+
+px_keyword = re.compile(r'^(?P<keyword>[A-Z-]+)(?:\[(?P<language>[\w-]+)\])?(?:\("(?P<variable>[^"]*)"\))?'
+                        r'=(?P<value>.*?);\s*$', re.DOTALL | re.MULTILINE)
+
+
+def parse_px(content, variables):
+    """ Parses a px response from SSB into the same DataFrame pyjstat gives for json-stat2.
+
+    A px file has the codes of every variable in the header and the values as one long list after DATA=,
+    in row-major order over STUB and then HEADING. The values are parsed in one go, and the columns are
+    made by looking up the codes, the rows are then sorted in the order of variables.
+
+    Parameters:
+    -----------
+    content : bytes
+        The response body.
+    variables : list
+        The Dimension in the query, in the order of the query.
+
+    Returns:
+    --------
+    dataframe : DataFrame
+        A str column per dimension and a float value column.
+    """
+    header, _, data = content.partition(b"DATA=")
+    codepage = re.search(rb'CODEPAGE="([^"]+)"', header)
+    header = header.decode(codepage.group(1).decode("ascii") if codepage else "iso-8859-1")
+    keywords = {}
+    for match in px_keyword.finditer(header):
+        if match.group("language") is None:
+            keywords[(match.group("keyword"), match.group("variable"))] = re.findall(r'"([^"]*)"', match.group("value"))
+
+    by_code = {dimension.code: dimension for dimension in variables}
+    by_text = {dimension.text.lower(): dimension for dimension in variables}
+    order = keywords.get(("STUB", None), []) + keywords.get(("HEADING", None), [])
+    px_variables = []
+    px_codes = []
+    for name in order:
+        code = keywords.get(("VARIABLECODE", name), [None])[0]
+        dimension = by_code.get(code) or by_text.get(name.lower())
+        if dimension is None:
+            raise ValueError("Finner ikke variabelen " + name + " i spørringen")
+        px_variables.append(dimension)
+        px_codes.append(keywords.get(("CODES", name)) or keywords[("VALUES", name)])
+
+    data = data.decode("ascii", errors="replace")
+    tokens = [token.strip('"') for token in re.findall(r'"[^"]*"|[^\s";]+', data)]
+    sizes = [len(codes) for codes in px_codes]
+    value = parse_values(tokens)
+    if len(value) != int(np.prod(sizes, dtype=np.int64)):
+        raise ValueError("px filen har {} verdier, men skulle hatt {}".format(len(value), int(np.prod(sizes))))
+
+    grid = np.indices(sizes).reshape(len(sizes), -1)
+    positions = {}
+    for dimension, codes, position in zip(px_variables, px_codes, grid):
+        lookup = label_positions(dimension, codes)
+        if (lookup < 0).any():
+            raise ValueError("Ukjente verdier for variabelen " + dimension.code + " i px filen")
+        positions[dimension.code] = lookup[position]
+    return frame_from_positions(variables, [positions[dimension.code] for dimension in variables], value)
+
+
+response_parsers = {"csv2": parse_csv, "px": parse_px}
+
+
+def calc_iterations(ssb_table):
+    iterations = 0
+    if ssb_table.table_tid_name == "år":
+        iterations = -6
+    elif ssb_table.table_tid_name == "måned":
+        iterations = -61
+    elif ssb_table.table_tid_name == "kvartal":
+        iterations = -21
+
+    return iterations
+
+
+class RegionRules:
+    """ A class used to decide which regions are valid in which years, from a set of rules.
+
+    The rules are a dict, usually a rule set from default_region_rules or regions.json (see load_region_rules):
+        always         : codes that are always valid, e.g. "0" (Hele landet) and "EAK"
+        exclude_prefix : codes starting with one of these are never valid
+        klass          : if true, a code is only valid in the years KLASS has it as valid
+        periods        : list of {"from": year, "to": year, "include_prefix": [...], "exclude_prefix": [...]},
+                         in the years from <= year < to only codes with one of include_prefix are valid,
+                         and codes with one of exclude_prefix are not
+
+    Every rule is evaluated for every code and year in one go with NumPy, instead of one region at a time.
+
+    Attributes:
+    -----------
+    rules : dict
+        The rules the object was made from.
+    key : str
+        A hash of rules, so results calculated from the rules can be cached by it.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.key = hashlib.sha1(json.dumps(rules, sort_keys=True).encode("utf-8")).hexdigest()
+        self.always = list(rules.get("always", []))
+        self.exclude_prefix = list(rules.get("exclude_prefix", []))
+        self.klass = bool(rules.get("klass", False))
+        self.periods = list(rules.get("periods", []))
+
+    @staticmethod
+    def prefix_mask(codes, prefixes):
+        """ True for every code that starts with one of prefixes. """
+        mask = np.zeros(len(codes), dtype=bool)
+        for prefix in prefixes:
+            mask |= np.char.startswith(codes, prefix)
+        return mask
+
+    def always_mask(self, codes):
+        """ True for every code in always. """
+        return np.isin(np.asarray(codes, dtype=str), self.always)
+
+    def validity(self, codes, years, filtered_regions=None):
+        """ Evaluates the rules for every code and year.
+
+        Parameters:
+        -----------
+        codes : list
+            The region codes.
+        years : list
+            The years, as int.
+        filtered_regions : dict/None
+            The valid regions from RegionKLASS.filtered_regions, needed if klass is true.
+
+        Returns:
+        --------
+        valid : numpy.ndarray
+            A bool array with a row per year and a column per code.
+        """
+        codes = np.asarray(codes, dtype=str)
+        years = np.asarray(years, dtype=np.int64).reshape(-1, 1)
+        valid = np.ones((len(years), len(codes)), dtype=bool)
+        if self.klass:
+            regions = filtered_regions or {}
+            valid_from = np.array([int(regions[code]["validFrom"]) if code in regions else 0
+                                   for code in codes.tolist()], dtype=np.int64)
+            valid_to = np.array([int(regions[code]["validTo"]) if code in regions else 0
+                                 for code in codes.tolist()], dtype=np.int64)
+            valid &= (valid_from <= years) & (years < valid_to)
+        if self.exclude_prefix:
+            valid &= ~self.prefix_mask(codes, self.exclude_prefix)
+        for period in self.periods:
+            in_period = (years >= period.get("from", np.iinfo(np.int64).min)) \
+                & (years < period.get("to", np.iinfo(np.int64).max))
+            if "include_prefix" in period:
+                valid &= ~in_period | self.prefix_mask(codes, period["include_prefix"])
+            if "exclude_prefix" in period:
+                valid &= ~(in_period & self.prefix_mask(codes, period["exclude_prefix"]))
+        valid |= self.always_mask(codes)
+        return valid
+
+
+# Regelsettene for hvilke regioner som er gyldige, kan overstyres med regions.json ved siden av skriptet
+# klass: Hele landet og EAK/EAKUO alltid, ellers de kommunene KLASS sier er gyldige det året (Meta og Data Filter)
+# prefix: Svalbard, Jan Mayen, Kontinentalsokkelen, Utlandet, Havområder, Ikke bosatt i Norge er aldri med.
+# Før 2018 bare kommuner fra før 2020 sammenslåingen (Viken, Innlandet, Vestfold og Telemark, Agder, Vestland,
+# Troms og Finnmark) og før Trøndelag (50) ble slått sammen i 2018, i 2018 og 2019 er Trøndelag 50 og ikke 16,
+# fra 2020 bare de nye fylkene og de som ikke ble påvirket (Stavanger, Møre og Romsdal, Nordland, Trøndelag)
+# (ASSS SSB AlleAar Values)
+default_region_rules = {
+    "klass": {"always": ["0", "EAK", "EAKUO"], "klass": True},
+    "prefix": {
+        "exclude_prefix": ["21", "22", "23", "25", "26", "88", "99"],
+        "periods": [
+            {"to": 2018, "exclude_prefix": ["30", "34", "38", "42", "46", "54", "50"]},
+            {"from": 2018, "to": 2020, "exclude_prefix": ["30", "34", "38", "42", "46", "54", "16"]},
+            {"from": 2020, "include_prefix": ["30", "34", "38", "42", "46", "54", "11", "15", "18", "50"]}
+        ]
+    }
+}
+
+try:
+    rules_dir = os.path.dirname(os.path.abspath(__file__))
+except NameError:
+    # SQL Server sin external_script har ikke __file__
+    rules_dir = os.getcwd()
+
+
+def load_region_rules(name="klass"):
+    """ Reads the rule set name from regions.json next to the script, the one in default_region_rules if its not there.
+
+    The other scripts load their rules from here too, so every variant filters the regions the same way.
+
+    Returns:
+    --------
+    rules : RegionRules
+    """
+    path = os.path.join(rules_dir, "regions.json")
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            rule_sets = json.load(f)
+        if name in rule_sets:
+            return RegionRules(rule_sets[name])
+    return RegionRules(default_region_rules[name])
+
+
+region_rules = load_region_rules()
+
+
+def region_validity(region_dimension, filtered_regions, years, rules):
+    """ Calculates which of the selected regions are valid in each year, once per distinct year.
+
+    Parameters:
+    -----------
+    region_dimension : Dimension
+        The region dimension with the selected regions.
+    filtered_regions : dict
+        The valid regions from RegionKLASS.filtered_regions.
+    years : iterable
+        The years to check, as int.
+    rules : RegionRules
+        The rules that decide which regions are valid.
+
+    Returns:
+    --------
+    validity : dict
+        A bool array per year, True for every selected region that is valid in the year.
+    """
+    distinct = sorted(set(years))
+    valid = rules.validity(region_dimension.values, distinct, filtered_regions)
+    return {year: valid[idx] for idx, year in enumerate(distinct)}
+
+
+region_validity_cache = {}
+region_validity_lock = threading.Lock()
+
+
+def period_validity(klass, region_dimension, period_codes, rules):
+    """ Returns a valid region mask per period, shared by every table with the same regions, periods and KLASS.
+
+    Many tables have the same region dimension and the same periods, so in a batch run the masks are only
+    calculated once per distinct layout. The key is the fingerprint of the region dimension, the periods, the
+    classifications and the from date of klass, and the key of the rules, which are all calculated once per
+    dimension and rule set, so looking up the cache doesnt depend on the number of regions.
+    The masks are read only, since they are shared.
+
+    Parameters:
+    -----------
+    klass : RegionKLASS
+        The classifications the valid regions are taken from.
+    region_dimension : Dimension
+        The region dimension with the selected regions.
+    period_codes : list
+        The codes of the periods, e.g. 2021, 2021K1 or 2021M01.
+    rules : RegionRules
+        The rules that decide which regions are valid, part of the key.
+
+    Returns:
+    --------
+    masks : list
+        A bool array per period, True for every selected region that is valid in the period.
+    """
+    key = (region_dimension.fingerprint, tuple(period_codes), tuple(klass.klass_id), klass.from_date, rules.key)
+    with region_validity_lock:
+        if key in region_validity_cache:
+            return region_validity_cache[key]
+    years = [int(code[0:4]) for code in period_codes]
+    filtered_regions = klass.filtered_regions if rules.klass else None
+    validity = region_validity(region_dimension, filtered_regions, years, rules)
+    for mask in validity.values():
+        mask.flags.writeable = False
+    masks = [validity[year] for year in years]
+    with region_validity_lock:
+        return region_validity_cache.setdefault(key, masks)
+
+
+def split_regions(positions, always, rows_per_region, max_rows):
+    """ Splits the regions of a chunk so that every chunk stays under max_rows.
+
+    Regions that are always included (RegionRules.always) are added without checking the size.
+
+    Parameters:
+    -----------
+    positions : list
+        Positions of the regions in the region dimension.
+    always : list
+        True for the positions that are always included.
+    rows_per_region : int
+        Number of rows each region adds to a chunk.
+    max_rows : int
+        Maximum rows we can query per request.
+
+    Returns:
+    --------
+    chunks : list
+        A list of positions per chunk.
+    """
+    chunks = []
+    current = []
+    for position, is_always in zip(positions, always):
+        if is_always or rows_per_region * (len(current) + 1) < max_rows:
+            current.append(position)
+        else:
+            chunks.append(current)
+            current = [position]
+    chunks.append(current)
+    return chunks
+
+
+def planned_periods(ssb_table, iterations):
+    """ The positions of the periods meta_filter plans for, the last -iterations - 1 periods, newest first.
+
+    Tables without a region dimension are fetched for every period.
+    """
+    tid_dimension = ssb_table.dimensions[ssb_table.table_tid]
+    if ssb_table.table_region is None:
+        return tid_dimension.positions.tolist()
+    return tid_dimension.positions[-1:iterations:-1].tolist()
+
+
+def meta_filter(ssb_table, iterations):
+    """ A function that filters away the regions that are invalid for the past five years.
+
+    Its done this way becaue of the way JSON-Stat files are built up, if we dont do a filter and query for each year
+    separately we will end up getting values for regions that are invalid for that year (In SSBs case they
+    are returned as the number 0). The regions that are valid in each year is calculated once per distinct year by
+    region_validity, and broadcast to every period of the year, so a table with måned or kvartal doesnt repeat the
+    checks for every month or quarter. In a batch run tables with the same regions and periods share the masks,
+    see period_validity. Consecutive periods with the same valid regions, e.g. every year since the
+    2020 merger, are put in the same chunk, as many periods per chunk as the 800k row limit allows.
+    If one period is bigger than the limit on its own, its regions are split into several chunks by split_regions.
+
+    Parameters:
+    -----------
+    ssb_table : SSBTable
+        The table we are querying, its klass is used to find the valid regions.
+    iterations : int
+        Negative number of periods from calc_iterations.
+
+    Returns:
+    --------
+    metadata_filter : list
+        A list of the metadata_variables that has been filtered for non valid regions for the past five years.
+        Each item is a list of Dimension that shares its values with ssb_table.dimensions.
+    """
+    metadata_filter = []
+    dimensions = ssb_table.dimensions
+    if ssb_table.table_region != None:
+        region_dimension = dimensions[ssb_table.table_region]
+        tid_dimension = dimensions[ssb_table.table_tid]
+        periods = planned_periods(ssb_table, iterations)
+        masks = period_validity(ssb_table.klass, region_dimension, tid_dimension.codes[periods].tolist(),
+                                ssb_table.region_rules)
+        always = ssb_table.region_rules.always_mask(region_dimension.values)
+
+        groups = []
+        for period, mask in zip(periods, masks):
+            if groups and np.array_equal(groups[-1][0], mask):
+                groups[-1][1].append(period)
+            else:
+                groups.append((mask, [period]))
+
+        for mask, group in groups:
+            regions = region_dimension.positions[mask].tolist()
+            rows_per_period = ssb_table.table_size * len(regions)
+            if rows_per_period == 0:
+                periods_per_chunk = len(group)
+            else:
+                periods_per_chunk = (ssb_table.ssb_max_row_query - 1) // rows_per_period
+            if periods_per_chunk >= 1:
+                chunks = [(regions, group[start:start + periods_per_chunk])
+                          for start in range(0, len(group), periods_per_chunk)]
+            else:
+                chunks = [(chunk, [period]) for period in group
+                          for chunk in split_regions(regions, always[mask], ssb_table.table_size,
+                                                     ssb_table.ssb_max_row_query)]
+            for chunk_regions, chunk_periods in chunks:
+                new_meta_var = list(dimensions)
+                new_meta_var[ssb_table.table_region] = region_dimension.select(chunk_regions)
+                new_meta_var[ssb_table.table_tid] = tid_dimension.select(chunk_periods)
+                metadata_filter.append(new_meta_var)
+    else:
+        metadata_filter.extend(split_to_limit(list(dimensions), ssb_table.ssb_max_row_query))
+    return metadata_filter
+
+
+def chunk_rows(variables):
+    """ Number of rows a chunk from meta_filter gives. """
+    return int(np.prod([len(dimension) for dimension in variables], dtype=np.int64))
+
+
+def split_chunk(variables):
+    """ Splits a chunk in two halves along its largest dimension.
+
+    Parameters:
+    -----------
+    variables : list
+        A chunk from meta_filter.
+
+    Returns:
+    --------
+    chunks : list/None
+        Two chunks with the same rows between them, or None if every dimension has one value.
+    """
+    sizes = [len(dimension) for dimension in variables]
+    d_idx = int(np.argmax(sizes))
+    if sizes[d_idx] < 2:
+        return None
+    positions = variables[d_idx].positions
+    halves = []
+    for part in (positions[:len(positions) // 2], positions[len(positions) // 2:]):
+        half = list(variables)
+        half[d_idx] = variables[d_idx].select(part)
+        halves.append(half)
+    return halves
+
+
+def split_to_limit(variables, max_rows):
+    """ Splits a chunk with split_chunk until every part is under max_rows. """
+    if chunk_rows(variables) < max_rows:
+        return [variables]
+    halves = split_chunk(variables)
+    if halves is None:
+        return [variables]
+    return split_to_limit(halves[0], max_rows) + split_to_limit(halves[1], max_rows)
+
+
+# Sekunder mellom hver spørring mot SSB
+request_pause = 3.0
+
+# Største antall celler SSB svarer med i en spørring
+ssb_row_limit = 800000
+
+# Sekunder vi venter på et svar før delen regnes som feilet og deles opp
+request_timeout = 120
+
+# Statuskodene SSB bruker når en del er for stor, delen deles i to og hentes på nytt
+split_statuses = (403, 413)
+
+# Antall ganger samme del hentes på nytt når SSB er overbelastet (429) eller har feil (5xx),
+# og sekunder vi venter før første nye forsøk (dobles for hvert forsøk, Retry-After fra SSB brukes hvis den finnes)
+max_retries = 5
+retry_backoff = 10.0
+
+# Sekunder den minste delen som har feilet huskes, etterpå kan ChunkTuner prøve større deler igjen
+failed_rows_ttl = 7 * 24 * 3600
+
+# Antall rader per del ChunkTuner har funnet for hver tabell, se load_chunk_sizes og save_chunk_sizes
+tuned_chunk_sizes = {}
+
+
+class ChunkTuner:
+    """ A class used to tune the number of rows per chunk for a table from the chunks that have been fetched.
+
+    Besides the row limit, SSB has limits on the size of a response and on how long a query can run, so a chunk
+    under ssb_row_limit can still fail or time out, while small chunks waste a request and a pause each.
+    For every chunk the latency and bytes per cell are recorded. A chunk that is too big for SSB (a timeout or
+    one of split_statuses) is split in two and put back in the queue by post_query, and max_rows is lowered
+    below it. A chunk that takes more than twice target_seconds lowers max_rows to what can be fetched in
+    target_seconds, and a chunk near max_rows that comes back in less than half of target_seconds raises it,
+    at most to ssb_row_limit and never to the size of the smallest chunk that has failed for the table.
+    The smallest failed chunk is forgotten after failed_rows_ttl seconds, or when a chunk as big succeeds.
+
+    The chunks of a run are planned before the first request, so the tuned max_rows doesnt change the run
+    that tuned it, only failed chunks are split. The tuned max_rows is kept in tuned_chunk_sizes, and the
+    next time the table is planned the chunks are planned at the tuned size, that is when the fast ones are
+    merged into fewer requests.
+
+    Attributes:
+    -----------
+    table_id : str
+        The table that is tuned.
+    max_rows : int
+        The number of rows per chunk to plan for.
+    target_seconds : float
+        How long we want a request to take.
+    failed_rows : int/None
+        The size of the smallest chunk that has failed for the table, also remembered in tuned_chunk_sizes.
+    failed_at : str/None
+        When failed_rows failed, as an ISO timestamp.
+    chunks : list
+        Rows, bytes, seconds and if it failed, for every chunk fetched.
+    """
+
+    min_rows = 1000
+
+    def __init__(self, table_id, max_rows, target_seconds=20.0):
+        self.table_id = table_id
+        self.max_rows = max_rows
+        self.target_seconds = target_seconds
+        tuned = tuned_chunk_sizes.get(table_id, {})
+        self.failed_rows = tuned.get("failed_rows")
+        self.failed_at = tuned.get("failed_at")
+        if self.failed_at is None \
+                or (datetime.now() - datetime.fromisoformat(self.failed_at)).total_seconds() > failed_rows_ttl:
+            self.failed_rows = self.failed_at = None
+        self.chunks = []
+
+    @property
+    def ceiling(self):
+        """ The largest max_rows can be raised to. """
+        if self.failed_rows is None:
+            return ssb_row_limit
+        return min(ssb_row_limit, self.failed_rows - 1)
+
+    def record(self, rows, size, seconds):
+        """ Records a chunk that was fetched, and adjusts max_rows if it was slow or fast. """
+        self.chunks.append({"rows": rows, "bytes": size, "seconds": seconds, "failed": False})
+        if self.failed_rows is not None and rows >= self.failed_rows:
+            self.failed_rows = self.failed_at = None
+        if rows == 0 or seconds <= 0:
+            return
+        ideal = int(rows / seconds * self.target_seconds)
+        if seconds > 2 * self.target_seconds:
+            self.max_rows = max(self.min_rows, min(self.max_rows, ideal))
+        elif seconds < self.target_seconds / 2 and rows >= self.max_rows // 2:
+            self.max_rows = min(self.ceiling, max(self.max_rows, min(ideal, 2 * self.max_rows)))
+
+    def failed(self, rows, seconds):
+        """ Records a chunk that failed or timed out, max_rows is lowered to half of it. """
+        self.chunks.append({"rows": rows, "bytes": 0, "seconds": seconds, "failed": True})
+        self.failed_rows = rows if self.failed_rows is None else min(self.failed_rows, rows)
+        self.failed_at = datetime.now().isoformat(timespec="seconds")
+        self.max_rows = max(self.min_rows, min(self.max_rows, rows // 2))
+
+    def remember(self):
+        """ Stores max_rows and the observed throughput of the table in tuned_chunk_sizes. """
+        fetched = [chunk for chunk in self.chunks if not chunk["failed"]]
+        rows = sum(chunk["rows"] for chunk in fetched)
+        tuned = {"max_rows": self.max_rows, "failed_rows": self.failed_rows, "failed_at": self.failed_at,
+                 "updated": datetime.now().isoformat(timespec="seconds")}
+        if rows:
+            tuned["bytes_per_cell"] = sum(chunk["bytes"] for chunk in fetched) / rows
+            tuned["seconds_per_cell"] = sum(chunk["seconds"] for chunk in fetched) / rows
+        tuned_chunk_sizes[self.table_id] = tuned
+
+
+def failure_action(data, error):
+    """ Decides what post_query does with a chunk that failed.
+
+    Parameters:
+    -----------
+    data : requests.Response/ArchivedResponse/None
+        The response, None if the request raised error.
+    error : Exception/None
+        The exception the request raised.
+
+    Returns:
+    --------
+    action : str
+        "split" if the chunk was too big for SSB (a timeout or one of split_statuses), "retry" if SSB is
+        overloaded or down (429, 5xx or no connection), or "raise" for the rest, e.g. 400 for a wrong query.
+    """
+    if data is None:
+        return "split" if isinstance(error, requests.exceptions.Timeout) else "retry"
+    if data.status_code in split_statuses:
+        return "split"
+    if data.status_code == 429 or data.status_code >= 500:
+        return "retry"
+    return "raise"
+
+
+def retry_delay(data, attempt):
+    """ Seconds to wait before attempt number attempt, the Retry-After header if SSB sent one. """
+    retry_after = data.headers.get("Retry-After", "") if data is not None else ""
+    if retry_after.isdigit():
+        return float(retry_after)
+    return retry_backoff * 2 ** (attempt - 1)
+
+
+def load_chunk_sizes(path):
+    """ Reads the tuned chunk sizes from a JSON file into tuned_chunk_sizes, if the file exists. """
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            tuned_chunk_sizes.update(json.load(f))
+
+
+def save_chunk_sizes(path):
+    """ Writes tuned_chunk_sizes to a JSON file. """
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(tuned_chunk_sizes, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+class Profiler:
+    """ A class used to profile a run for a table, and write the result in formats we can attach to a ticket.
+
+    A sampler thread records the stacks of the profiled threads every interval seconds. Those are the thread
+    that entered the profiler and the threads that work for it, which are found by name: a thread named
+    "<name of the entering thread>/..." or "<table_id>/...", like the prefetch thread of SSBTable, the KLASS
+    requests in RegionKLASS and the hent/dekod threads in Meta Thread Filter AlleAar. Other threads are left
+    out, so parallel tables in the command line dont end up in each others profile, unless all_threads is True.
+    Work in other processes, like the decoding in the worker processes of Meta Thread Filter, isnt sampled.
+
+    A sample where the thread only waits (on a Condition, a queue, an event or a join, or an idle pool thread) is
+    counted in idle instead of added to the stacks, unless include_idle is True, so the waiting threads dont
+    drown out where the time is spent. When the run is done it writes, to path:
+        <table_id>.collapsed.txt   : collapsed stacks, "a;b;c count" per line, for flamegraph.pl or speedscope
+        <table_id>.speedscope.json : a sampled profile for https://www.speedscope.app
+        <table_id>.hotspots.txt    : the top functions by own and total time, tagged with the table id
+    With deterministic=True the run is also profiled with cProfile, <table_id>.prof is written and its top
+    functions by cumulative time are added to the hotspots.
+
+    Used as a context manager:
+        with Profiler("12367", "profil/"):
+            post_query(ssb_table)
+
+    Attributes:
+    -----------
+    table_id : str
+        The table, used in the file names and the summary.
+    path : str
+        The directory the files are written to.
+    samples : dict
+        Number of samples per stack, a stack is a tuple of frames from the outermost.
+    idle : int
+        Number of samples that were left out because the thread only waited.
+    files : list
+        The files that were written.
+    """
+
+    # Den innerste framen (funksjon, fil) i en tråd som bare venter, på en Condition/Event/kø, join eller ny jobb
+    idle_frames = {("wait", "threading.py"), ("_wait_for_tstate_lock", "threading.py"), ("_worker", "thread.py")}
+
+    def __init__(self, table_id, path, interval=0.005, top=20, deterministic=False, all_threads=False,
+                 include_idle=False):
+        self.table_id = table_id
+        self.path = path
+        self.interval = interval
+        self.top = top
+        self.deterministic = deterministic
+        self.all_threads = all_threads
+        self.include_idle = include_idle
+        self.samples = {}
+        self.idle = 0
+        self.files = []
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        self.prefixes = (threading.current_thread().name + "/", self.table_id + "/")
+        self.stop = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.profile = cProfile.Profile() if self.deterministic else None
+        self.started = time.time()
+        self.sampler.start()
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.profile is not None:
+            self.profile.disable()
+        self.stop.set()
+        self.sampler.join()
+        self.seconds = time.time() - self.started
+        self.write()
+        return False
+
+    def profiled(self, thread_id, names):
+        """ True if the thread is sampled, see the class docstring. """
+        if self.all_threads or thread_id == self.thread_id:
+            return True
+        return names.get(thread_id, "").startswith(self.prefixes)
+
+    def sample(self):
+        """ Records the stacks until stop is set, runs in the sampler thread. """
+        own = threading.get_ident()
+        while not self.stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or not self.profiled(thread_id, names):
+                    continue
+                code = frame.f_code
+                if not self.include_idle and (code.co_name, os.path.basename(code.co_filename)) in self.idle_frames:
+                    self.idle += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    @staticmethod
+    def frame_name(frame):
+        name, file_name, line = frame
+        return "{} ({}:{})".format(name, os.path.basename(file_name), line)
+
+    def write(self):
+        """ Writes the collapsed stacks, the speedscope profile and the hotspots. """
+        os.makedirs(self.path, exist_ok=True)
+        prefix = os.path.join(self.path, self.table_id)
+
+        with open(prefix + ".collapsed.txt", "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                f.write(";".join(self.frame_name(frame).replace(";", ":") for frame in stack) + " " + str(count) + "\n")
+
+        frames = {}
+        speedscope_samples = []
+        weights = []
+        for stack, count in self.samples.items():
+            speedscope_samples.append([frames.setdefault(frame, len(frames)) for frame in stack])
+            weights.append(count * self.interval)
+        speedscope = {"$schema": "https://www.speedscope.app/file-format-schema.json",
+                      "name": "Tabell " + self.table_id, "exporter": "asss-hent",
+                      "shared": {"frames": [{"name": name, "file": file_name, "line": line}
+                                            for name, file_name, line in frames]},
+                      "profiles": [{"type": "sampled", "name": "Tabell " + self.table_id, "unit": "seconds",
+                                    "startValue": 0, "endValue": self.seconds,
+                                    "samples": speedscope_samples, "weights": weights}]}
+        with open(prefix + ".speedscope.json", "w", encoding="utf-8") as f:
+            json.dump(speedscope, f)
+
+        total = sum(self.samples.values())
+        own = {}
+        inclusive = {}
+        for stack, count in self.samples.items():
+            if stack:
+                own[stack[-1]] = own.get(stack[-1], 0) + count
+            for frame in set(stack):
+                inclusive[frame] = inclusive.get(frame, 0) + count
+        lines = ["Tabell {}: {:.2f}s, {} samples hvert {}s".format(self.table_id, self.seconds, total, self.interval)]
+        if self.idle:
+            lines.append("{} samples der tråden bare ventet er ikke med ({:.3f}s)".format(self.idle,
+                                                                                     self.idle * self.interval))
+        for title, counts in (("Egen tid", own), ("Total tid", inclusive)):
+            lines.append("")
+            lines.append(title + ":")
+            for frame, count in sorted(counts.items(), key=lambda item: -item[1])[:self.top]:
+                lines.append("{:6.1%} {:8.3f}s  {}".format(count / max(1, total), count * self.interval,
+                                                            self.frame_name(frame)))
+        if self.profile is not None:
+            self.profile.dump_stats(prefix + ".prof")
+            self.files.append(prefix + ".prof")
+            summary = io.StringIO()
+            pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(self.top)
+            lines.extend(["", "cProfile:", summary.getvalue()])
+        with open(prefix + ".hotspots.txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        self.files.extend([prefix + ".collapsed.txt", prefix + ".speedscope.json", prefix + ".hotspots.txt"])
+
+
+# Andelen celler som må være tomme før sparse="auto" lagrer resultatet sparse
+# En SparseArray teller tomme eller 0 (det som er flest av), å droppe rader teller bare tomme, 0 er en verdi
+sparse_threshold = 0.5
+
+
+def should_drop_missing(dataframe, sparse):
+    """ True if the rows without a value should be dropped, sparse is True or "auto" and at least
+    sparse_threshold of the rows in dataframe have no value. Cells with 0 have a value and are never dropped.
+    """
+    if not sparse or len(dataframe) == 0:
+        return False
+    if sparse == "auto":
+        return bool(np.isnan(dataframe["value"].to_numpy(dtype=float)).mean() >= sparse_threshold)
+    return True
+
+
+def sparse_result(dataframe, sparse, drop_missing=False):
+    """ Stores a result sparse, if sparse is True, or "auto" and at least sparse_threshold of the cells are empty.
+
+    Many KOSTRA tables are mostly empty or 0 even after the region filtering, e.g. 09817 with country of origin
+    per municipality. The value column then becomes a pandas SparseArray, with NaN or 0 (whichever is most common)
+    as the fill value, so only the other values take memory, and "auto" counts the cells that are NaN or 0.
+    With drop_missing the rows without a value are dropped instead, so only the coordinates and values of the
+    cells that have a value are left, and "auto" only counts NaN, see should_drop_missing. Dont use drop_missing
+    per chunk, with "auto" that decides per chunk, post_query decides once per table and lets the sink drop
+    the rows, see the drop_missing attribute of the sinks.
+
+    Parameters:
+    -----------
+    dataframe : DataFrame
+        A column per dimension and a value column.
+    sparse : bool/str
+        True, False or "auto".
+    drop_missing : bool
+        If True the rows without a value are dropped instead of making the value column sparse.
+
+    Returns:
+    --------
+    dataframe : DataFrame
+        The same rows (or the rows with a value) with a sparse value column if it was worth it.
+    """
+    if not sparse or len(dataframe) == 0:
+        return dataframe
+    value = dataframe["value"].to_numpy(dtype=float)
+    missing = np.isnan(value)
+    if drop_missing:
+        if not should_drop_missing(dataframe, sparse):
+            return dataframe
+        return dataframe[~missing].reset_index(drop=True)
+    zeros = value == 0
+    fill_value, empty = (np.nan, missing) if missing.sum() >= zeros.sum() else (0.0, zeros)
+    if sparse == "auto" and empty.mean() < sparse_threshold:
+        return dataframe
+    dataframe = dataframe.copy(deep=False)
+    dataframe["value"] = pd.arrays.SparseArray(value, fill_value=fill_value)
+    return dataframe
+
+
+# Kolonnenavnene i oppsummeringen post_query returnerer når resultatet lastes med en sink
+report_columns = {"table": "Tabell", "rows": "Rader", "inserted": "Nye", "changed": "Endret", "unchanged": "Uendret",
+                  "deleted": "Slettet", "parts": "Deler"}
+
+
+def post_query(ssb_table, sink=None, categorical=True, response_format="json-stat2", sparse=False, profile=None):
+    """ A function to do a post query on the SSB API.
+
+    This function does a post query on the SSB API, following the SSB API Documentation, by
+    doing a post request with the query we have built up, we get a JSON stat file back with the result.
+    First we run meta_filter() once to get the filtered metadata variables, then for each dict in the list
+    we run the build_query() function and post that query to the SSB API. Which after running that query
+    returns a JSON-Stat file back with the results. Each JSON-Stat is written straight into a ResultAssembler,
+    which has allocated the columns for every row in meta_data up front, so there is no concat at the end.
+
+    A chunk that is too big for SSB, it times out (request_timeout) or SSB answers with one of split_statuses,
+    is split in two by split_chunk and the halves are fetched instead. When SSB is overloaded or down (429, 5xx)
+    the same chunk is fetched again after a backoff, at most max_retries times, and any other error is raised,
+    see failure_action. The latency and size of every chunk is recorded by a ChunkTuner, which tunes the chunk
+    size the table is planned with the next time.
+
+    If a sink is given, each JSON-Stat is run through pyjstat and the DataFrame is written to the sink as soon
+    as its decoded instead, and the pause between requests is spent decoding and loading.
+    Only a summary is returned in that case.
+
+    Parameters:
+    -----------
+    ssb_table : SSBTable
+        The table we are querying.
+    sink : SQLTableSink/SQLiteMergeSink/PartitionedDatasetSink/None
+        Where to load each chunk, None returns everything as one DataFrame.
+    categorical : bool
+        If True the dimension columns of the DataFrame are categorical, otherwise str like pyjstat.
+    response_format : str
+        The format to ask SSB for, one of response_formats. csv2 and px are parsed by response_parsers
+        into the same DataFrame as json-stat2, see compare_formats for which is fastest for a table.
+    sparse : bool/str
+        True, False or "auto", see sparse_result. Without a sink the value column becomes a SparseArray.
+        With a sink the rows without a value are not written, with "auto" decided once for the table from
+        the first chunk with rows. The sink is given every row and drops them itself (drop_missing), so it
+        knows which cells no longer have a value and can remove them from what an earlier run wrote.
+    profile : str/Profiler/None
+        A directory to write a profile of the run to, or a Profiler to use, see Profiler. The prefetch
+        thread and the KLASS requests are sampled too, their threads are named after the table and the caller.
+
+    Returns:
+    --------
+    big_df : Series
+        This is the DataFrame that will be returned to the SQL server we are using.
+    """
+
+    if profile is not None:
+        with profile if isinstance(profile, Profiler) else Profiler(ssb_table.table_id, profile):
+            return post_query(ssb_table, sink, categorical, response_format, sparse)
+
+    stats = ssb_table.stats
+    pause = 0.0 if replaying() else request_pause
+    ssb_table.prefetch()
+    if ssb_table.table_region != None:
+        timer = time.time()
+        ssb_table.klass.load()
+        add_seconds(stats, "klass", time.time() - timer)
+    timer = time.time()
+    meta_data = meta_filter(ssb_table, calc_iterations(ssb_table))
+    add_seconds(stats, "plan", time.time() - timer)
+    if response_archive is not None and not response_archive.replay:
+        response_archive.freeze_plan(ssb_table.table_id, ssb_table.ssb_max_row_query)
+    if sink is None:
+        assembler = ResultAssembler(ssb_table.dimensions, meta_data, categorical)
+    tuner = ChunkTuner(ssb_table.table_id, ssb_table.ssb_max_row_query)
+    pending = list(reversed(meta_data))
+    retries = 0
+    drop_decided = False
+
+    try:
+        while pending:
+            variables = pending.pop()
+            query = build_query(variables, response_format=response_format)
+            timer = time.time()
+            error = None
+            try:
+                data = http_post(ssb_table.metadata_url, json=query)
+            except requests.exceptions.RequestException as e:
+                data = None
+                error = e
+            received = time.time()
+            add_seconds(stats, "fetch", received - timer)
+            if data is not None:
+                count_response(stats, data)
+            if data is None or data.status_code != 200:
+                message = repr(error) if data is None else "Status kode: " + str(data.status_code)
+                print("Feil!", message)
+                action = failure_action(data, error)
+                if action == "split":
+                    halves = split_chunk(variables)
+                    if halves is None:
+                        raise RuntimeError("Feil fra SSB for en del som ikke kan deles mer: " + message)
+                    tuner.failed(chunk_rows(variables), received - timer)
+                    pending.extend(reversed(halves))
+                    retries = 0
+                    delay = pause
+                elif action == "retry":
+                    retries += 1
+                    if retries > max_retries:
+                        raise RuntimeError("Feil fra SSB etter " + str(max_retries) + " nye forsøk: " + message)
+                    pending.append(variables)
+                    delay = 0.0 if replaying() else retry_delay(data, retries)
+                else:
+                    raise RuntimeError("Feil fra SSB: " + message)
+                time.sleep(delay)
+                add_seconds(stats, "sleep", time.time() - received)
+                continue
+            retries = 0
+            tuner.record(chunk_rows(variables), len(data.content), received - timer)
+            if sink is None:
+                time.sleep(pause)
+                add_seconds(stats, "sleep", time.time() - received)
+            timer = time.time()
+            updated = None
+            if response_format == "json-stat2":
+                json_stat = data.json(object_pairs_hook=OrderedDict)
+                updated = json_stat.get("updated")
+                if sink is None:
+                    stats["rows"] += assembler.add(json_stat)
+                else:
+                    dataframe = pyjstat.from_json_stat(json_stat, naming="id")[0]
+            else:
+                dataframe = response_parsers[response_format](data.content, variables)
+                if sink is None:
+                    stats["rows"] += assembler.add_frame(dataframe)
+            add_seconds(stats, "decode", time.time() - timer)
+            if sink is not None:
+                stats["rows"] += len(dataframe)
+                if not drop_decided and len(dataframe):
+                    sink.drop_missing = should_drop_missing(dataframe, sparse)
+                    drop_decided = True
+                timer = time.time()
+                sink.write(dataframe, updated=updated)
+                add_seconds(stats, "write", time.time() - timer)
+                timer = time.time()
+                time.sleep(max(0.0, pause - (time.time() - received)))
+                add_seconds(stats, "sleep", time.time() - timer)
+    except Exception:
+        if sink is not None:
+            sink.abort()
+        raise
+    finally:
+        if not replaying():
+            tuner.remember()
+
+    if sink is not None:
+        report = sink.close()
+        summary = {"Tabell Nummer": ssb_table.table_id}
+        for key, column in report_columns.items():
+            if key in report:
+                summary[column] = report[key]
+        return pd.DataFrame([summary])
+    big_df = sparse_result(assembler.dataframe(), sparse)
+    return big_df
+
+
+# Brukes av estimate når det ikke finnes rapporter fra tidligere kjøringer
+default_throughput = {"bytes_per_cell": 12.0, "seconds_per_cell": 2e-06, "source": "default"}
+
+
+def throughput_history(path, table_id=None):
+    """ Reads the throughput of earlier runs from the reports fetch_table has written to path.
+
+    Only reports with status ok and at least one row are used. If table_id is given and the table has
+    been fetched before, only its own reports are used, otherwise every table in path.
+
+    Parameters:
+    -----------
+    path : str/None
+        The directory with <table>.report.json files, usually --out of the command line.
+    table_id : str/None
+        The table to look for history for.
+
+    Returns:
+    --------
+    throughput : dict
+        bytes_per_cell and seconds_per_cell, with the pause between requests taken out of the seconds,
+        and source, which is the table, "all" or "default" if there is no history.
+    """
+    reports = []
+    if path is not None and os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(".report.json"):
+                continue
+            with open(os.path.join(path, name), encoding="utf-8") as f:
+                report = json.load(f)
+            if report.get("status") == "ok" and report.get("rows"):
+                reports.append(report)
+    own = [report for report in reports if report["table_id"] == table_id]
+    if own:
+        reports, source = own, table_id
+    else:
+        source = "all"
+    if not reports:
+        return dict(default_throughput)
+
+    rows = sum(report["rows"] for report in reports)
+    seconds = sum(max(0.0, report["seconds"].get("total", 0.0) - report["seconds"].get("sleep", 0.0))
+                  for report in reports)
+    return {"bytes_per_cell": sum(report["bytes"] for report in reports) / rows,
+            "seconds_per_cell": seconds / rows, "source": source}
+
+
+def estimate(ssb_table, history=None):
+    """ Estimates the cost of fetching a table, without fetching any data.
+
+    The metadata and the KLASS regions are fetched (and kept on ssb_table, so a post_query afterwards
+    doesnt fetch them again), then the query plan is made by meta_filter just like post_query does.
+    Every request is followed by a pause of request_pause seconds, the rest of the time is estimated
+    per cell from the throughput of earlier runs.
+
+    Parameters:
+    -----------
+    ssb_table : SSBTable
+        The table we want to estimate.
+    history : str/dict/None
+        A directory with reports from fetch_table, or a dict from throughput_history.
+        None uses default_throughput.
+
+    Returns:
+    --------
+    estimate : dict
+        periods : the periods meta_filter plans for, total_cells : cells in those periods before the region
+        filtering, valid_cells : cells left after it (the rows post_query returns), table_cells : cells in every
+        period of the table after the filter, requests, bytes and seconds, and the throughput the estimate is
+        based on. total_cells and valid_cells are counted over the same periods, so the difference between them
+        is what the region filtering saves.
+    """
+    if not isinstance(history, dict):
+        history = throughput_history(history, ssb_table.table_id)
+    ssb_table.prefetch()
+    if ssb_table.table_region != None:
+        timer = time.time()
+        ssb_table.klass.load()
+        add_seconds(ssb_table.stats, "klass", time.time() - timer)
+    iterations = calc_iterations(ssb_table)
+    meta_data = meta_filter(ssb_table, iterations)
+    valid_cells = sum(chunk_rows(variables) for variables in meta_data)
+    periods = []
+    total_cells = ssb_table.table_total_size
+    if ssb_table.table_tid is not None:
+        tid_dimension = ssb_table.dimensions[ssb_table.table_tid]
+        periods = tid_dimension.codes[planned_periods(ssb_table, iterations)].tolist()
+        total_cells = total_cells // max(1, len(tid_dimension)) * len(periods)
+    return {"table_id": ssb_table.table_id,
+            "periods": periods,
+            "total_cells": total_cells,
+            "valid_cells": valid_cells,
+            "table_cells": ssb_table.table_total_size,
+            "requests": len(meta_data),
+            "bytes": int(round(valid_cells * history["bytes_per_cell"])),
+            "seconds": len(meta_data) * request_pause + valid_cells * history["seconds_per_cell"],
+            "throughput": history}
+
+
+def compare_formats(ssb_table, formats=None, chunks=1):
+    """ Measures which response format is fastest end to end for a table.
+
+    The first chunks of the plan from meta_filter are fetched in every format, and the time to fetch and
+    parse them, and the bytes before and after decompression, are measured. Every format is checked against
+    the DataFrame pyjstat gives for json-stat2, a format that doesnt give the same rows is never the fastest.
+
+    Parameters:
+    -----------
+    ssb_table : SSBTable
+        The table we are measuring.
+    formats : list/None
+        The formats to measure, None measures every format in response_formats.
+    chunks : int
+        Number of chunks to fetch in each format.
+
+    Returns:
+    --------
+    result : dict
+        fastest : the fastest format, and formats : seconds, bytes, wire_bytes, rows and same per format.
+    """
+    formats = formats or response_formats
+    ssb_table.prefetch()
+    if ssb_table.table_region != None:
+        ssb_table.klass.load()
+    meta_data = meta_filter(ssb_table, calc_iterations(ssb_table))[:chunks]
+    measured = []
+    reference = None
+    for response_format in ["json-stat2"] + [f for f in formats if f != "json-stat2"]:
+        stats = new_stats()
+        dataframes = []
+        for variables in meta_data:
+            timer = time.time()
+            data = http_post(ssb_table.metadata_url, json=build_query(variables, response_format=response_format))
+            count_response(stats, data)
+            if response_format == "json-stat2":
+                dataframe = pyjstat.from_json_stat(data.json(object_pairs_hook=OrderedDict), naming="id")[0]
+            else:
+                dataframe = response_parsers[response_format](data.content, variables)
+            add_seconds(stats, "total", time.time() - timer)
+            dataframes.append(dataframe)
+            time.sleep(0.0 if replaying() else request_pause)
+        result = pd.concat(dataframes, ignore_index=True) if dataframes else None
+        if reference is None:
+            reference = result
+        same = result is not None and list(result.columns) == list(reference.columns) \
+            and result.drop(columns="value").astype(str).equals(reference.drop(columns="value").astype(str)) \
+            and np.allclose(result["value"], reference["value"], equal_nan=True)
+        if response_format in formats:
+            measured.append({"format": response_format, "seconds": stats["seconds"].get("total", 0.0),
+                             "bytes": stats["bytes"], "wire_bytes": stats["wire_bytes"],
+                             "rows": 0 if result is None else len(result), "same": bool(same)})
+    candidates = [m for m in measured if m["same"]] or measured
+    return {"table_id": ssb_table.table_id, "fastest": min(candidates, key=lambda m: m["seconds"])["format"],
+            "formats": measured}
+
+
+def best_format(out, table_id):
+    """ The fastest format compare_formats found for the table, json-stat2 if it hasnt been measured. """
+    path = os.path.join(out, table_id + ".formats.json")
+    if not os.path.exists(path):
+        return "json-stat2"
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["fastest"]
+
+
+# Sekunder en tabell venter på at en annen tabell er ferdig lastet inn i asss.sqlite, med --jobs lastes en av gangen
+sqlite_timeout = 3600
+
+
+def make_sink(sink_type, out, table_id):
+    """ Creates the sink the command line writes a table to.
+
+    Parameters:
+    -----------
+    sink_type : str
+        "dataset", "merge", "sqlite" or "csv". csv doesnt use a sink and returns None.
+    out : str
+        The output directory.
+    table_id : str
+        The table that is written.
+
+    Returns:
+    --------
+    sink : PartitionedDatasetSink/SQLiteMergeSink/SQLTableSink/None
+    """
+    if sink_type == "dataset":
+        return PartitionedDatasetSink(out, table_id)
+    if sink_type == "merge":
+        return SQLiteMergeSink(sqlite3.connect(os.path.join(out, "asss.sqlite"), timeout=sqlite_timeout),
+                               "t" + table_id)
+    if sink_type == "sqlite":
+        return SQLTableSink(sqlite3.connect(os.path.join(out, "asss.sqlite"), timeout=sqlite_timeout),
+                            "t" + table_id, staging=True)
+    return None
+
+
+def fetch_table(table_id, metadata_filter, out, sink_type, response_format="json-stat2", sparse=False,
+                profile=None, deterministic=False, ssb_table=None):
+    """ Fetches one table for the command line and writes a JSON report next to the result.
+
+    Parameters:
+    -----------
+    table_id : str
+        Table number thats used to query against correct ssb table.
+    metadata_filter : str/None
+        Filter string, see SSBTable.filters_as_dict.
+    out : str
+        The output directory.
+    sink_type : str
+        See make_sink.
+    response_format : str
+        One of response_formats, or "auto" to use the fastest format the formats command has measured.
+    sparse : bool/str
+        See post_query, with csv the rows without a value are dropped.
+    profile : str/None
+        A directory to write a profile of the run to, see Profiler.
+    deterministic : bool
+        Profile with cProfile as well as the sampler.
+    ssb_table : SSBTable/None
+        The table, if main has already created (and prefetched) it, otherwise it is created here.
+
+    Returns:
+    --------
+    report : dict
+        Status, timings per stage, number of requests, bytes and rows for the table.
+    """
+    if response_format == "auto":
+        response_format = best_format(out, table_id)
+    report = {"table_id": table_id, "filter": metadata_filter, "sink": sink_type, "format": response_format,
+              "status": "ok", "started": datetime.now().isoformat(timespec="seconds")}
+    timer = time.time()
+    if ssb_table is None:
+        ssb_table = SSBTable(table_id, metadata_filter)
+    sink = None
+    profiler = Profiler(table_id, profile, deterministic=deterministic) if profile else None
+    try:
+        sink = make_sink(sink_type, out, table_id)
+        result = post_query(ssb_table, sink, response_format=response_format, sparse=sparse, profile=profiler)
+        if sink is None:
+            if sparse:
+                result = sparse_result(result, sparse, drop_missing=True)
+            result.to_csv(os.path.join(out, table_id + ".csv"), index=False)
+        else:
+            report["result"] = {key: (value.item() if hasattr(value, "item") else value)
+                                for key, value in result.iloc[0].items()}
+    except Exception as e:
+        report["status"] = "error"
+        report["error"] = repr(e)
+        print("Feil i tabell", table_id + ":", repr(e))
+    finally:
+        if sink is not None and hasattr(sink, "connection"):
+            sink.connection.close()
+    report["seconds"] = dict(ssb_table.stats["seconds"], total=time.time() - timer)
+    report["requests"] = ssb_table.stats["requests"]
+    report["bytes"] = ssb_table.stats["bytes"]
+    report["wire_bytes"] = ssb_table.stats["wire_bytes"]
+    report["rows"] = ssb_table.stats["rows"]
+    if ssb_table._klass is not None:
+        report["klass"] = ssb_table._klass.stats
+    if profiler is not None:
+        report["profile"] = profiler.files
+    with open(os.path.join(out, table_id + ".report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def main(argv=None):
+    """ Command line entry point, e.g. asss-hent fetch 12367 07459 --jobs 4 --out dir/
+
+    Every table is fetched with post_query, the tables are run in parallel with --jobs threads and
+    share the KLASS classifications. When a table starts, the metadata and KLASS of the table that starts after
+    it are prefetched, so they have arrived when a thread is free for it. A report per table and a report.json
+    for the whole run are written to --out.
+
+    Returns:
+    --------
+    exit_code : int
+        0 if every table was fetched, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(prog="asss-hent", description="Henter tabeller fra SSB sitt API.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    fetch = commands.add_parser("fetch", help="Hent en eller flere tabeller.")
+    fetch.add_argument("tables", nargs="+", help="Tabellnummer, f.eks 12367.")
+    fetch.add_argument("--filter", default=None, help="Filter, f.eks \"ContentsCode=A&Region!=EAK\".")
+    fetch.add_argument("--jobs", type=int, default=1, help="Antall tabeller som hentes samtidig.")
+    fetch.add_argument("--out", required=True, help="Mappen resultatet og rapportene skrives til.")
+    fetch.add_argument("--sink", choices=["dataset", "merge", "sqlite", "csv"], default="dataset",
+                       help="Hvordan resultatet skrives, se make_sink.")
+    fetch.add_argument("--format", choices=response_formats + ["auto"], default="json-stat2",
+                       help="Svarformatet fra SSB, auto bruker det raskeste formats kommandoen har målt.")
+    fetch.add_argument("--sparse", choices=["off", "auto", "on"], default="off",
+                       help="Dropp cellene uten verdi, auto gjør det bare når minst halvparten er tomme.")
+    fetch.add_argument("--profile", default=None,
+                       help="Profiler hver tabell og skriv flamegraph/speedscope filer og de tregeste funksjonene hit.")
+    fetch.add_argument("--deterministic", action="store_true",
+                       help="Profiler også med cProfile og skriv <tabell>.prof, krever --jobs 1.")
+    archive = fetch.add_mutually_exclusive_group()
+    archive.add_argument("--archive", default=None, help="Lagre alle svarene fra SSB i denne mappen.")
+    archive.add_argument("--replay", default=None, help="Les svarene fra et arkiv i stedet for fra SSB.")
+    formats = commands.add_parser("formats", help="Mål hvilket svarformat som er raskest for hver tabell.")
+    formats.add_argument("tables", nargs="+", help="Tabellnummer, f.eks 12367.")
+    formats.add_argument("--filter", default=None, help="Filter, f.eks \"ContentsCode=A&Region!=EAK\".")
+    formats.add_argument("--out", required=True, help="Mappen <tabell>.formats.json skrives til.")
+    cost = commands.add_parser("estimate", help="Anslå hvor mye det koster å hente tabellene, uten å hente data.")
+    cost.add_argument("tables", nargs="+", help="Tabellnummer, f.eks 12367.")
+    cost.add_argument("--filter", default=None, help="Filter, f.eks \"ContentsCode=A&Region!=EAK\".")
+    cost.add_argument("--history", default=None, help="Mappen med rapporter fra tidligere kjøringer (--out).")
+    cost.add_argument("--window", type=float, default=None,
+                      help="Tidsvinduet i sekunder, tabeller som ikke blir ferdige innenfor det gir exit code 1.")
+    args = parser.parse_args(argv)
+
+    if args.command == "estimate":
+        estimates = [estimate(SSBTable(table_id, args.filter), args.history) for table_id in args.tables]
+        print(json.dumps(estimates, ensure_ascii=False, indent=2))
+        total = sum(e["seconds"] for e in estimates)
+        print("Totalt", sum(e["requests"] for e in estimates), "spørringer,",
+              sum(e["valid_cells"] for e in estimates), "rader, {:.0f}s".format(total))
+        return 0 if args.window is None or total <= args.window else 1
+
+    os.makedirs(args.out, exist_ok=True)
+    if args.command == "formats":
+        for table_id in args.tables:
+            result = compare_formats(SSBTable(table_id, args.filter))
+            with open(os.path.join(args.out, table_id + ".formats.json"), "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+            for measured in result["formats"]:
+                print(table_id, measured["format"], "{:.2f}s".format(measured["seconds"]), measured["wire_bytes"],
+                      "bytes", "" if measured["same"] else "ULIK")
+            print(table_id, "raskest:", result["fastest"])
+        return 0
+
+    if args.deterministic and (args.profile is None or args.jobs > 1):
+        parser.error("--deterministic krever --profile og --jobs 1")
+    use_archive(args.replay or args.archive, replay=args.replay is not None)
+    sparse = {"off": False, "auto": "auto", "on": True}[args.sparse]
+    chunk_sizes_path = os.path.join(args.out, "chunk_sizes.json")
+    load_chunk_sizes(chunk_sizes_path)
+    timer = time.time()
+    jobs = max(1, args.jobs)
+    ssb_tables = [SSBTable(table_id, args.filter) for table_id in args.tables]
+
+    def run(i):
+        # Tabellen som startes når denne er ferdig hentes metadata og KLASS for mens denne hentes
+        if i + jobs < len(ssb_tables):
+            ssb_tables[i + jobs].prefetch()
+        return fetch_table(args.tables[i], args.filter, args.out, args.sink, args.format, sparse, args.profile,
+                           args.deterministic, ssb_tables[i])
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        reports = list(pool.map(run, range(len(ssb_tables))))
+    save_chunk_sizes(chunk_sizes_path)
+    run_report = {"seconds": time.time() - timer, "jobs": args.jobs, "tables": reports}
+    with open(os.path.join(args.out, "report.json"), "w", encoding="utf-8") as f:
+        json.dump(run_report, f, ensure_ascii=False, indent=2)
+
+    for report in reports:
+        print(report["table_id"], report["status"], "{:.1f}s".format(report["seconds"]["total"]),
+              report["requests"], "spørringer", report["bytes"], "bytes", report["rows"], "rader")
+    return 0 if all(report["status"] == "ok" for report in reports) else 1
+
+
+# TabellNummer og Filter blir satt av SQL Server sin external_script, uten dem kan filen importeres uten å hente noe
+# Med MaalTabell og Tilkobling (ODBC connection string) lastes resultatet rett inn i MaalTabell,
+# r blir da bare en oppsummering av hvor mange rader som ble lastet
+if "TabellNummer" in globals():
+    ssb_table = SSBTable(TabellNummer, globals().get("Filter"))
+    if globals().get("MaalTabell"):
+        import pyodbc
+        sink = SQLTableSink(pyodbc.connect(Tilkobling), MaalTabell, staging=True)
+        r = post_query(ssb_table, sink)
+    else:
+        r = post_query(ssb_table, categorical=False)
+elif __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -6,9 +6,41 @@ import time
 import copy
 import re
 import json
+import os
 from datetime import datetime
 import multiprocessing
 import signal
+import threading
+import queue
+import sys
+import ctypes
+import importlib.util
+import numpy as np
+
+
+try:
+    skript_dir = os.path.dirname(os.path.abspath(__file__))
+except NameError:
+    # SQL Server sin external_script har ikke __file__
+    skript_dir = os.getcwd()
+
+
+def last_meta_filter():
+    """ Laster Meta Filter AlleAar.py som modul, filnavnet har mellomrom så den kan ikke importeres med navn.
+
+    Reglene for gyldige regioner (region_rules), KLASS regionene (RegionKLASS) og arkivet alle spørringer går
+    gjennom (http_get, http_post og use_archive) deles med Meta Filter AlleAar i stedet for å kopieres.
+    """
+    if "meta_filter_alleaar" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("meta_filter_alleaar",
+                                                      os.path.join(skript_dir, "Meta Filter AlleAar.py"))
+        modul = importlib.util.module_from_spec(spec)
+        sys.modules["meta_filter_alleaar"] = modul
+        spec.loader.exec_module(modul)
+    return sys.modules["meta_filter_alleaar"]
+
+
+meta = last_meta_filter()
 
 
 class SSBTable:
@@ -107,7 +139,7 @@ class SSBTable:
             Returnerer enten rå metadata eller filtrerte metadataen.
         """
         filtered_variables = []
-        ssb_table_metadata = requests.get(self.metadata_url).json()
+        ssb_table_metadata = meta.http_get(self.metadata_url).json()
         if (metadata_filter != None):
             filtered_variables = self.filter_json_metadata(
                 ssb_table_metadata, self.filters_as_dict(self.metadata_filter))
@@ -169,65 +201,15 @@ class SSBTable:
                 table_size *= len(var["values"])
         return table_region, table_tid, table_size
 
-class RegionKLASS:
-    def __init__(self, klass_id):
-        self.klass_id = klass_id
-        self.to_date = time.localtime(time.time()).tm_year
-        self.from_date = self.to_date - 5
-        self.klass_variables = self.get_klass_variables()
-        self.filtered_klass_variables = self.filter_klass_variables()
-        self.filtered_regions = self.filter_regions()
-
-    def region_klass_url(self, i):
-        url = "http://data.ssb.no/api/klass/v1/classifications/" + i + "/codes?from=" + \
-            str(self.from_date) + "-01-01&to=2059-01-01&includeFuture=true"
-        return url
-
-    def get_klass_variables(self):
-        all_klass_data = []
-        for i in self.klass_id:
-            headers = {"Accept": "application/json", "charset": "UTF-8"}
-            response = requests.get(self.region_klass_url(i), headers=headers)
-            data = response.text
-
-            if ("?" in response.text):
-                data = response.text.replace("?", "š")
-            all_klass_data.append(data)
-        return all_klass_data
-
-    def filter_klass_variables(self):
-        regioner = []
-        for klass_id in self.klass_variables:
-            json_array = json.loads(klass_id)["codes"]
-
-            for item in json_array:
-                regioner_details = {"code": None,
-                                    "validFrom": None, "validTo": None}
-                regioner_details["code"] = item["code"]
-                datetime_object = datetime.strptime(
-                    item["validFromInRequestedRange"], "%Y-%m-%d")
-                regioner_details["validFrom"] = str(datetime_object.year)
-                datetime_object = datetime.strptime(
-                    item["validToInRequestedRange"], "%Y-%m-%d")
-                regioner_details["validTo"] = str(datetime_object.year)
-                regioner.append(regioner_details)
-        return regioner
-
-    def filter_regions(self):
-        filtered_regions_klass = {}
-        for regions in self.filtered_klass_variables:
-            try:
-                a = filtered_regions_klass[regions["code"]]
-                if regions["validFrom"] < filtered_regions_klass[regions["code"]]["validFrom"]:
-                    filtered_regions_klass[regions["code"]
-                                           ]["validFrom"] = regions["validFrom"]
-                else:
-                    filtered_regions_klass[regions["code"]
-                                           ]["validTo"] = regions["validTo"]
-            except KeyError:
-                filtered_regions_klass[regions["code"]] = regions
-        return filtered_regions_klass
+def region_klass(klass_id, from_date=None):
+    """ KLASS regionene for de siste fem årene, eller fra from_date, delt med Meta Filter AlleAar.
 
+    Klassifikasjonene hentes og slås sammen av meta.RegionKLASS (samtidig, alltid som UTF-8, og med
+    intervallene slått sammen), og deles med alle tabeller med samme from date, se meta.shared_region_klass.
+    """
+    if from_date is None:
+        from_date = time.localtime(time.time()).tm_year - 5
+    return meta.shared_region_klass(klass_id, from_date=from_date).load()
 
 
 def build_query(variables, _filter="item"):
@@ -259,72 +241,474 @@ def build_query(variables, _filter="item"):
 
 def meta_filter():
     metadata_filter = []
-    
-    for year in ssb_table.variables["variables"][ssb_table.table_tid]["values"]:
+    regioner = ssb_table.variables["variables"][ssb_table.table_region]["values"]
+    årstall = ssb_table.variables["variables"][ssb_table.table_tid]["values"]
+    # Hvilke regioner som er gyldige hvert år avgjøres av reglene i Meta Filter AlleAar (se load_region_rules),
+    # regionene i always tas alltid med, uten å telle mot ssb_max_row_query
+    gyldige = meta.region_rules.validity(regioner, [int(year) for year in årstall], klass.filtered_regions)
+    alltid = meta.region_rules.always_mask(regioner)
+
+    for year, gyldig in zip(årstall, gyldige):
         new_meta_var = copy.deepcopy(ssb_table.variables["variables"])
         new_meta_regions = []
-        for region in ssb_table.variables["variables"][ssb_table.table_region]["values"]:
-            if region in {"0", "EAK", "EAKUO"}:
+        for region, er_gyldig, er_alltid in zip(regioner, gyldig, alltid):
+            if er_alltid:
                 new_meta_regions.append(region)
-            elif region in klass.filtered_regions.keys():
-                valid_from = int(klass.filtered_regions[region]["validFrom"])
-                valid_to = int(klass.filtered_regions[region]["validTo"])
-                if int(year) in range(valid_from, valid_to):
-                    if (ssb_table.table_size * (len(new_meta_regions) + 1)) < ssb_table.ssb_max_row_query:
-                        new_meta_regions.append(region)
-                    else:
-                        new_meta_var[ssb_table.table_region]["values"] = new_meta_regions
-                        new_meta_var[ssb_table.table_tid]["values"] = [year]
-                        metadata_filter.append(new_meta_var)
-                        new_meta_regions = []
-                        new_meta_regions.append(region)
-                        new_meta_var = copy.deepcopy(
-                            ssb_table.variables["variables"])
+            elif er_gyldig:
+                if (ssb_table.table_size * (len(new_meta_regions) + 1)) < ssb_table.ssb_max_row_query:
+                    new_meta_regions.append(region)
+                else:
+                    new_meta_var[ssb_table.table_region]["values"] = new_meta_regions
+                    new_meta_var[ssb_table.table_tid]["values"] = [year]
+                    metadata_filter.append(new_meta_var)
+                    new_meta_regions = []
+                    new_meta_regions.append(region)
+                    new_meta_var = copy.deepcopy(
+                        ssb_table.variables["variables"])
         new_meta_var[ssb_table.table_region]["values"] = new_meta_regions
         new_meta_var[ssb_table.table_tid]["values"] = [year]
         metadata_filter.append(new_meta_var)
 
     return metadata_filter
 
-def run_pyjstat(result_list):
-    return pyjstat.from_json_stat(result_list.json(object_pairs_hook=OrderedDict), naming="id")[0]
-    
+class MinneBudsjett:
+    """
+    Holder styr på hvor mange bytes som er under behandling i pipeline(), og stopper
+    henting av nye deler når minne_grense er nådd (backpressure).
+
+    Det som telles er svaret fra SSB slik det kommer over nettet. Blokkene delene dekodes inn i lages før
+    hentingen starter og telles ikke: uten sink er det én blokk for hele resultatet, og med sink et fast antall
+    blokker (kø_størrelse + 2) som gjenbrukes. Heller ikke JSON-en prosessene parser svaret til telles,
+    den finnes bare mens en del dekodes.
+
+    Attributes:
+    -----------
+    minne_grense : int
+        Største antall bytes som kan være hentet, men ikke skrevet til sink enda.
+    i_bruk : int
+        Antall bytes som er reservert nå.
+    avbrutt : bool
+        True etter avbryt(), da venter ingen lenger på plass.
+    """
+
+    def __init__(self, minne_grense):
+        self.minne_grense = minne_grense
+        self.i_bruk = 0
+        self.avbrutt = False
+        self.condition = threading.Condition()
+
+    def reserver(self, antall_bytes, timeout=0.5):
+        """
+        Venter til det er plass til antall_bytes under minne_grense og reserverer dem.
+        En del som er større enn hele grensen slippes gjennom når ingenting annet er i bruk,
+        ellers ville den ventet for alltid. Venter i biter på timeout sekunder, så en avbrutt
+        pipeline aldri blir hengende her.
+
+        Returns:
+        --------
+        reservert : bool
+            False hvis budsjettet er avbrutt, da er ingenting reservert.
+        """
+        with self.condition:
+            while not self.avbrutt and self.i_bruk > 0 and self.i_bruk + antall_bytes > self.minne_grense:
+                self.condition.wait(timeout)
+            if self.avbrutt:
+                return False
+            self.i_bruk += antall_bytes
+            return True
+
+    def juster(self, reservert, faktisk):
+        """ Bytter ut et estimat med den faktiske størrelsen etter at svaret er hentet. """
+        with self.condition:
+            self.i_bruk += faktisk - reservert
+            self.condition.notify_all()
+
+    def frigi(self, antall_bytes):
+        with self.condition:
+            self.i_bruk -= antall_bytes
+            self.condition.notify_all()
+
+    def avbryt(self):
+        """ Slipper alle som venter i reserver, og nekter nye reservasjoner. """
+        with self.condition:
+            self.avbrutt = True
+            self.condition.notify_all()
+
+
+def legg_i_kø(kø, element, stopp, timeout=0.1):
+    """ Legger element i kø, men gir opp når stopp er satt, så ingen tråd henger på en full kø etter en feil. """
+    while not stopp.is_set():
+        try:
+            kø.put(element, timeout=timeout)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def ta_fra_kø(kø, stopp, timeout=0.1):
+    """ Tar neste element fra kø, eller None når stopp er satt. """
+    while not stopp.is_set():
+        try:
+            return kø.get(timeout=timeout)
+        except queue.Empty:
+            pass
+    return None
+
+
+def tøm_kø(kø):
+    """ Tar ut alt som ligger i kø uten å vente. """
+    elementer = []
+    while True:
+        try:
+            elementer.append(kø.get_nowait())
+        except queue.Empty:
+            return elementer
+
+
+def vent_på(oppgave, stopp, timeout=0.1):
+    """ Resultatet av en oppgave fra pool.apply_async, eller RuntimeError hvis pipelinen stoppes mens vi venter. """
+    while not oppgave.ready():
+        if stopp.is_set():
+            raise RuntimeError("Pipelinen ble stoppet")
+        oppgave.wait(timeout)
+    return oppgave.get()
+
+
+class DeltBlokk:
+    """
+    En blokk i delt minne (multiprocessing.RawArray) med kodene til hver dimensjon og verdiene
+    for et antall rader. Prosessene som dekoder skriver rett inn i blokken, og master lager DataFrame
+    rett oppå den, så resultatet blir aldri picklet tilbake fra prosessene.
+
+    Blokkene lages før prosessene startes og sendes med når de startes (initargs), så prosessene arver
+    det samme minnet. Minnet eies av RawArray, og alle numpy views (og DataFrame-ene oppå dem) holder det
+    i live, så en blokk forsvinner når det siste som bruker den gjør det, uten close eller unlink.
 
-def post_query():    
-    meta_data = meta_filter()
-    result_list = []
+    Attributes:
+    -----------
+    dimensjoner : list
+        (kode, verdier) for hver dimensjon i tabellen, verdiene blir kategoriene i kolonnen.
+    rader : int
+        Antall rader blokken har plass til.
+    størrelse : int
+        Antall bytes i blokken.
+    minne : ctypes array
+        Selve blokken, en multiprocessing.RawArray.
+    """
+
+    def __init__(self, dimensjoner, rader, minne=None):
+        self.dimensjoner = dimensjoner
+        self.rader = rader
+        self.typer, self.posisjoner, self.verdi_posisjon, self.størrelse = self.utlegg(dimensjoner, rader)
+        if minne is None:
+            minne = multiprocessing.RawArray(ctypes.c_char, max(1, self.størrelse))
+        self.minne = minne
+
+    @staticmethod
+    def utlegg(dimensjoner, rader):
+        """ Kodetypene, hvor kodene til hver dimensjon og verdiene starter, og antall bytes i en blokk. """
+        typer = [kode_type(len(verdier)) for kode, verdier in dimensjoner]
+        posisjoner = []
+        posisjon = 0
+        for kode_dtype in typer:
+            posisjoner.append(posisjon)
+            posisjon += -(-rader * np.dtype(kode_dtype).itemsize // 8) * 8
+        return typer, posisjoner, posisjon, posisjon + rader * 8
+
+    def koder(self, idx):
+        """ Kodene til dimensjon nummer idx, som et numpy array oppå blokken. """
+        return np.frombuffer(self.minne, dtype=self.typer[idx], count=self.rader, offset=self.posisjoner[idx])
+
+    def verdier(self):
+        """ Verdiene, som et numpy array oppå blokken. """
+        return np.frombuffer(self.minne, dtype=np.float64, count=self.rader, offset=self.verdi_posisjon)
+
+    def skriv(self, json_stat, start, planlagt, indekser):
+        """
+        Skriver et json-stat2 svar inn i radene fra og med start. Verdiene ligger i rad-major rekkefølge
+        over dimensjonene i json_stat["id"], så kodene skrives ved å kringkaste posisjonene til hver
+        dimensjon over et view av radene.
+
+        Svaret må ha like mange rader som delen ble planlagt med, ellers ville resultatet fått hull
+        (eller skrevet over neste del), så da kastes ValueError.
+
+        Returns:
+        --------
+        rader : int
+            Antall rader som ble skrevet.
+        """
+        størrelser = [int(størrelse) for størrelse in json_stat["size"]]
+        rader = int(np.prod(størrelser, dtype=np.int64))
+        if rader != planlagt:
+            raise ValueError("Svaret fra SSB har {} rader, men delen er planlagt med {}.".format(rader, planlagt))
+        if start + rader > self.rader:
+            raise ValueError("Delen får ikke plass i blokken ({} > {}).".format(start + rader, self.rader))
+        dimensjon_idx = {kode: idx for idx, (kode, verdier) in enumerate(self.dimensjoner)}
+        for d_idx, kode in enumerate(json_stat["id"]):
+            indeks = json_stat["dimension"][kode]["category"]["index"]
+            kategorier = sorted(indeks, key=indeks.get) if isinstance(indeks, dict) else list(indeks)
+            idx = dimensjon_idx[kode]
+            posisjoner = np.array([indekser[kode][kategori] for kategori in kategorier], dtype=self.typer[idx])
+            form = [1] * len(størrelser)
+            form[d_idx] = størrelser[d_idx]
+            self.koder(idx)[start:start + rader].reshape(størrelser)[...] = posisjoner.reshape(form)
+        verdi = json_stat["value"]
+        if isinstance(verdi, dict):
+            verdier = self.verdier()
+            verdier[start:start + rader] = np.nan
+            for idx, val in verdi.items():
+                verdier[start + int(idx)] = np.nan if val is None else val
+        else:
+            self.verdier()[start:start + rader] = np.array(verdi, dtype=float)
+        return rader
+
+    def dataframe(self, rader=None):
+        """ Lager en DataFrame oppå blokken uten å kopiere, med kategoriske kolonner og en value kolonne. """
+        rader = self.rader if rader is None else rader
+        kolonner = {}
+        for idx, (kode, verdier) in enumerate(self.dimensjoner):
+            kolonner[kode] = pd.Categorical.from_codes(self.koder(idx)[:rader], dtype=pd.CategoricalDtype(verdier))
+        kolonner["value"] = self.verdier()[:rader]
+        return pd.DataFrame(kolonner, copy=False)
 
-    timer_for = time.time()
-    for variables in meta_data:
-        query = build_query(variables)
-        data = requests.post(ssb_table.metadata_url, json=query)
-        result_list.append(data)
-        time.sleep(5.0)
-        print(data)
-    print("FOR LOOP: ", time.time() - timer_for)
-    return result_list
 
+def kode_type(kategorier):
+    """ Den minste heltallstypen pandas bruker for kodene til en kategorisk kolonne med så mange kategorier. """
+    if kategorier < np.iinfo(np.int8).max:
+        return np.int8
+    if kategorier < np.iinfo(np.int16).max:
+        return np.int16
+    return np.int32
+
+
+def dekod_til_delt_minne(innhold, blokk_nr, start, planlagt):
+    """
+    Parser et JSON-Stat svar og skriver kodene og verdiene rett inn i blokk nummer blokk_nr, kjøres i en egen prosess.
+    Bare de rå bytene sendes inn og antall rader sendes tilbake, ingenting annet blir picklet.
+    """
+    return worker_blokker[blokk_nr].skriv(json.loads(innhold, object_pairs_hook=OrderedDict), start, planlagt,
+                                          worker_indekser)
 
-def worker():
+
+def antall_rader(query):
+    """ Antall rader en spørring fra build_query gir. """
+    rader = 1
+    for var in query["query"]:
+        rader *= len(var["selection"]["values"])
+    return rader
+
+
+def estimer_bytes(rader, bytes_per_celle=12):
+    """ Estimerer størrelsen på svaret før det er hentet, ut fra antall celler i spørringen. """
+    return max(1, rader) * bytes_per_celle
+
+
+def pipeline(meta_data, sink=None, minne_grense=512 * 1024 ** 2, kø_størrelse=4, prosesser=None, pause=5.0):
+    """
+    Henter, parser og dekoder delene i meta_data i en pipeline med begrensede køer imellom:
+    hent (tråd) -> parse og dekod (prosesser) -> sink (denne tråden).
+
+    Hver del reserverer plass i et MinneBudsjett før den hentes, og plassen frigis først når den dekodede
+    delen er skrevet til sink. Når minne_grense er nådd venter hentingen til sink har tatt unna,
+    så alle svarene ligger aldri i minnet samtidig.
+
+    Prosessene skriver resultatet rett inn i delt minne (DeltBlokk) og sender bare tilbake antall rader.
+    Uten sink lages én blokk for hele resultatet, siden antall rader er kjent fra spørringene, og hver del
+    skrives inn på sin plass. DataFrame-en som returneres ligger oppå blokken og holder den i live.
+    Med sink lages kø_størrelse + 2 blokker med plass til den største delen, og hver del dekodes inn i en ledig
+    blokk som blir ledig igjen når delen er skrevet. DataFrame-en sink får ligger oppå blokken, så den er bare
+    gyldig under write, en sink som vil beholde den må kopiere den.
+    Et svar med et annet antall rader enn delen er planlagt med gir ValueError, så resultatet får aldri hull.
+
+    Går noe galt i et av stegene (et svar fra SSB som ikke er 200, en feil i dekodingen eller i sink) settes
+    et stopp-flagg som alle stegene sjekker mens de venter, prosessene termineres, det som ligger i køene
+    frigis, sink.abort() kalles, og feilen kastes videre. Ingenting blir hengende og vente på en annen tråd.
+
+    Parameters:
+    -----------
+    meta_data : list
+        Listen fra meta_filter().
+    sink : object/None
+        Noe med write(dataframe) og abort(). Uten sink returneres alle delene som én DataFrame.
+    minne_grense : int
+        Største antall bytes fra SSB som kan være under behandling samtidig.
+    kø_størrelse : int
+        Største antall deler som kan vente mellom hvert steg.
+    prosesser : int/None
+        Antall prosesser som dekoder, standard er antall kjerner.
+    pause : float
+        Sekunder mellom hver spørring mot SSB.
+
+    Returns:
+    --------
+    big_df : DataFrame/None
+        Alle delene med kategoriske kolonner, eller None hvis de er skrevet til sink.
+    """
+    dimensjoner = [(var["code"], var["values"]) for var in ssb_table.variables["variables"]]
+    spørringer = [build_query(variables) for variables in meta_data]
+    rader = [antall_rader(query) for query in spørringer]
+    resultat = None
+    if sink is None:
+        resultat = DeltBlokk(dimensjoner, sum(rader))
+        blokker = [resultat]
+    else:
+        blokker = [DeltBlokk(dimensjoner, max(rader, default=0)) for _ in range(kø_størrelse + 2)]
+    ledige = queue.Queue()
+    for blokk_nr in range(len(blokker)):
+        ledige.put(blokk_nr)
+
+    budsjett = MinneBudsjett(minne_grense)
+    hentet = queue.Queue(maxsize=kø_størrelse)
+    dekodet = queue.Queue(maxsize=kø_størrelse)
+    stopp = threading.Event()
+    feil = []
+    pool = multiprocessing.Pool(processes=prosesser or multiprocessing.cpu_count(), initializer=worker,
+                                initargs=(dimensjoner, [(blokk.rader, blokk.minne) for blokk in blokker]))
+
+    def stopp_med(e):
+        feil.append(e)
+        stopp.set()
+        budsjett.avbryt()
+
+    def hent():
+        try:
+            start = 0
+            for del_nr, (query, del_rader) in enumerate(zip(spørringer, rader)):
+                estimat = estimer_bytes(del_rader)
+                if not budsjett.reserver(estimat):
+                    return
+                data = meta.http_post(ssb_table.metadata_url, json=query)
+                if data.status_code != 200:
+                    budsjett.frigi(estimat)
+                    raise RuntimeError("Feil fra SSB for del {} av {}, status kode: {}".format(
+                        del_nr + 1, len(spørringer), data.status_code))
+                budsjett.juster(estimat, len(data.content))
+                if not legg_i_kø(hentet, (data.content, len(data.content), del_rader, start), stopp):
+                    budsjett.frigi(len(data.content))
+                    return
+                start += del_rader
+                if stopp.wait(pause):
+                    return
+        except Exception as e:
+            stopp_med(e)
+        finally:
+            legg_i_kø(hentet, None, stopp)
+
+    def dekod():
+        try:
+            while True:
+                del_ = ta_fra_kø(hentet, stopp)
+                if del_ is None:
+                    break
+                innhold, størrelse, del_rader, start = del_
+                if resultat is None:
+                    blokk_nr = ta_fra_kø(ledige, stopp)
+                    if blokk_nr is None:
+                        budsjett.frigi(størrelse)
+                        break
+                    oppgave = pool.apply_async(dekod_til_delt_minne, (innhold, blokk_nr, 0, del_rader))
+                else:
+                    blokk_nr = None
+                    oppgave = pool.apply_async(dekod_til_delt_minne, (innhold, 0, start, del_rader))
+                if not legg_i_kø(dekodet, (oppgave, størrelse, blokk_nr, del_rader), stopp):
+                    frigi_del(størrelse, blokk_nr)
+                    break
+        except Exception as e:
+            stopp_med(e)
+        finally:
+            legg_i_kø(dekodet, None, stopp)
+
+    def frigi_del(størrelse, blokk_nr=None):
+        if blokk_nr is not None:
+            ledige.put(blokk_nr)
+        budsjett.frigi(størrelse)
+
+    def tøm_køene():
+        for del_ in tøm_kø(hentet):
+            if del_ is not None:
+                frigi_del(del_[1])
+        for del_ in tøm_kø(dekodet):
+            if del_ is not None:
+                frigi_del(del_[1], del_[2])
+
+    # Trådene får navn etter tråden som startet dem, så meta.Profiler sampler dem sammen med master
+    navn = threading.current_thread().name
+    tråder = [threading.Thread(target=hent, name=navn + "/hent", daemon=True),
+              threading.Thread(target=dekod, name=navn + "/dekod", daemon=True)]
+    for tråd in tråder:
+        tråd.start()
+
+    skrevet = 0
+    try:
+        while True:
+            del_ = ta_fra_kø(dekodet, stopp)
+            if del_ is None:
+                break
+            oppgave, størrelse, blokk_nr, del_rader = del_
+            try:
+                skrevet += vent_på(oppgave, stopp)
+                if blokk_nr is not None:
+                    sink.write(blokker[blokk_nr].dataframe(del_rader))
+            finally:
+                frigi_del(størrelse, blokk_nr)
+        if not stopp.is_set() and skrevet != sum(rader):
+            raise RuntimeError("Skrev {} rader, men {} var planlagt.".format(skrevet, sum(rader)))
+    except Exception as e:
+        stopp_med(e)
+    finally:
+        if stopp.is_set():
+            pool.terminate()
+        else:
+            pool.close()
+        # Køene tømmes mens trådene avslutter, så ingen av dem står og venter på plass i en kø
+        while any(tråd.is_alive() for tråd in tråder):
+            tøm_køene()
+            for tråd in tråder:
+                tråd.join(0.1)
+        tøm_køene()
+        pool.join()
+        if feil and sink is not None:
+            sink.abort()
+
+    if feil:
+        raise feil[0]
+    if resultat is not None:
+        return resultat.dataframe()
+    return None
+
+
+worker_blokker = None
+worker_indekser = None
+
+
+def worker(dimensjoner=None, blokker=None):
+    """ Starter en prosess i pool, blokker er (rader, minne) for hver DeltBlokk prosessen kan skrive i. """
+    global worker_blokker, worker_indekser
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if dimensjoner is not None:
+        worker_blokker = [DeltBlokk(dimensjoner, rader, minne) for rader, minne in blokker or []]
+        worker_indekser = {kode: {verdi: idx for idx, verdi in enumerate(verdier)} for kode, verdier in dimensjoner}
+
+def master(sink=None, minne_grense=512 * 1024 ** 2, profil=None, deterministisk=False):
+    """
+    Henter tabellen i ssb_table. Med meta.use_archive(sti, replay=True) leses alt fra arkivet i Meta Filter AlleAar,
+    uten pause mellom spørringene. Med profil (en mappe) profileres kjøringen med meta.Profiler, som sampler
+    master tråden og hent/dekod trådene i pipeline. Dekodingen i worker prosessene kommer ikke med.
+    """
+    if profil is not None:
+        with meta.Profiler(ssb_table.table_id, profil, deterministic=deterministisk):
+            return master(sink, minne_grense)
 
-def master():
-    dataframes = []
-    timer2 = time.time()
-    x = post_query()
     timer = time.time()
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-    dataframes = pool.map(run_pyjstat, x)
-    pool.close()
-    pool.join()
-    print("THREADS: ", time.time() - timer)
-    print("FULL QUERY: ", time.time() - timer2)
-    big_df = pd.concat(dataframes, ignore_index=True)
+    pause = 0.0 if meta.replaying() else 5.0
+    big_df = pipeline(meta_filter(), sink=sink, minne_grense=minne_grense, pause=pause)
+    print("FULL QUERY: ", time.time() - timer)
     return big_df
         
 
 if __name__ == "__main__":
     ssb_table = SSBTable("12367")
-    klass = RegionKLASS(["131", "104", "214", "231"])
+    klass = region_klass(["131", "104", "214", "231"])
     r = master()
     print(r)
\ No newline at end of file
@@ -0,0 +1,45 @@
+""" Fixtures shared by the tests. Everything SSB would answer is replayed from tests/arkiv, see lag_arkiv.py. """
+import os
+
+import pytest
+
+import skript
+
+arkiv = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arkiv")
+
+
+@pytest.fixture(scope="session")
+def meta():
+    return skript.load("meta_filter_alleaar")
+
+
+@pytest.fixture(scope="session")
+def values():
+    return skript.load("asss_ssb_alleaar_values")
+
+
+@pytest.fixture
+def replay(meta):
+    """ Replays tests/arkiv, with empty caches so every test plans from the archived responses. """
+    def clear():
+        meta.region_klass_cache.clear()
+        meta.region_validity_cache.clear()
+        meta.tuned_chunk_sizes.clear()
+
+    clear()
+    meta.use_archive(arkiv, replay=True)
+    yield arkiv
+    meta.use_archive(None)
+    clear()
+
+
+@pytest.fixture
+def table(meta, replay):
+    """ The table with a region dimension in the archive. """
+    return meta.SSBTable("12367")
+
+
+@pytest.fixture
+def metadata(meta, replay):
+    """ The archived metadata of 12367, in the JSON form SSB returns it in. """
+    return meta.http_get(meta.SSBTable("12367").metadata_url).json()
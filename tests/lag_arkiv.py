@@ -0,0 +1,253 @@
+""" Makes the response archive in tests/arkiv the tests replay, without the network.
+
+The archive is recorded through ResponseArchive like a real run with --archive, but the responses come from
+a small SSB in this file instead of ssb.no: a table with the same dimensions as 12367 (region, regnskapsomfang,
+art, statistikkvariabel and år), a monthly table without a region dimension like 03013, and the four KLASS
+classifications, with the quirks of the real API the scripts have to handle (gzip, missing values, KLASS codes
+without an end date, a name with š, two art codes with the same text).
+
+Run it again when a script changes what it asks SSB for:
+
+    python tests/lag_arkiv.py
+"""
+import copy
+import csv
+import fnmatch
+import gzip
+import io
+import itertools
+import json
+import os
+import shutil
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import skript
+
+arkiv = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arkiv")
+
+tables = {
+    "12367": {"title": "12367: Detaljerte regnskapstall driftsregnskapet, etter region, regnskapsomfang, art, "
+                       "statistikkvariabel og år",
+              "variables": [
+                  {"code": "KOKkommuneregion0000", "text": "region",
+                   "values": ["0", "EAK", "EAKUO", "0301", "1101", "1601", "5001", "3001", "3002", "3401", "2111"],
+                   "valueTexts": ["Hele landet", "Landet", "Landet uten Oslo", "Oslo", "Eigersund",
+                                  "Trondheim (-2017)", "Trondheim - Tråante", "Halden", "Moss", "Kongsvinger",
+                                  "Svalbard"],
+                   "elimination": True},
+                  {"code": "KOKregnskapsomfa0000", "text": "regnskapsomfang", "values": ["A", "B"],
+                   "valueTexts": ["Konsern", "Kommunekassen"]},
+                  {"code": "KOKart0000", "text": "art", "values": ["AG1", "AG2", "AG3", "AG4"],
+                   "valueTexts": ["Frie inntekter", "Netto driftsresultat", "Brutto driftsresultat",
+                                  "Frie inntekter"]},
+                  {"code": "ContentsCode", "text": "statistikkvariabel", "values": ["KOSbelop0000"],
+                   "valueTexts": ["Beløp (1000 kr)"]},
+                  {"code": "Tid", "text": "år", "values": [str(year) for year in range(2015, 2023)],
+                   "valueTexts": [str(year) for year in range(2015, 2023)], "time": True}]},
+    "03013": {"title": "03013: Konsumprisindeks, etter konsumgruppe, statistikkvariabel og måned",
+              "variables": [
+                  {"code": "Konsumgrp", "text": "konsumgruppe", "values": ["TOTAL", "01", "02"],
+                   "valueTexts": ["Totalindeks", "Matvarer og alkoholfrie drikkevarer",
+                                  "Alkoholholdige drikkevarer og tobakk"]},
+                  {"code": "ContentsCode", "text": "statistikkvariabel", "values": ["KpiIndMnd"],
+                   "valueTexts": ["Konsumprisindeks (2015=100)"]},
+                  {"code": "Tid", "text": "måned", "values": ["2022M%02d" % month for month in range(1, 13)],
+                   "valueTexts": ["2022M%02d" % month for month in range(1, 13)], "time": True}]}}
+
+# (kode, navn, gyldig fra, gyldig til), None som til er en kode som fortsatt er gyldig
+klass = {
+    "131": [("0301", "Oslo", "2000-01-01", None),
+            ("1101", "Eigersund", "2000-01-01", "2020-01-01"),
+            ("1101", "Eigersund", "2020-01-01", None),
+            ("1601", "Trondheim", "2000-01-01", "2018-01-01"),
+            ("5001", "Trondheim", "2018-01-01", "2020-01-01"),
+            ("5001", "Trondheim - Tråante", "2020-01-01", None),
+            ("0101", "Halden", "2000-01-01", "2020-01-01"),
+            ("3001", "Halden", "2020-01-01", None),
+            ("3002", "Moss", "2020-01-01", None),
+            ("3401", "Kongsvinger", "2020-01-01", None),
+            ("5437", "Kárášjohka - Karasjok", "2020-01-01", None)],
+    "104": [("03", "Oslo", "2000-01-01", None),
+            ("16", "Sør-Trøndelag", "2000-01-01", "2018-01-01"),
+            ("50", "Trøndelag - Trööndelage", "2018-01-01", None)],
+    "214": [("030101", "Gamle Oslo", "2004-01-01", None)],
+    "231": [("EKG13", "Kostragruppe 13", "2015-01-01", None)]}
+
+
+class Response:
+    """ The parts of requests.Response the scripts use, gzip on the wire like SSB. """
+
+    def __init__(self, content, content_type, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.ok = status_code == 200
+        self.encoding = "utf-8"
+        self.headers = {"Content-Type": content_type, "Content-Encoding": "gzip",
+                        "Content-Length": str(len(gzip.compress(content, mtime=0))),
+                        "Last-Modified": "Wed, 15 Mar 2023 07:00:00 GMT"}
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding)
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+
+def json_response(payload):
+    return Response(json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8")
+
+
+def value(table_id, cell):
+    """ A fixed value per cell, about one in seven is missing and one in eleven is 0. """
+    checksum = zlib.crc32(json.dumps([table_id, cell]).encode("utf-8"))
+    if checksum % 7 == 0:
+        return None
+    if checksum % 11 == 0:
+        return 0
+    return checksum % 100000 / 10
+
+
+def get(url, headers=None, **kwargs):
+    if "/klass/" in url:
+        klass_id = url.split("classifications/")[1].split("/")[0]
+        from_date = url.split("from=")[1][:10]
+        codes = []
+        for code, name, valid_from, valid_to in klass[klass_id]:
+            if valid_to is not None and valid_to <= from_date:
+                continue
+            item = {"code": code, "parentCode": None, "level": "1", "name": name, "shortName": "",
+                    "presentationName": "", "validFrom": valid_from, "validTo": valid_to,
+                    "validFromInRequestedRange": max(valid_from, from_date), "notes": ""}
+            if valid_to is not None:
+                item["validToInRequestedRange"] = valid_to
+            codes.append(item)
+        return json_response({"codes": codes})
+    return json_response(tables[url.rsplit("/", 1)[1]])
+
+
+def select(variable, selection):
+    if selection["filter"] == "item":
+        return [code for code in variable["values"] if code in selection["values"]]
+    if selection["filter"] == "top":
+        return variable["values"][-int(selection["values"][0]):]
+    if selection["filter"] == "all":
+        return [code for code in variable["values"]
+                if any(fnmatch.fnmatchcase(code, pattern) for pattern in selection["values"])]
+    raise ValueError("Filteret brukes ikke av skriptene: " + selection["filter"])
+
+
+# Flere celler enn dette i en spørring gir 413, som SSB sin grense, None er ingen grense
+max_cells = None
+
+
+def post(url, json=None, **kwargs):
+    table_id = url.rsplit("/", 1)[1]
+    variables = {variable["code"]: variable for variable in tables[table_id]["variables"]}
+    ids, categories = [], []
+    for item in json["query"]:
+        ids.append(item["code"])
+        categories.append(select(variables[item["code"]], item["selection"]))
+    cells = list(itertools.product(*categories))
+    if max_cells is not None and len(cells) > max_cells:
+        return Response(b"Too many cells", "text/plain; charset=utf-8", 413)
+    values = [value(table_id, list(cell)) for cell in cells]
+    response_format = json["response"]["format"]
+
+    if response_format == "csv2":
+        text = io.StringIO()
+        writer = csv.writer(text, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\r\n")
+        writer.writerow(ids + [table_id + ": " + variables["ContentsCode"]["valueTexts"][0]])
+        for cell, val in zip(cells, values):
+            writer.writerow(list(cell) + ["." if val is None else str(val)])
+        return Response(text.getvalue().encode("utf-8"), "text/csv; charset=utf-8")
+
+    if response_format == "px":
+        # STUB er alle variablene utenom den siste, som er HEADING, og DATA er rad-major over STUB og så HEADING
+        texts = [variables[code]["text"] for code in ids]
+        lines = ['CHARSET="ANSI";', 'CODEPAGE="iso-8859-1";', 'LANGUAGE="no";',
+                 'STUB=' + ",".join('"%s"' % text for text in texts[:-1]) + ";", 'HEADING="%s";' % texts[-1]]
+        for code, text, codes in zip(ids, texts, categories):
+            names = [variables[code]["valueTexts"][variables[code]["values"].index(c)] for c in codes]
+            lines.append('VALUES("%s")=%s;' % (text, ",".join('"%s"' % name for name in names)))
+            lines.append('CODES("%s")=%s;' % (text, ",".join('"%s"' % c for c in codes)))
+            lines.append('VARIABLECODE("%s")="%s";' % (text, code))
+        lines.append("DATA=")
+        lines.append(" ".join('"."' if val is None else str(val) for val in values) + ";")
+        return Response("\r\n".join(lines).encode("iso-8859-1"), "text/plain; charset=iso-8859-1")
+
+    dimension = {}
+    for code, codes in zip(ids, categories):
+        variable = variables[code]
+        dimension[code] = {"label": variable["text"],
+                           "category": {"index": {c: idx for idx, c in enumerate(codes)},
+                                        "label": {c: variable["valueTexts"][variable["values"].index(c)]
+                                                  for c in codes}}}
+    return json_response({"version": "2.0", "class": "dataset", "label": tables[table_id]["title"],
+                          "source": "Statistisk sentralbyrå", "updated": "2023-03-15T07:00:00Z", "id": ids,
+                          "size": [len(codes) for codes in categories], "dimension": dimension,
+                          "role": {"time": ["Tid"], "metric": ["ContentsCode"]}, "value": values})
+
+
+# (tabell, filter, format, max_cells) for hver kjøring testene spiller av
+runs = [(table_id, None, response_format, None)
+        for table_id in tables for response_format in ("json-stat2", "csv2", "px")]
+runs.append(("12367", "Tid=2021,2022", "json-stat2", None))
+# 54 celler, som deles til de er under 20, se test_chunks.py
+runs.append(("12367", "Tid=2022&KOKart0000=AG1,AG2,AG3", "json-stat2", 20))
+# Filteret test_cli.py gir kommandolinjen for begge tabellene, hver tabell bruker bare sin del av det
+cli_filter = "KOKart0000=AG1,AG2&Konsumgrp!=02"
+runs.extend((table_id, cli_filter, "json-stat2", None) for table_id in tables)
+
+
+def record():
+    """ Records every request the tests make, through the scripts themselves. """
+    import requests
+
+    meta = skript.load("meta_filter_alleaar")
+    requests.get, requests.post = get, post
+    meta.request_pause = 0.0
+    meta.use_archive(arkiv)
+    global max_cells
+    for table_id, metadata_filter, response_format, max_cells in runs:
+        meta.region_klass_cache.clear()
+        meta.tuned_chunk_sizes.clear()
+        meta.post_query(meta.SSBTable(table_id, metadata_filter), response_format=response_format)
+    max_cells = None
+    meta.tuned_chunk_sizes.clear()
+
+    # Delene av 12367 spurt med item også, så testene kan sammenligne med det build_selection sender
+    ssb_table = meta.SSBTable("12367")
+    for chunk in meta.meta_filter(ssb_table, meta.calc_iterations(ssb_table)):
+        meta.http_post(ssb_table.metadata_url, json=item_query(meta, chunk))
+
+    thread = skript.load("meta_thread_filter_alleaar")
+    thread.ssb_table = thread.SSBTable("12367")
+    thread.pipeline(thread_chunks(thread.ssb_table), prosesser=1, pause=0.0)
+    meta.use_archive(None)
+
+
+def item_query(meta, chunk):
+    """ The query build_query makes for chunk, with every value spelled out with item instead of pushed down. """
+    query = meta.build_query(chunk)
+    for item, dimension in zip(query["query"], chunk):
+        item["selection"] = {"filter": "item", "values": dimension.values}
+    return query
+
+
+def thread_chunks(ssb_table):
+    """ One chunk per year with every region, what the pipeline tests fetch with Meta Thread Filter AlleAar. """
+    chunks = []
+    for year in ssb_table.variables["variables"][ssb_table.table_tid]["values"]:
+        variables = copy.deepcopy(ssb_table.variables["variables"])
+        variables[ssb_table.table_tid]["values"] = [year]
+        chunks.append(variables)
+    return chunks
+
+
+if __name__ == "__main__":
+    shutil.rmtree(arkiv, ignore_errors=True)
+    record()
+    print("Arkivet er laget i", arkiv)
@@ -0,0 +1,25 @@
+""" Loads the scripts in the repository as modules, their file names have spaces so they cant be imported by name.
+
+Each script is loaded once per process under the same module name the scripts use when they load each other,
+so the tests and the scripts share the same module state (the archive, the KLASS cache and so on).
+"""
+import importlib.util
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+scripts = {"meta_filter_alleaar": "Meta Filter AlleAar.py",
+           "meta_thread_filter_alleaar": "Meta Thread Filter AlleAar.py",
+           "asss_ssb_alleaar_values": "ASSS SSB AlleAar Values.py",
+           "data_filter_alleaar": "Data Filter AlleAar.py"}
+
+
+def load(name):
+    """ Returns the script name (a key in scripts) as a module, loads it the first time. """
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(root, scripts[name]))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
@@ -0,0 +1,29 @@
+""" ResponseArchive, the headers it stores with the decompressed bodies and the bytes SSB sent for them. """
+import glob
+import json
+import os
+
+
+def test_headers_describe_the_stored_body(replay):
+    for path in glob.glob(os.path.join(replay, "requests", "*", "*.json")):
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+        assert "Content-Encoding" not in entry["headers"]
+        assert entry["wire_bytes"] > 0
+        if entry["status_code"] == 200:
+            assert entry["wire_bytes"] < int(entry["headers"]["Content-Length"])
+
+
+def test_replay_counts_the_wire_bytes(meta, table):
+    response = meta.http_get(table.metadata_url)
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Content-Length"] == str(len(response.content))
+    assert meta.wire_size(response) == response.wire_bytes < len(response.content)
+    meta.post_query(table)
+    assert 0 < table.stats["wire_bytes"] < table.stats["bytes"]
+
+
+def test_old_entries_are_normalized(meta):
+    response = meta.ArchivedResponse(b"{}", 200, {"Content-Encoding": "gzip", "Content-Length": "22"})
+    assert response.headers == {"Content-Length": "2"}
+    assert meta.wire_size(response) == 2
@@ -0,0 +1,52 @@
+""" ResultAssembler, the result post_query builds without a sink, against pyjstat on the archived responses. """
+from collections import OrderedDict
+
+import pandas as pd
+import pytest
+from pyjstat import pyjstat
+
+
+def pyjstat_result(meta, ssb_table):
+    """ The result like the scripts built it before ResultAssembler, a pyjstat DataFrame per chunk and a concat. """
+    meta_data = meta.meta_filter(ssb_table, meta.calc_iterations(ssb_table))
+    frames = []
+    for variables in meta_data:
+        response = meta.http_post(ssb_table.metadata_url, json=meta.build_query(variables))
+        frames.append(pyjstat.from_json_stat(response.json(object_pairs_hook=OrderedDict), naming="id")[0])
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.mark.parametrize("table_id", ["12367", "03013"])
+def test_same_as_pyjstat(meta, replay, table_id):
+    expected = pyjstat_result(meta, meta.SSBTable(table_id))
+    result = meta.post_query(meta.SSBTable(table_id), categorical=False)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    assert result["value"].dtype == float
+
+
+@pytest.mark.parametrize("table_id", ["12367", "03013"])
+@pytest.mark.parametrize("response_format", ["csv2", "px"])
+def test_formats_give_the_same_result(meta, replay, table_id, response_format):
+    expected = meta.post_query(meta.SSBTable(table_id))
+    result = meta.post_query(meta.SSBTable(table_id), response_format=response_format)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_categorical_columns(meta, table):
+    result = meta.post_query(table)
+    for dimension in table.dimensions:
+        assert isinstance(result[dimension.code].dtype, pd.CategoricalDtype)
+        assert list(result[dimension.code].cat.categories) == dimension.codes.tolist()
+    assert result["KOKkommuneregion0000"].cat.codes.dtype == "int8"
+
+
+def test_grows_when_a_response_is_bigger_than_planned(meta, table):
+    meta_data = meta.meta_filter(table, meta.calc_iterations(table))
+    response = meta.http_post(table.metadata_url, json=meta.build_query(meta_data[0]))
+    json_stat = response.json(object_pairs_hook=OrderedDict)
+    assembler = meta.ResultAssembler(table.dimensions, [])
+    assert assembler.add(json_stat) == assembler.rows == assembler.position
+    dataframe = assembler.dataframe()
+    expected = pyjstat.from_json_stat(json_stat, naming="id")[0]
+    pd.testing.assert_frame_equal(dataframe.astype({dimension.code: str for dimension in table.dimensions}),
+                                  expected, check_dtype=False)
@@ -0,0 +1,120 @@
+""" split_chunk, ChunkTuner and what post_query does with a chunk that fails, on the archived 12367.
+
+The archive has the filter small in lag_arkiv.runs recorded with a limit of 20 cells, so its 54 cells are
+answered with 413 and split until every part is under the limit.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+small = "Tid=2022&KOKart0000=AG1,AG2,AG3"
+
+
+def test_split_chunk(meta, table):
+    chunk = meta.meta_filter(table, meta.calc_iterations(table))[0]
+    halves = meta.split_chunk(chunk)
+    assert sum(meta.chunk_rows(half) for half in halves) == meta.chunk_rows(chunk)
+    assert halves[0][0].values + halves[1][0].values == chunk[0].values
+    assert [len(dimension) for dimension in halves[0][1:]] == [len(dimension) for dimension in chunk[1:]]
+    assert meta.split_chunk([dimension.select(dimension.positions[:1]) for dimension in chunk]) is None
+
+
+def test_split_to_limit(meta, table):
+    chunk = meta.meta_filter(table, meta.calc_iterations(table))[0]
+    parts = meta.split_to_limit(chunk, 10)
+    assert all(meta.chunk_rows(part) < 10 for part in parts)
+    assert sum(meta.chunk_rows(part) for part in parts) == meta.chunk_rows(chunk)
+
+
+def test_tuner_slow_and_fast(meta, replay):
+    tuner = meta.ChunkTuner("12367", 100000, target_seconds=20.0)
+    tuner.record(100000, 10 ** 6, 80.0)
+    assert tuner.max_rows == 25000
+    tuner.record(25000, 10 ** 5, 2.0)
+    assert tuner.max_rows == 50000
+    tuner.failed(40000, 120.0)
+    assert tuner.failed_rows == 40000 and tuner.failed_at is not None
+    assert tuner.max_rows == 20000 and tuner.ceiling == 39999
+
+
+def test_tuner_forgets_failed_rows(meta, replay):
+    tuner = meta.ChunkTuner("12367", 100000)
+    tuner.failed(40000, 120.0)
+    tuner.record(45000, 10 ** 5, 20.0)
+    assert tuner.failed_rows is None and tuner.ceiling == meta.ssb_row_limit
+
+    old = (datetime.now() - timedelta(seconds=meta.failed_rows_ttl + 60)).isoformat(timespec="seconds")
+    meta.tuned_chunk_sizes["12367"] = {"max_rows": 20000, "failed_rows": 40000, "failed_at": old}
+    assert meta.ChunkTuner("12367", 20000).failed_rows is None
+    meta.tuned_chunk_sizes["12367"]["failed_at"] = datetime.now().isoformat(timespec="seconds")
+    assert meta.ChunkTuner("12367", 20000).failed_rows == 40000
+
+
+def test_too_big_chunk_is_split(meta, replay):
+    ssb_table = meta.SSBTable("12367", small)
+    result = meta.post_query(ssb_table)
+    assert len(result) == 9 * 2 * 3
+    # metadata, 54 cells, 24 and 30 cells and the four parts under 20
+    assert ssb_table.stats["requests"] == 1 + 1 + 2 + 4
+    assert "sleep" in ssb_table.stats["seconds"]
+
+
+class FailingPost:
+    """ Replays the archive, but answers the requests in fail_on with response, or raises it. """
+
+    def __init__(self, meta, fail_on, response):
+        self.post = meta.http_post
+        self.fail_on = fail_on
+        self.response = response
+        self.calls = 0
+
+    def __call__(self, url, json=None, headers=None, timeout=None):
+        self.calls += 1
+        if self.calls in self.fail_on:
+            if isinstance(self.response, Exception):
+                raise self.response
+            return self.response
+        return self.post(url, json=json, headers=headers, timeout=timeout)
+
+
+def test_timeout_is_split(meta, replay, monkeypatch):
+    monkeypatch.setattr(meta, "http_post", FailingPost(meta, {1}, requests.exceptions.ReadTimeout()))
+    ssb_table = meta.SSBTable("12367", small)
+    assert len(meta.post_query(ssb_table)) == 54
+    assert ssb_table.stats["requests"] == 1 + 2 + 4
+
+
+@pytest.mark.parametrize("status_code", [429, 503])
+def test_overloaded_is_retried(meta, table, monkeypatch, status_code):
+    response = meta.ArchivedResponse(b"", status_code, {"Retry-After": "0"})
+    post = FailingPost(meta, {1, 2}, response)
+    monkeypatch.setattr(meta, "http_post", post)
+    chunks = len(meta.meta_filter(table, meta.calc_iterations(table)))
+    result = meta.post_query(table)
+    assert post.calls == table.stats["requests"] - 1 == chunks + 2
+    assert len(result) == meta.estimate(table)["valid_cells"]
+    assert "sleep" in table.stats["seconds"]
+
+
+def test_gives_up_after_max_retries(meta, table, monkeypatch):
+    post = FailingPost(meta, set(range(1, 100)), meta.ArchivedResponse(b"", 503, {}))
+    monkeypatch.setattr(meta, "http_post", post)
+    with pytest.raises(RuntimeError, match="503"):
+        meta.post_query(table)
+    assert post.calls == meta.max_retries + 1
+
+
+def test_other_errors_are_raised(meta, table, monkeypatch):
+    post = FailingPost(meta, {1}, meta.ArchivedResponse(b"", 400, {}))
+    monkeypatch.setattr(meta, "http_post", post)
+    with pytest.raises(RuntimeError, match="400"):
+        meta.post_query(table)
+    assert post.calls == 1
+
+
+def test_replay_plans_like_the_recording(meta, replay):
+    meta.tuned_chunk_sizes["12367"] = {"max_rows": 10}
+    ssb_table = meta.SSBTable("12367", small)
+    assert ssb_table.ssb_max_row_query == meta.ssb_row_limit
+    assert len(meta.post_query(ssb_table)) == 54
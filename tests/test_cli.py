@@ -0,0 +1,79 @@
+""" The fetch command of main and the asss-hent wrapper, replaying both archived tables with --jobs 2. """
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+import lag_arkiv
+import skript
+
+tables = ["12367", "03013"]
+
+
+def fetch(meta, replay, out, *options):
+    return meta.main(["fetch", *tables, "--jobs", "2", "--filter", lag_arkiv.cli_filter, "--replay", replay,
+                      "--out", str(out), *options])
+
+
+def read_report(out, name):
+    with open(os.path.join(str(out), name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def rows_written(meta, out, sink, table_id):
+    if sink == "csv":
+        return len(pd.read_csv(os.path.join(str(out), table_id + ".csv")))
+    if sink == "dataset":
+        return len(meta.read_dataset(str(out), table_id, verify=True))
+    connection = sqlite3.connect(os.path.join(str(out), "asss.sqlite"))
+    try:
+        return connection.execute('SELECT COUNT(*) FROM "t{}"'.format(table_id)).fetchone()[0]
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("sink", ["dataset", "merge", "sqlite", "csv"])
+def test_fetch(meta, replay, tmp_path, sink):
+    expected = {table_id: len(meta.post_query(meta.SSBTable(table_id, lag_arkiv.cli_filter)))
+                for table_id in tables}
+    assert expected["03013"] == 2 * 1 * 12 and 0 < expected["12367"] < 11 * 2 * 2 * 1 * 5
+    meta.tuned_chunk_sizes.clear()
+
+    assert fetch(meta, replay, tmp_path, "--sink", sink) == 0
+
+    run_report = read_report(tmp_path, "report.json")
+    assert run_report["jobs"] == 2
+    assert [report["table_id"] for report in run_report["tables"]] == tables
+    for table_id in tables:
+        report = read_report(tmp_path, table_id + ".report.json")
+        assert report == next(r for r in run_report["tables"] if r["table_id"] == table_id)
+        assert report["status"] == "ok" and report["sink"] == sink and report["filter"] == lag_arkiv.cli_filter
+        assert report["format"] == "json-stat2" and report["requests"] >= 2
+        assert ("result" in report) == (sink != "csv")
+        assert rows_written(meta, tmp_path, sink, table_id) == expected[table_id]
+    assert "klass" in read_report(tmp_path, "12367.report.json")
+    assert "klass" not in read_report(tmp_path, "03013.report.json")
+    assert os.path.exists(os.path.join(str(tmp_path), "chunk_sizes.json"))
+
+
+def test_failing_table_gives_exit_code_1(meta, replay, tmp_path):
+    """ 07459 isnt in the archive, the other table is still fetched. """
+    assert meta.main(["fetch", "07459", "03013", "--jobs", "2", "--filter", lag_arkiv.cli_filter, "--sink", "csv",
+                      "--replay", replay, "--out", str(tmp_path)]) == 1
+    statuses = {report["table_id"]: report["status"] for report in read_report(tmp_path, "report.json")["tables"]}
+    assert statuses == {"07459": "error", "03013": "ok"}
+    assert "error" in read_report(tmp_path, "07459.report.json")
+    assert os.path.exists(os.path.join(str(tmp_path), "03013.csv"))
+
+
+def test_asss_hent(replay, tmp_path):
+    command = [sys.executable, os.path.join(skript.root, "asss-hent"), "fetch", "03013", "--sink", "csv",
+               "--filter", lag_arkiv.cli_filter, "--replay", replay, "--out", str(tmp_path)]
+    completed = subprocess.run(command, capture_output=True, text=True, timeout=120)
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.startswith("03013 ok")
+    assert len(pd.read_csv(os.path.join(str(tmp_path), "03013.csv"))) == 2 * 1 * 12
@@ -0,0 +1,67 @@
+""" PartitionedDatasetSink and read_dataset, with the archived 12367. """
+import gzip
+import os
+
+import pandas as pd
+import pytest
+
+keys = ["KOKkommuneregion0000", "KOKregnskapsomfa0000", "KOKart0000", "ContentsCode", "Tid"]
+
+
+def normalized(dataframe):
+    dataframe = dataframe.astype({key: str for key in keys})
+    return dataframe.sort_values(keys).reset_index(drop=True)[keys + ["value"]]
+
+
+def write(meta, path, metadata_filter=None):
+    sink = meta.PartitionedDatasetSink(str(path), "12367")
+    return meta.post_query(meta.SSBTable("12367", metadata_filter), sink=sink)
+
+
+def test_roundtrip(meta, replay, tmp_path):
+    write(meta, tmp_path)
+    expected = meta.post_query(meta.SSBTable("12367"))
+    pd.testing.assert_frame_equal(normalized(meta.read_dataset(str(tmp_path), "12367", verify=True)),
+                                  normalized(expected))
+
+    manifest = meta.read_manifest(str(tmp_path), "12367")
+    assert manifest["rows"] == len(expected)
+    assert manifest["published"] == "2023-03-15T07:00:00Z"
+    assert sorted(set(part["tid"] for part in manifest["parts"])) == ["2018", "2019", "2020", "2021", "2022"]
+    assert not os.path.exists(os.path.join(str(tmp_path), "table=12367", "_staging"))
+
+
+def test_read_periods_and_regions(meta, replay, tmp_path):
+    write(meta, tmp_path)
+    everything = normalized(meta.read_dataset(str(tmp_path), "12367"))
+    part = normalized(meta.read_dataset(str(tmp_path), "12367", tid=[2019, "2021"], regions=["5001", "EAK"]))
+    mask = everything["Tid"].isin(["2019", "2021"]) & everything["KOKkommuneregion0000"].isin(["5001", "EAK"])
+    pd.testing.assert_frame_equal(part, everything[mask].reset_index(drop=True))
+    assert meta.read_dataset(str(tmp_path), "12367", regions=["1601"], tid=["2022"]).empty
+
+
+def test_partial_run_replaces_only_its_periods(meta, replay, tmp_path):
+    write(meta, tmp_path)
+    before = meta.read_manifest(str(tmp_path), "12367")
+    write(meta, tmp_path, "Tid=2021,2022")
+    after = meta.read_manifest(str(tmp_path), "12367")
+    assert after["rows"] == before["rows"]
+    kept = [part for part in before["parts"] if part["tid"] not in ("2021", "2022")]
+    assert [part for part in after["parts"] if part["tid"] not in ("2021", "2022")] == kept
+
+
+def test_verify_finds_changed_parts(meta, replay, tmp_path):
+    write(meta, tmp_path)
+    part = meta.read_manifest(str(tmp_path), "12367")["parts"][0]
+    file_path = os.path.join(str(tmp_path), "table=12367", part["path"])
+    with gzip.open(file_path, "rt") as f:
+        text = f.read()
+    with gzip.open(file_path, "wt") as f:
+        f.write(text.replace("KOSbelop0000", "KOSbelop0001"))
+    with pytest.raises(ValueError):
+        meta.read_dataset(str(tmp_path), "12367", verify=True)
+
+
+def test_missing_table(meta, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        meta.read_dataset(str(tmp_path), "12367")
@@ -0,0 +1,42 @@
+""" Dimension, the compact metadata model, built from the archived metadata of 12367. """
+
+
+def test_select_shares_values(meta, metadata):
+    region = meta.Dimension(metadata["variables"][0])
+    part = region.select([6, 3])
+    assert part.codes is region.codes and part.texts is region.texts
+    assert part.values == ["5001", "0301"]
+    assert part.value_texts == ["Trondheim - Tråante", "Oslo"]
+    assert part.to_variable()["valueTexts"] == ["Trondheim - Tråante", "Oslo"]
+    assert not part.is_complete and region.is_complete
+
+
+def test_texts_are_the_json_strings(meta, metadata):
+    variable = metadata["variables"][2]
+    art = meta.Dimension(variable)
+    assert all(text is source for text, source in zip(art.texts, variable["valueTexts"]))
+
+
+def test_fingerprint(meta, metadata):
+    region = meta.Dimension(metadata["variables"][0])
+    assert region.fingerprint == meta.Dimension(metadata["variables"][0]).fingerprint
+    assert region.select([6, 3]).fingerprint == region.select([6, 3]).fingerprint != region.fingerprint
+    assert region.select([3, 6]).fingerprint != region.select([6, 3]).fingerprint
+
+
+def test_tables_share_validity(meta, replay):
+    first, second = meta.SSBTable("12367"), meta.SSBTable("12367")
+    for ssb_table in [first, second]:
+        meta.meta_filter(ssb_table, meta.calc_iterations(ssb_table))
+    assert len(meta.region_validity_cache) == 1
+    key = next(iter(meta.region_validity_cache))
+    assert key[0] == first.dimensions[first.table_region].fingerprint
+
+
+def test_fingerprint_of_codes_that_join_to_the_same_bytes(meta):
+    def dimension(values):
+        return meta.Dimension({"code": "Region", "text": "region", "values": values, "valueTexts": values})
+
+    assert dimension(["0301", "0101"]).fingerprint != dimension(["03010101"]).fingerprint
+    assert dimension(["03", "01"]).fingerprint != dimension(["0301"]).fingerprint
+    assert dimension(["0301", "0101"]).fingerprint == dimension(["0301", "0101"]).fingerprint
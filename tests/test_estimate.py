@@ -0,0 +1,18 @@
+""" estimate() on the archived tables, compared with what post_query actually fetches. """
+
+
+def test_region_table(meta, table):
+    result = meta.estimate(table)
+    assert result["periods"] == ["2022", "2021", "2020", "2019", "2018"]
+    assert result["total_cells"] == 11 * 2 * 4 * 1 * 5
+    assert result["table_cells"] == 11 * 2 * 4 * 1 * 8
+    assert result["valid_cells"] == len(meta.post_query(table)) < result["total_cells"]
+    assert result["requests"] == table.stats["requests"] - 1
+    assert result["throughput"] == meta.default_throughput
+
+
+def test_table_without_region(meta, replay):
+    result = meta.estimate(meta.SSBTable("03013"))
+    assert len(result["periods"]) == 12
+    assert result["total_cells"] == result["valid_cells"] == result["table_cells"] == 3 * 1 * 12
+    assert result["requests"] == 1
@@ -0,0 +1,40 @@
+""" The metadata filter of SSBTable (filter_term, filters_as_dict and filter_dimensions) on the archived 12367. """
+import pytest
+
+
+def values_of(ssb_table):
+    return {dimension.code: dimension.values for dimension in ssb_table.dimensions}
+
+
+def test_filters_as_dict(meta):
+    ssb_table = meta.SSBTable("12367")
+    exclude, include = ssb_table.filters_as_dict(" KOKart0000 = AG1, AG2 &Tid!=2015&KOKart0000=AG2,AG3& ")
+    assert include == {"KOKart0000": ["AG1", "AG2", "AG3"]}
+    assert exclude == {"Tid": ["2015"]}
+
+
+@pytest.mark.parametrize("filter_string", ["KOKart0000", "KOKart0000==AG1", "KOKart0000=AG1=AG2", "=AG1"])
+def test_filters_as_dict_invalid(meta, filter_string):
+    with pytest.raises(ValueError):
+        meta.SSBTable("12367", filter_string)
+
+
+def test_filter_dimensions(meta, replay):
+    ssb_table = meta.SSBTable("12367", "KOKart0000=AG3,AG1,AG9&KOKregnskapsomfa0000!=B&Tid!=2015,2016")
+    values = values_of(ssb_table)
+    assert values["KOKart0000"] == ["AG3", "AG1"]
+    assert values["KOKregnskapsomfa0000"] == ["A"]
+    assert values["Tid"] == [str(year) for year in range(2017, 2023)]
+    assert len(values["KOKkommuneregion0000"]) == 11
+    assert ssb_table.table_size == 2 * 1
+
+
+def test_filter_include_and_exclude(meta, replay):
+    ssb_table = meta.SSBTable("12367", "Tid=2020,2021,2022&Tid!=2021")
+    assert values_of(ssb_table)["Tid"] == ["2020", "2022"]
+
+
+def test_filter_keeps_texts(meta, replay):
+    ssb_table = meta.SSBTable("12367", "KOKkommuneregion0000=5001,0301")
+    region = ssb_table.dimensions[ssb_table.table_region]
+    assert list(region.value_texts) == ["Trondheim - Tråante", "Oslo"]
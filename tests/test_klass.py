@@ -0,0 +1,42 @@
+""" KlassIntervals and the regions every script gets from KLASS, on the archived classifications. """
+import pytest
+
+import skript
+
+
+@pytest.fixture
+def klass(table):
+    klass = table.klass
+    klass.load()
+    return klass
+
+
+def test_valid_on(klass):
+    intervals = klass.intervals
+    assert "1601" not in intervals.valid_on("2019-01-01")
+    assert {"5001", "1101", "0301", "50"} <= set(intervals.valid_on("2019-01-01"))
+    assert "3001" not in intervals.valid_on("2019-12-31") and "3001" in intervals.valid_on("2020-01-01")
+
+
+def test_lookup(meta, klass):
+    assert klass.intervals.lookup("5001") == [("2018-01-01", "2020-01-01", "131"),
+                                              ("2020-01-01", meta.klass_open_end, "131")]
+    assert klass.intervals.lookup("9999") == []
+
+
+def test_regions_merge_the_intervals_of_a_code(meta, klass):
+    regions = klass.filtered_regions
+    assert regions["5001"] == {"code": "5001", "validFrom": "2018", "validTo": meta.klass_open_end[:4]}
+    assert regions["1101"]["validFrom"] == "2017" and regions["1101"]["validTo"] == "2059"
+    assert regions["1601"] == {"code": "1601", "validFrom": "2017", "validTo": "2018"}
+
+
+def test_open_end_is_in_the_url(meta, klass):
+    assert "to=" + meta.klass_open_end in klass.region_klass_url("131")
+
+
+@pytest.mark.parametrize("name", ["meta_thread_filter_alleaar", "data_filter_alleaar"])
+def test_variants_share_the_regions(meta, klass, name):
+    variant = skript.load(name)
+    assert variant.region_klass(klass.klass_id, klass.from_date) is klass
+    assert variant.region_klass(list(klass.klass_id), klass.from_date).filtered_regions is klass.filtered_regions
@@ -0,0 +1,32 @@
+""" last_meta_filter in the other scripts, also without __file__ like in SQL Server's external_script. """
+import os
+import subprocess
+import sys
+
+import pytest
+
+import skript
+
+# Runs the script with exec and without __file__, from the directory with Meta Filter AlleAar.py
+external_script = """
+import sys
+with open(sys.argv[1], encoding="utf-8") as f:
+    source = f.read()
+scope = {"__name__": "external_script"}
+exec(compile(source, "<external_script>", "exec"), scope)
+print(scope["skript_dir"])
+print(scope["meta"].__file__)
+"""
+
+
+@pytest.mark.parametrize("name", ["meta_thread_filter_alleaar", "asss_ssb_alleaar_values", "data_filter_alleaar"])
+def test_loads_meta_filter_without_file(name):
+    command = [sys.executable, "-c", external_script, os.path.join(skript.root, skript.scripts[name])]
+    completed = subprocess.run(command, cwd=skript.root, capture_output=True, text=True, timeout=120)
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.splitlines()[-2:] == [skript.root, os.path.join(skript.root, "Meta Filter AlleAar.py")]
+
+
+@pytest.mark.parametrize("name", ["meta_thread_filter_alleaar", "asss_ssb_alleaar_values", "data_filter_alleaar"])
+def test_shares_the_loaded_module(meta, name):
+    assert skript.load(name).meta is meta
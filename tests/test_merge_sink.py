@@ -0,0 +1,54 @@
+""" The diffs of SQLiteMergeSink, merging the archived 12367 into the same table several times. """
+import sqlite3
+
+
+def merge(meta, connection, table_id="12367", metadata_filter=None):
+    sink = meta.SQLiteMergeSink(connection, "kostra")
+    summary = meta.post_query(meta.SSBTable(table_id, metadata_filter), sink=sink)
+    return summary.iloc[0].to_dict(), sink.diff
+
+
+def test_first_run_inserts_everything(meta, replay):
+    connection = sqlite3.connect(":memory:")
+    summary, diff = merge(meta, connection)
+    assert summary["Nye"] == summary["Rader"] > 0
+    assert summary["Endret"] == summary["Uendret"] == 0
+    assert connection.execute('SELECT COUNT(*) FROM "kostra"').fetchone()[0] == summary["Rader"]
+    assert diff["Tid"].tolist() == sorted(diff["Tid"].tolist())
+
+
+def test_same_data_is_unchanged(meta, replay):
+    connection = sqlite3.connect(":memory:")
+    first, _ = merge(meta, connection)
+    summary, diff = merge(meta, connection)
+    assert summary["Uendret"] == first["Rader"]
+    assert summary["Nye"] == summary["Endret"] == 0
+    assert (diff["inserted"] + diff["changed"] == 0).all()
+
+
+def test_changed_value_is_found_per_period(meta, replay):
+    connection = sqlite3.connect(":memory:")
+    first, _ = merge(meta, connection)
+    connection.execute('UPDATE "kostra" SET "value" = -1 WHERE "Tid" = ? AND "KOKkommuneregion0000" = ? '
+                       'AND "KOKart0000" = ?', ("2021", "0301", "AG2"))
+    connection.execute('DELETE FROM "kostra" WHERE "Tid" = ? AND "KOKkommuneregion0000" = ?', ("2022", "3002"))
+    connection.commit()
+    deleted = first["Rader"] - connection.execute('SELECT COUNT(*) FROM "kostra"').fetchone()[0]
+
+    summary, diff = merge(meta, connection)
+    diff = diff.set_index("Tid")
+    assert summary["Endret"] == 2 and diff.loc["2021", "changed"] == 2
+    assert summary["Nye"] == deleted and diff.loc["2022", "inserted"] == deleted
+    assert diff.drop(["2021", "2022"])[["inserted", "changed"]].sum().sum() == 0
+    value = connection.execute('SELECT "value" FROM "kostra" WHERE "Tid" = ? AND "KOKkommuneregion0000" = ? '
+                               'AND "KOKart0000" = ?', ("2021", "0301", "AG2")).fetchall()
+    assert all(row[0] != -1 for row in value)
+
+
+def test_partial_run_only_touches_its_rows(meta, replay):
+    connection = sqlite3.connect(":memory:")
+    first, _ = merge(meta, connection)
+    summary, diff = merge(meta, connection, metadata_filter="Tid=2021,2022")
+    assert diff["Tid"].tolist() == ["2021", "2022"]
+    assert summary["Uendret"] == summary["Rader"] < first["Rader"]
+    assert connection.execute('SELECT COUNT(*) FROM "kostra"').fetchone()[0] == first["Rader"]
@@ -0,0 +1,69 @@
+""" metadata_cache in ASSS SSB AlleAar Values.py, with pd.read_json stubbed instead of SSB. """
+import pytest
+
+
+@pytest.fixture
+def fetches(values, metadata, monkeypatch):
+    """ The urls pd.read_json is called with, it answers with the archived metadata of 12367. """
+    urls = []
+
+    def read_json(url):
+        urls.append(url)
+        return values.pd.DataFrame({"title": metadata["title"], "variables": metadata["variables"]})
+
+    monkeypatch.setattr(values.pd, "read_json", read_json)
+    values.invalidate_metadata()
+    yield urls
+    values.invalidate_metadata()
+
+
+@pytest.fixture
+def clock(values, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(values.time, "time", lambda: now[0])
+    return now
+
+
+def test_fetched_once(values, fetches):
+    table = values.SSBTable("12367")
+    for _ in range(3):
+        assert table.dimensions[0] == "KOKkommuneregion0000"
+        assert table.variables[0]["code"] == "KOKkommuneregion0000"
+        assert list(table.metadata[0].columns) == ["KOKkommuneregion0000_kode", "KOKkommuneregion0000"]
+    assert values.SSBTable("12367").dimensions == table.dimensions
+    assert fetches == [table.url]
+
+
+def test_fetched_again_after_ttl(values, fetches, clock):
+    table = values.SSBTable("12367")
+    table.dimensions
+    clock[0] += values.metadata_ttl
+    table.dimensions
+    assert len(fetches) == 1
+    clock[0] += 1
+    table.dimensions
+    assert len(fetches) == 2
+
+
+def test_fetched_again_after_invalidate(values, fetches):
+    table = values.SSBTable("12367")
+    table.dimensions
+    table.invalidate()
+    table.dimensions
+    values.invalidate_metadata("12367")
+    table.dimensions
+    values.invalidate_metadata("03013")
+    table.dimensions
+    values.invalidate_metadata()
+    table.dimensions
+    assert len(fetches) == 4
+
+
+def test_changing_variables_doesnt_change_the_cache(values, fetches):
+    table = values.SSBTable("12367")
+    variables = table.variables
+    variables[0]["values"].clear()
+    variables.pop()
+    assert len(table.variables[0]["values"]) == 11
+    assert len(table.variables) == len(variables) + 1
+    assert len(fetches) == 1
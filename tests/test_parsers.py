@@ -0,0 +1,77 @@
+""" parse_csv, parse_px and label_positions on the archived csv2 and px responses of 12367. """
+import csv
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def chunk(meta, table):
+    return meta.meta_filter(table, meta.calc_iterations(table))[0]
+
+
+def response(meta, table, chunk, response_format):
+    return meta.http_post(table.metadata_url, json=meta.build_query(chunk, response_format=response_format)).content
+
+
+def test_label_positions(meta, table):
+    art = table.dimensions[2]
+    positions = meta.label_positions(art, ["AG3", "Netto driftsresultat", "Frie inntekter", "AG4", "AG9"])
+    assert positions.tolist() == [2, 1, -1, 3, -1]
+
+
+def test_csv_separators(meta, table, chunk):
+    content = response(meta, table, chunk, "csv2")
+    expected = meta.parse_csv(content, chunk)
+    assert meta.csv_separator(content, len(chunk) + 1) == ","
+
+    rows = list(csv.reader(io.StringIO(content.decode("utf-8"))))
+    text = io.StringIO()
+    writer = csv.writer(text, delimiter=";", quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerows(rows[:1] + [row[:-1] + [row[-1] if row[-1] == "." else row[-1].replace(".", ",")]
+                                 for row in rows[1:]])
+    semicolon = text.getvalue().encode("utf-8")
+    assert meta.csv_separator(semicolon, len(chunk) + 1) == ";"
+    pd.testing.assert_frame_equal(meta.parse_csv(semicolon, chunk), expected)
+
+    text = io.StringIO()
+    csv.writer(text, delimiter="\t").writerows(rows)
+    tab = "\ufeff".encode("utf-8") + text.getvalue().encode("utf-8")
+    assert meta.csv_separator(tab, len(chunk) + 1) == "\t"
+    pd.testing.assert_frame_equal(meta.parse_csv(tab, chunk), expected)
+
+
+def test_csv_with_texts(meta, table, chunk):
+    """ A csv with the value texts instead of codes, the region texts are unique but two art have the same text. """
+    content = response(meta, table, chunk, "csv2").decode("utf-8")
+    region = table.dimensions[0]
+    for code, text in zip(region.codes.tolist(), region.texts):
+        content = content.replace('"' + code + '","', '"' + text + '","')
+    expected = meta.parse_csv(response(meta, table, chunk, "csv2"), chunk)
+    pd.testing.assert_frame_equal(meta.parse_csv(content.encode("utf-8"), chunk), expected)
+
+    content = content.replace('"AG4"', '"Frie inntekter"')
+    with pytest.raises(ValueError):
+        meta.parse_csv(content.encode("utf-8"), chunk)
+
+
+def test_px_without_codes(meta, table, chunk):
+    """ A px file with only VALUES, the texts, for the dimensions. """
+    content = response(meta, table, chunk, "px").decode("iso-8859-1")
+    expected = meta.parse_px(content.encode("iso-8859-1"), chunk)
+    without_codes = "\r\n".join(line for line in content.split("\r\n")
+                                if not line.startswith('CODES("region")') and not line.startswith('CODES("år")'))
+    pd.testing.assert_frame_equal(meta.parse_px(without_codes.encode("iso-8859-1"), chunk), expected)
+
+    without_art_codes = "\r\n".join(line for line in content.split("\r\n") if not line.startswith('CODES("art")'))
+    with pytest.raises(ValueError):
+        meta.parse_px(without_art_codes.encode("iso-8859-1"), chunk)
+
+
+def test_missing_values(meta):
+    values = meta.parse_values(np.array(["1.5", ".", "..", "", ":", "-", "0", "3"], dtype=object))
+    assert np.isnan(values[1:6]).all()
+    assert values[[0, 6, 7]].tolist() == [1.5, 0.0, 3.0]
+    assert meta.parse_values(np.array(["1,5", "."], dtype=object), decimal=",")[0] == 1.5
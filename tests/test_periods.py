@@ -0,0 +1,53 @@
+""" How meta_filter groups the periods of the archived 12367 into chunks, and the masks period_validity gives them. """
+
+
+def planned(meta, ssb_table):
+    regions, periods = [], []
+    for chunk in meta.meta_filter(ssb_table, meta.calc_iterations(ssb_table)):
+        regions.append(chunk[ssb_table.table_region].values)
+        periods.append(chunk[ssb_table.table_tid].values)
+    return regions, periods
+
+
+def test_periods_with_the_same_regions_share_a_chunk(meta, table):
+    """ Halden, Moss and Kongsvinger are valid from 2020, so 2022-2020 is one chunk and 2019-2018 another. """
+    regions, periods = planned(meta, table)
+    assert periods == [["2022", "2021", "2020"], ["2019", "2018"]]
+    assert regions == [["0", "EAK", "EAKUO", "0301", "1101", "5001", "3001", "3002", "3401"],
+                       ["0", "EAK", "EAKUO", "0301", "1101", "5001"]]
+
+
+def test_group_is_split_at_the_row_limit(meta, table):
+    """ 8 rows per region and period, so 9 regions give 72 rows per period and 6 regions 48. """
+    table.ssb_max_row_query = 2 * 72 + 1
+    regions, periods = planned(meta, table)
+    assert periods == [["2022", "2021"], ["2020"], ["2019", "2018"]]
+    assert regions[0] == regions[1] != regions[2]
+
+    table.ssb_max_row_query = 2 * 72
+    assert planned(meta, table)[1] == [["2022"], ["2021"], ["2020"], ["2019", "2018"]]
+
+
+def test_one_mask_per_year(meta, table, monkeypatch):
+    """ Quarters and months of the same year share the mask, which is calculated once for every distinct year. """
+    rules = table.region_rules
+    calls = []
+    validity = rules.validity
+
+    def counting(values, years, filtered_regions):
+        calls.append(list(years))
+        return validity(values, years, filtered_regions)
+
+    monkeypatch.setattr(rules, "validity", counting)
+    region = table.dimensions[table.table_region]
+    quarters = ["2021K4", "2021K3", "2021K2", "2021K1", "2019K4", "2019K3"]
+    masks = meta.period_validity(table.klass, region, quarters, rules)
+    assert calls == [[2019, 2021]]
+    assert all(mask is masks[0] for mask in masks[:4]) and masks[4] is masks[5] is not masks[0]
+    assert masks[0].tolist() != masks[4].tolist()
+    assert not masks[0].flags.writeable
+
+    months = ["2021M%02d" % month for month in range(1, 13)]
+    masks = meta.period_validity(table.klass, region, months, rules)
+    assert calls == [[2019, 2021], [2021]]
+    assert all(mask is masks[0] for mask in masks)
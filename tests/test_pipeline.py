@@ -0,0 +1,133 @@
+""" pipeline() in Meta Thread Filter AlleAar, replaying the archived 12367, and what happens when a step fails. """
+import copy
+import gc
+import json
+import threading
+
+import numpy as np
+import pytest
+
+import lag_arkiv
+import skript
+
+
+@pytest.fixture
+def thread(replay):
+    """ The thread variant, it replays the archive through the same http_post as Meta Filter AlleAar. """
+    thread = skript.load("meta_thread_filter_alleaar")
+    thread.ssb_table = thread.SSBTable("12367")
+    return thread
+
+
+class Sink:
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.rows = 0
+        self.writes = 0
+        self.aborted = False
+
+    def write(self, dataframe):
+        self.writes += 1
+        if self.writes == self.fail_on:
+            raise RuntimeError("Sink feilet")
+        self.rows += len(dataframe)
+
+    def abort(self):
+        self.aborted = True
+
+
+def run(thread, sink=None, **kwargs):
+    """ Runs pipeline in a thread, so a pipeline that hangs fails the test instead of the test run. """
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = thread.pipeline(lag_arkiv.thread_chunks(thread.ssb_table), sink=sink, prosesser=2,
+                                                pause=0.0, **kwargs)
+        except Exception as e:
+            outcome["error"] = e
+
+    runner = threading.Thread(target=target, daemon=True)
+    runner.start()
+    runner.join(60)
+    assert not runner.is_alive(), "pipeline henger"
+    return outcome
+
+
+def test_result(thread):
+    outcome = run(thread)
+    result = outcome["result"]
+    gc.collect()
+    assert len(result) == 11 * 1 * 4 * 1 * 8
+    assert set(result["KOKregnskapsomfa0000"]) == {"A"}
+    assert result["Tid"].value_counts().eq(44).all()
+    assert np.isnan(result["value"]).any() and not np.isnan(result["value"]).all()
+    assert result["value"].sum() > 0
+
+
+def test_sink_with_backpressure(thread):
+    sink = Sink()
+    outcome = run(thread, sink, minne_grense=1, kø_størrelse=1)
+    assert outcome == {"result": None}
+    assert sink.rows == 352 and sink.writes == 8 and not sink.aborted
+
+
+class FailingPost:
+    """ Replays the archive, but answers request number fail_on with response instead. """
+
+    def __init__(self, meta, fail_on, response):
+        self.post = meta.http_post
+        self.fail_on = fail_on
+        self.response = response
+        self.calls = 0
+
+    def __call__(self, url, json=None, headers=None, timeout=None):
+        self.calls += 1
+        if self.calls == self.fail_on:
+            return self.response
+        return self.post(url, json=json, headers=headers, timeout=timeout)
+
+
+@pytest.mark.parametrize("sink", [None, Sink()], ids=["uten sink", "med sink"])
+def test_error_from_ssb(meta, thread, monkeypatch, sink):
+    monkeypatch.setattr(meta, "http_post", FailingPost(meta, 3, meta.ArchivedResponse(b"", 503, {})))
+    outcome = run(thread, sink, minne_grense=1, kø_størrelse=1)
+    assert isinstance(outcome["error"], RuntimeError) and "503" in str(outcome["error"])
+    assert sink is None or sink.aborted
+
+
+def test_error_in_decode(meta, thread, monkeypatch):
+    sink = Sink()
+    monkeypatch.setattr(meta, "http_post", FailingPost(meta, 2, meta.ArchivedResponse(b"{", 200, {})))
+    outcome = run(thread, sink)
+    assert isinstance(outcome["error"], ValueError)
+    assert sink.aborted
+
+
+def test_error_in_sink(thread):
+    sink = Sink(fail_on=2)
+    outcome = run(thread, sink, kø_størrelse=1)
+    assert str(outcome["error"]) == "Sink feilet"
+    assert sink.aborted and sink.rows == 44
+
+
+def fewer_rows(meta, thread, chunk):
+    """ The archived response for chunk, without its last region, as SSB could answer if a region is gone. """
+    json_stat = meta.http_post(thread.ssb_table.metadata_url, json=thread.build_query(chunk)).json()
+    short = copy.deepcopy(json_stat)
+    region = short["id"].index("KOKkommuneregion0000")
+    index = short["dimension"]["KOKkommuneregion0000"]["category"]["index"]
+    last = max(index, key=index.get)
+    del index[last]
+    short["size"][region] -= 1
+    values = np.array(json_stat["value"], dtype=object).reshape(json_stat["size"])
+    short["value"] = np.delete(values, -1, axis=region).reshape(-1).tolist()
+    return meta.ArchivedResponse(json.dumps(short).encode("utf-8"), 200, {})
+
+
+@pytest.mark.parametrize("sink", [None, Sink()], ids=["uten sink", "med sink"])
+def test_fewer_rows_than_planned(meta, thread, monkeypatch, sink):
+    response = fewer_rows(meta, thread, lag_arkiv.thread_chunks(thread.ssb_table)[1])
+    monkeypatch.setattr(meta, "http_post", FailingPost(meta, 2, response))
+    outcome = run(thread, sink)
+    assert isinstance(outcome["error"], ValueError) and "planlagt" in str(outcome["error"])
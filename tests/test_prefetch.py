@@ -0,0 +1,68 @@
+""" SSBTable.prefetch only fetches KLASS for tables with a region dimension, and main prefetches the next table. """
+import time
+
+import pytest
+
+
+@pytest.fixture
+def requests_made(meta, replay, monkeypatch):
+    made = []
+    request = meta.response_archive.request
+
+    def counting(method, url, body=None, headers=None, timeout=None):
+        made.append(url)
+        return request(method, url, body, headers, timeout)
+
+    monkeypatch.setattr(meta.response_archive, "request", counting)
+    return made
+
+
+def klass_requests(made):
+    return sorted(url for url in made if "/klass/" in url)
+
+
+def test_region_table(meta, requests_made):
+    ssb_table = meta.SSBTable("12367").prefetch()
+    ssb_table.load_klass()
+    assert list(meta.region_klass_cache) == [(("131", "104", "214", "231"), 2017)]
+    meta.post_query(ssb_table)
+    requested = klass_requests(requests_made)
+    assert len(requested) == 4 and all("from=2017-01-01" in url for url in requested)
+
+
+def test_table_without_region(meta, requests_made):
+    ssb_table = meta.SSBTable("03013").prefetch()
+    ssb_table.load_klass()
+    meta.post_query(ssb_table)
+    assert klass_requests(requests_made) == []
+    assert meta.region_klass_cache == {}
+
+
+def test_tables_share_klass(meta, requests_made):
+    for ssb_table in [meta.SSBTable("12367").prefetch(), meta.SSBTable("12367").prefetch()]:
+        meta.post_query(ssb_table)
+    assert len(klass_requests(requests_made)) == 4
+
+
+def test_main_prefetches_the_next_table(meta, replay, monkeypatch, tmp_path):
+    """ With --jobs 1 the metadata of 03013 is fetched while 12367 is, instead of after it. """
+    events = []
+
+    def slow(method, request):
+        def slow_request(url, *args, **kwargs):
+            events.append(("start", method, url))
+            time.sleep(0.02)
+            try:
+                return request(url, *args, **kwargs)
+            finally:
+                events.append(("end", method, url))
+        return slow_request
+
+    monkeypatch.setattr(meta, "http_get", slow("GET", meta.http_get))
+    monkeypatch.setattr(meta, "http_post", slow("POST", meta.http_post))
+    argv = ["fetch", "12367", "03013", "--jobs", "1", "--sink", "csv", "--replay", replay, "--out", str(tmp_path)]
+    assert meta.main(argv) == 0
+
+    first_post = events.index(("end", "POST", meta.SSBTable("12367").metadata_url))
+    assert events.index(("start", "GET", meta.SSBTable("03013").metadata_url)) < first_post
+    assert events.index(("start", "POST", meta.SSBTable("03013").metadata_url)) > first_post
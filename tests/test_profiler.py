@@ -0,0 +1,51 @@
+""" Profiler on a replayed post_query, which threads it samples and the samples it leaves out. """
+import os
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def slow_get(meta, replay, monkeypatch):
+    """ Replays the GETs a little slower, so the prefetch and KLASS threads are alive long enough to be sampled. """
+    get = meta.http_get
+
+    def slow_get(url, headers=None):
+        time.sleep(0.05)
+        return get(url, headers=headers)
+
+    monkeypatch.setattr(meta, "http_get", slow_get)
+
+
+def functions(profiler):
+    return [{name for name, file_name, line in stack} for stack in profiler.samples]
+
+
+def test_samples_the_threads_working_for_the_table(meta, slow_get, tmp_path):
+    profiler = meta.Profiler("12367", str(tmp_path), interval=0.002)
+    meta.post_query(meta.SSBTable("12367").prefetch(), profile=profiler)
+    assert sorted(os.listdir(tmp_path)) == ["12367.collapsed.txt", "12367.hotspots.txt", "12367.speedscope.json"]
+    assert any({"prefetch_quietly", "slow_get"} <= names for names in functions(profiler))
+    assert any({"_worker", "slow_get"} <= names for names in functions(profiler))
+
+
+def test_profiled(meta, tmp_path):
+    profiler = meta.Profiler("12367", str(tmp_path))
+    with profiler:
+        names = {1: "MainThread/klass_0", 2: "12367/prefetch", 3: "03013/prefetch", 4: "ThreadPoolExecutor-0_0"}
+        assert [profiler.profiled(thread_id, names) for thread_id in names] == [True, True, False, False]
+        assert profiler.profiled(threading.get_ident(), {})
+
+
+def test_idle_thread_is_left_out(meta, tmp_path):
+    stop = threading.Event()
+    waiting = threading.Thread(target=stop.wait, name="12367/venter", daemon=True)
+    waiting.start()
+    with meta.Profiler("12367", str(tmp_path), interval=0.002) as profiler:
+        time.sleep(0.1)
+    stop.set()
+    waiting.join()
+    assert profiler.idle > 0
+    assert not any("wait" in names for names in functions(profiler))
+    assert "bare ventet" in (tmp_path / "12367.hotspots.txt").read_text(encoding="utf-8")
@@ -0,0 +1,80 @@
+""" compile_profile and resolve_selection in ASSS SSB AlleAar Values.py, against the archived metadata of 12367. """
+import pytest
+
+
+def variable(metadata, code):
+    return next(var for var in metadata["variables"] if var["code"] == code)
+
+
+def rows(query, metadata):
+    total = 1
+    for item in query["query"]:
+        selection = item["selection"]
+        if selection["filter"] == "all":
+            assert selection["values"] == ["*"]
+            total *= len(variable(metadata, item["code"])["values"])
+        else:
+            total *= len(selection["values"]) if selection["filter"] == "item" else int(selection["values"][0])
+    return total
+
+
+@pytest.mark.parametrize("selection, expected", [
+    ({"values": ["A"]}, ("item", ["A"], 1)),
+    ({"all": True}, ("all", ["*"], 2)),
+    ({"prefix": ["B"]}, ("item", ["B"], 1)),
+    ({"first": 1}, ("item", ["A"], 1)),
+    ({"skip": 1}, ("item", ["B"], 1)),
+    ({"top": 5}, ("top", ["5"], 2)),
+])
+def test_resolve_selection(values, metadata, selection, expected):
+    assert values.resolve_selection(variable(metadata, "KOKregnskapsomfa0000"), selection) == expected
+
+
+def test_resolve_selection_unknown(values, metadata):
+    with pytest.raises(ValueError):
+        values.resolve_selection(variable(metadata, "Tid"), {"last": 2})
+
+
+def test_compile_profile(values, metadata):
+    profile = values.load_profile("12367")
+    queries = values.compile_profile(profile, metadata["variables"])
+    assert len(queries) == 1
+    selections = {item["code"]: item["selection"] for item in queries[0]["query"]}
+    assert list(selections) == ["KOKregnskapsomfa0000", "KOKart0000", "Tid"]
+    assert selections["KOKregnskapsomfa0000"] == {"filter": "item", "values": ["A"]}
+    assert selections["KOKart0000"] == {"filter": "all", "values": ["*"]}
+    assert selections["Tid"] == {"filter": "top", "values": ["3"]}
+    assert queries[0]["response"] == {"format": "json-stat2"}
+
+
+def test_compile_profile_fans_out(values, metadata):
+    profile = values.load_profile("12367")
+    queries = values.compile_profile(profile, metadata["variables"], max_rows=7)
+    assert len(queries) == 2
+    arts = []
+    for query in queries:
+        assert rows(query, metadata) < 7
+        arts.extend(item["selection"]["values"] for item in query["query"] if item["code"] == "KOKart0000")
+    assert sum(arts, []) == ["AG1", "AG2", "AG3", "AG4"]
+
+
+def test_split_at_the_same_limit_as_meta_filter(values, metadata):
+    """ 1 * 4 * 3 = 12 rows, a query has to have fewer rows than max_rows like the chunks meta_filter plans. """
+    profile = values.load_profile("12367")
+    assert len(values.compile_profile(profile, metadata["variables"], max_rows=13)) == 1
+    queries = values.compile_profile(profile, metadata["variables"], max_rows=12)
+    assert [rows(query, metadata) for query in queries] == [9, 3]
+
+
+def test_compile_profile_unlisted_all(values, metadata):
+    profile = {"table_id": "12367", "unlisted": "all", "parts": [{"Tid": {"top": 1}}]}
+    query = values.compile_profile(profile, metadata["variables"])[0]
+    assert [item["code"] for item in query["query"]] == [var["code"] for var in metadata["variables"]]
+    assert rows(query, metadata) == 11 * 2 * 4 * 1 * 1
+    assert [item["selection"]["filter"] for item in query["query"]] == ["all", "all", "all", "all", "top"]
+
+
+def test_compile_profile_unknown_code(values, metadata):
+    profile = {"table_id": "12367", "parts": [{"Alder": {"all": True}}]}
+    with pytest.raises(KeyError):
+        values.compile_profile(profile, metadata["variables"])
@@ -0,0 +1,41 @@
+""" The region rule sets in Meta Filter AlleAar, and the other scripts filtering regions with them. """
+import json
+import os
+
+import skript
+
+
+def test_prefix_rules(meta):
+    rules = meta.load_region_rules("prefix")
+    codes = ["0301", "1601", "5001", "3001", "2111"]
+    valid = rules.validity(codes, [2017, 2018, 2020]).tolist()
+    assert valid == [[True, True, False, False, False],
+                     [True, False, True, False, False],
+                     [False, False, True, True, False]]
+
+
+def test_values_uses_the_same_rules(meta, values):
+    assert values.meta is meta
+    assert not hasattr(values, "RegionRules")
+
+
+def test_readme_shows_the_default_rules(meta):
+    with open(os.path.join(skript.root, "README.md"), encoding="utf-8") as f:
+        readme = f.read()
+    start = readme.index('    {"klass"')
+    end = readme.index("\n\n", start)
+    assert json.loads(readme[start:end]) == meta.default_region_rules
+
+
+def test_thread_filters_with_the_rules(meta, table):
+    thread = skript.load("meta_thread_filter_alleaar")
+    thread.ssb_table = thread.SSBTable.__new__(thread.SSBTable)
+    thread.ssb_table.variables = {"variables": [dimension.to_variable() for dimension in table.dimensions]}
+    thread.ssb_table.table_region, thread.ssb_table.table_tid, thread.ssb_table.table_size = 0, 4, 8
+    thread.ssb_table.ssb_max_row_query = 800000
+    thread.klass = table.klass
+    region = table.dimensions[table.table_region]
+    for variables in thread.meta_filter():
+        year = int(variables[4]["values"][0])
+        valid = meta.region_rules.validity(region.values, [year], table.klass.filtered_regions)[0]
+        assert variables[0]["values"] == [code for code, ok in zip(region.values, valid) if ok]
@@ -0,0 +1,71 @@
+""" wildcard_patterns and build_selection, the selections pushed down to SSB instead of spelling out every value. """
+from collections import OrderedDict
+
+import pandas as pd
+import pytest
+from pyjstat import pyjstat
+
+import lag_arkiv
+
+regions = ["0", "EAK", "EAKUO", "0301", "1101", "1601", "5001", "3001", "3002", "3401", "2111"]
+
+
+def dimension(meta, values, time=False):
+    variable = {"code": "Tid" if time else "Region", "text": "år" if time else "region", "values": values,
+                "valueTexts": values}
+    if time:
+        variable["time"] = True
+    return meta.Dimension(variable)
+
+
+def selected(meta, dimension_all, values):
+    return dimension_all.select([dimension_all.index[value] for value in values])
+
+
+def test_full_prefix_is_a_pattern(meta):
+    assert meta.wildcard_patterns(["EAK", "EAKUO"], regions) == ["E*"]
+    region = dimension(meta, regions)
+    assert meta.build_selection(selected(meta, region, ["0301", "EAK", "EAKUO"])) == \
+        {"filter": "all", "values": ["03*", "E*"]}
+
+
+def test_partial_prefix_stays_item(meta):
+    assert meta.wildcard_patterns(["3001"], regions) == ["3001"]
+    region = dimension(meta, regions)
+    assert meta.build_selection(selected(meta, region, ["3001", "3401"])) == \
+        {"filter": "item", "values": ["3001", "3401"]}
+
+
+def test_every_value_is_all(meta):
+    region = dimension(meta, regions)
+    assert meta.build_selection(region) == {"filter": "all", "values": ["*"]}
+
+
+def test_top_only_for_the_newest_periods(meta):
+    tid = dimension(meta, [str(year) for year in range(2015, 2023)], time=True)
+    assert meta.build_selection(selected(meta, tid, ["2022", "2021", "2020"])) == {"filter": "top", "values": ["3"]}
+    assert meta.build_selection(selected(meta, tid, ["2019", "2018"])) == {"filter": "item", "values": ["2019", "2018"]}
+    assert meta.build_selection(selected(meta, tid, ["2022", "2020"])) == {"filter": "item", "values": ["2022", "2020"]}
+
+
+@pytest.mark.parametrize("values", [regions[:i] for i in range(1, len(regions) + 1)] +
+                         [regions[i:] for i in range(len(regions))] + [regions[::2], regions[1::2], regions[3:7]])
+def test_never_more_patterns_than_items(meta, values):
+    patterns = meta.wildcard_patterns(values, regions)
+    assert len(patterns) <= len(values)
+    selection = meta.build_selection(selected(meta, dimension(meta, regions), values))
+    assert len(selection["values"]) <= len(values)
+
+
+def result(meta, ssb_table, query):
+    response = meta.http_post(ssb_table.metadata_url, json=query)
+    return pyjstat.from_json_stat(response.json(object_pairs_hook=OrderedDict), naming="id")[0]
+
+
+def test_pushed_down_chunk_returns_the_same_rows(meta, table):
+    chunks = meta.meta_filter(table, meta.calc_iterations(table))
+    for chunk in chunks:
+        query = meta.build_query(chunk)
+        assert any(item["selection"]["filter"] != "item" for item in query["query"])
+        expected = result(meta, table, lag_arkiv.item_query(meta, chunk))
+        pd.testing.assert_frame_equal(result(meta, table, query), expected)
@@ -0,0 +1,103 @@
+""" sparse_result, and dropping the rows without a value in the sinks, on the archived 12367.
+
+The first chunk of 12367 has about 16% cells without a value and the second about 11%.
+"""
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+
+def test_auto_sparse_counts_zeros(meta, table, monkeypatch):
+    result = meta.post_query(table)
+    value = result["value"].to_numpy(dtype=float)
+    monkeypatch.setattr(meta, "sparse_threshold", np.isnan(value).mean() + 0.01)
+    assert meta.sparse_result(result, "auto") is result
+    assert not meta.should_drop_missing(result, "auto")
+    monkeypatch.setattr(meta, "sparse_threshold", max(np.isnan(value).mean(), (value == 0).mean()))
+    sparse = meta.sparse_result(result, "auto")
+    assert isinstance(sparse["value"].dtype, pd.SparseDtype)
+    np.testing.assert_array_equal(sparse["value"].to_numpy(), value)
+
+
+def test_drop_missing_keeps_zeros(meta, table):
+    result = meta.post_query(table)
+    dropped = meta.sparse_result(result, True, drop_missing=True)
+    assert len(dropped) == result["value"].notna().sum()
+    assert (dropped["value"] == 0).sum() == (result["value"] == 0).sum() > 0
+
+
+class RecordingSink:
+    def __init__(self):
+        self.drop_missing_per_write = []
+        self.missing = 0
+
+    def write(self, dataframe, updated=None):
+        self.drop_missing_per_write.append(self.drop_missing)
+        self.missing += dataframe["value"].isna().sum()
+
+    def close(self):
+        return {}
+
+    def abort(self):
+        pass
+
+
+def test_auto_is_decided_once_per_table(meta, table, monkeypatch):
+    monkeypatch.setattr(meta, "sparse_threshold", 0.13)
+    sink = RecordingSink()
+    meta.post_query(table, sink, sparse="auto")
+    assert sink.drop_missing_per_write == [True, True]
+    assert sink.missing > 0
+
+    monkeypatch.setattr(meta, "sparse_threshold", 0.5)
+    sink = RecordingSink()
+    meta.post_query(meta.SSBTable("12367"), sink, sparse="auto")
+    assert sink.drop_missing_per_write == [False, False]
+
+
+def test_sql_sink_drops_missing(meta, table):
+    expected = meta.post_query(meta.SSBTable("12367"))
+    connection = sqlite3.connect(":memory:")
+    meta.post_query(table, meta.SQLTableSink(connection, "kostra"), sparse=True)
+    assert connection.execute('SELECT COUNT(*) FROM "kostra"').fetchone()[0] == expected["value"].notna().sum()
+    assert connection.execute('SELECT COUNT(*) FROM "kostra" WHERE "value" IS NULL').fetchone()[0] == 0
+
+
+def test_merge_sink_deletes_cells_without_a_value(meta, replay):
+    connection = sqlite3.connect(":memory:")
+    sink = meta.SQLiteMergeSink(connection, "kostra")
+    first = meta.post_query(meta.SSBTable("12367"), sink, sparse=True).iloc[0]
+    stored = connection.execute('SELECT COUNT(*) FROM "kostra"').fetchone()[0]
+    assert first["Nye"] == stored and first["Slettet"] == 0
+
+    # The cells had a value in an earlier run, but are empty now
+    expected = meta.post_query(meta.SSBTable("12367"))
+    missing = expected[expected["value"].isna()].head(3).astype(str)
+    columns = list(expected.columns)
+    connection.executemany('INSERT INTO "kostra" VALUES (' + ", ".join("?" for column in columns) + ")",
+                           [row[:-1] + (1.0,) for row in missing.itertuples(index=False, name=None)])
+    connection.commit()
+
+    sink = meta.SQLiteMergeSink(connection, "kostra")
+    summary = meta.post_query(meta.SSBTable("12367"), sink, sparse=True).iloc[0]
+    assert summary["Slettet"] == 3 and summary["Nye"] == summary["Endret"] == 0
+    assert summary["Uendret"] == stored
+    assert connection.execute('SELECT COUNT(*) FROM "kostra"').fetchone()[0] == stored
+
+
+def test_dataset_sink_replaces_empty_periods(meta, replay, tmp_path):
+    meta.post_query(meta.SSBTable("12367"), meta.PartitionedDatasetSink(str(tmp_path), "12367"))
+    written = meta.read_dataset(str(tmp_path), "12367")
+
+    empty = written[written["Tid"] == "2022"].copy()
+    empty["value"] = np.nan
+    sink = meta.PartitionedDatasetSink(str(tmp_path), "12367")
+    sink.drop_missing = True
+    sink.write(empty)
+    assert sink.close()["parts"] == 0
+
+    manifest = meta.read_manifest(str(tmp_path), "12367")
+    assert "2022" not in set(part["tid"] for part in manifest["parts"])
+    assert not (tmp_path / "table=12367" / "tid=2022").exists()
+    assert len(meta.read_dataset(str(tmp_path), "12367")) == len(written) - len(empty)
@@ -0,0 +1,56 @@
+""" SQLTableSink on sqlite, loading the archived 12367 with post_query. """
+import sqlite3
+
+import pytest
+
+
+class FailingSink:
+    """ Passes the chunks on to sink, and fails on chunk number fail_on. """
+
+    def __init__(self, sink, fail_on):
+        self.sink = sink
+        self.fail_on = fail_on
+        self.writes = 0
+
+    def write(self, dataframe, updated=None):
+        self.writes += 1
+        if self.writes == self.fail_on:
+            raise RuntimeError("Sink feilet")
+        self.sink.write(dataframe, updated=updated)
+
+    def close(self):
+        return self.sink.close()
+
+    def abort(self):
+        self.sink.abort()
+
+
+def old_table():
+    connection = sqlite3.connect(":memory:")
+    connection.execute('CREATE TABLE "kostra" ("gammel" TEXT)')
+    connection.execute('INSERT INTO "kostra" VALUES (?)', ("rad",))
+    connection.commit()
+    return connection
+
+
+@pytest.mark.parametrize("staging", [False, True])
+def test_load(meta, table, staging):
+    connection = old_table()
+    summary = meta.post_query(table, sink=meta.SQLTableSink(connection, "kostra", staging=staging))
+    rows = connection.execute('SELECT COUNT(*), COUNT("value") FROM "kostra"').fetchone()
+    assert rows[0] == summary["Rader"][0] > 0
+    assert 0 < rows[1] < rows[0]
+    names = [row[1] for row in connection.execute('PRAGMA table_info("kostra")')]
+    assert names == ["KOKkommuneregion0000", "KOKregnskapsomfa0000", "KOKart0000", "ContentsCode", "Tid", "value"]
+
+
+@pytest.mark.parametrize("staging", [False, True])
+def test_abort_keeps_old_table(meta, table, staging):
+    connection = old_table()
+    sink = FailingSink(meta.SQLTableSink(connection, "kostra", staging=staging), fail_on=2)
+    with pytest.raises(RuntimeError):
+        meta.post_query(table, sink=sink)
+    assert sink.writes == 2
+    assert connection.execute('SELECT * FROM "kostra"').fetchall() == [("rad",)]
+    tables = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+    assert tables == [("kostra",)]